@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lib.utils
+from lib.base import execute, get_plan
+from lib.stats import format_time
+from lib.runners.bash import BashRunner, PersistentBashRunner
+from lib.runners.echo import EchoRunner
+from lib.encoders.ssh import SSHEncoder
+from lib.encoders.wmic import WmicEncoder
+from lib.encoders.powershell import PowerShellEncoder
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+PAYLOAD_SIZES = [10, 1000, 100000, 1000000, 10000000]
+QUICK_PAYLOAD_SIZES = [10, 1000, 100000]
+
+BENCHMARKS = []
+
+def benchmark(name, size=None):
+    """
+    Register a benchmark. The decorated function is called once to set up the benchmark and returns
+    the callable to time. Benchmarks with a size report throughput in bytes per second.
+    """
+    def _benchmark(func):
+        BENCHMARKS.append((name, size, func))
+        return func
+    return _benchmark
+
+def get_payload(size):
+    # Shell-like text with the quotes, backslashes and pipes the encoders have to escape
+    alphabet = string.ascii_letters + string.digits + " -_./=\"'\\|&<>$"
+    return "".join(random.Random(size).choices(alphabet, k=size))
+
+def get_session(encoders):
+    return {"runner" : EchoRunner(), "encoders" : encoders, "decoders" : []}
+
+def _register_chains(sizes):
+    def _ssh_chain():
+        return [SSHEncoder("user{}".format(x), "10.0.0.{}".format(x)) for x in range(5)]
+
+    for size in sizes:
+        def _ssh(size=size):
+            session = get_session(_ssh_chain())
+            payload = get_payload(size)
+            return lambda: execute(payload, session)
+
+        def _ssh_wmic_powershell(size=size):
+            session = get_session(_ssh_chain() + [WmicEncoder("10.0.1.1", "administrator", "password"), PowerShellEncoder()])
+            payload = get_payload(size)
+            return lambda: execute(payload, session)
+
+        benchmark("execute.ssh5.{}".format(size), size)(_ssh)
+        benchmark("execute.ssh5_wmic_powershell.{}".format(size), size)(_ssh_wmic_powershell)
+
+@benchmark("plan.compile.ssh5_wmic_powershell")
+def _plan_compile():
+    encoders = [SSHEncoder("user{}".format(x), "10.0.0.{}".format(x)) for x in range(5)] + [WmicEncoder("10.0.1.1"), PowerShellEncoder()]
+    def _compile():
+        session = get_session(encoders)
+        get_plan(session)
+    return _compile
+
+@benchmark("args.get_args.json")
+def _get_args_json():
+    return lambda: lib.utils.get_args("{\"url\" : \"http://www.example.com\", \"data\" : \"arg=[*]\", \"replace\" : \"*\"}")
+
+@benchmark("args.get_args.call")
+def _get_args_call():
+    return lambda: lib.utils.get_args("(\"http://www.example.com\", \"arg=[*]\", replace=\"*\", timeout=5)")
+
+@benchmark("args.get_args.cmdline")
+def _get_args_cmdline():
+    return lambda: lib.utils.get_args("--replace=\"*\" --timeout=5 \"http://www.example.com\" \"arg=[*]\"")
+
+@benchmark("args.tokenize_args")
+def _tokenize_args():
+    argument_string = " ".join("--key{}=\"value {}\" [{}, {{\"a\" : {}}}]".format(x, x, x, x) for x in range(20))
+    return lambda: list(lib.utils.tokenize_args(argument_string))
+
+@benchmark("bash.latency")
+def _bash_latency():
+    session = {"runner" : BashRunner(), "encoders" : [], "decoders" : []}
+    return lambda: execute("true", session)
+
+@benchmark("bash.persistent.latency")
+def _persistent_bash_latency():
+    session = {"runner" : PersistentBashRunner(), "encoders" : [], "decoders" : []}
+    return lambda: execute("true", session)
+
+@benchmark("bash.output.10000000", 10000000)
+def _bash_output():
+    session = {"runner" : BashRunner(), "encoders" : [], "decoders" : []}
+    return lambda: execute("head -c 10000000 /dev/zero | tr '\\0' 'A'", session)
+
+def measure(func, min_time, min_repeat):
+    """
+    Time repeated calls of func after a warm up call, until both min_time seconds and min_repeat
+    calls have elapsed, returning the per call times.
+    """
+    func()
+    times = []
+    starttime = time.perf_counter()
+    while len(times) < min_repeat or time.perf_counter() - starttime < min_time:
+        _starttime = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - _starttime)
+    return times
+
+def run(pattern=None, min_time=0.5, min_repeat=5):
+    results = {}
+    for name, size, setup in BENCHMARKS:
+        if pattern is not None and pattern not in name:
+            continue
+        times = measure(setup(), min_time, min_repeat)
+        result = {
+            "median" : statistics.median(times),
+            "min" : min(times),
+            "stdev" : statistics.stdev(times) if len(times) > 1 else 0,
+            "repeat" : len(times),
+        }
+        if size is not None:
+            result["bytes"] = size
+            result["bytes_per_second"] = size / result["median"]
+        results[name] = result
+        print("{:45s} {:>12s} {:>12s}{}".format(name, format_time(result["median"]), format_time(result["min"]), "  {:8.1f} MB/s".format(result["bytes_per_second"] / 1e6) if size is not None else ""), file=sys.stderr)
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Compare the fastest times, which are less affected by noise than the median, against the
+    baseline, returning the names of benchmarks which are more than threshold (a fraction) slower.
+    """
+    regressions = []
+    print("\n{:45s} {:>12s} {:>12s} {:>8s}".format("benchmark", "baseline", "current", "ratio"), file=sys.stderr)
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["min"] / baseline[name]["min"]
+        status = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            status = "  REGRESSION"
+        print("{:45s} {:>12s} {:>12s} {:>7.2f}x{}".format(name, format_time(baseline[name]["min"]), format_time(result["min"]), ratio, status), file=sys.stderr)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="benchmark", description="Benchmark the CmdRunner hot paths")
+    parser.add_argument("--filter", "-f", type=str, default=None, help="Only run benchmarks whose name contains the given string")
+    parser.add_argument("--quick", "-q", action="store_true", default=False, help="Skip the largest payload sizes")
+    parser.add_argument("--min-time", type=float, default=0.5, help="Minimum number of seconds to run each benchmark for")
+    parser.add_argument("--min-repeat", type=int, default=5, help="Minimum number of timed runs of each benchmark")
+    parser.add_argument("--output", "-o", type=str, default=None, help="File to write the JSON results to, - for stdout")
+    parser.add_argument("--baseline", "-b", type=str, default=BASELINE_PATH, help="Baseline JSON results to compare against")
+    parser.add_argument("--threshold", "-t", type=float, default=0.25, help="Fraction slower than the baseline reported as a regression")
+    parser.add_argument("--save-baseline", action="store_true", default=False, help="Store the results as the new baseline")
+    parser.add_argument("--force", action="store_true", default=False, help="With --save-baseline, also store results which are regressions")
+    args = parser.parse_args()
+
+    _register_chains(QUICK_PAYLOAD_SIZES if args.quick else PAYLOAD_SIZES)
+    output = {
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "results" : run(args.filter, args.min_time, args.min_repeat),
+    }
+
+    if args.output == "-":
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    elif args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {"results" : {}}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        # Regressions (or a noisy run) are only stored when forced, so they are not hidden by later
+        # comparisons against them
+        if not args.force:
+            for name in compare(output["results"], baseline["results"], args.threshold):
+                print("Keeping the baseline of {}, use --force to store it".format(name), file=sys.stderr)
+                del output["results"][name]
+        # Keep the baseline of any benchmarks which were filtered out or kept
+        output["results"] = {**baseline["results"], **output["results"]}
+        with open(args.baseline, "w") as f:
+            json.dump(output, f, indent=2)
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(output["results"], baseline["results"], args.threshold):
+            sys.exit(1)
@@ -5,12 +5,12 @@ import os
 import re
 import readline
 import sys
+import time
 
-from lib.base import InteractiveCmd, CmdRunnerException, CmdRunner, CmdEncoder, CmdDecoder, execute
+from lib.base import InteractiveCmd, CmdRunnerException, execute, execute_stream, execute_batch_async, close_encoders, invalidate_plan, get_plan, is_cacheable
+import lib.buffer
+import lib.registry
 import lib.utils
-from lib.runners import *
-from lib.encoders import *
-from lib.decoders import *
 
 class PrintSessionCmd(InteractiveCmd):
     tag = "print_session"
@@ -50,18 +50,17 @@ class LoadSessionCmd(InteractiveCmd):
             raise CmdRunnerException("Session file '{}' does not exist".format(session_file))
         with open(session_file) as f:
             _session = json.load(f)
-        available_runners = {x.__name__ : x for x in CmdRunner.get_subclasses()}
-        available_encoders = {x.__name__ : x for x in CmdEncoder.get_subclasses()}
-        available_decoders = {x.__name__ : x for x in CmdDecoder.get_subclasses()}
         try:
-            runner = available_runners[_session["runner"]["__classname__"]].load(_session["runner"])
-            encoders = [available_encoders[x["__classname__"]].load(x) for x in _session["encoders"]]
-            decoders = [available_decoders[x["__classname__"]].load(x) for x in _session["decoders"]]
+            runner = lib.registry.get_class("runner", _session["runner"]["__classname__"]).load(_session["runner"])
+            encoders = [lib.registry.get_class("encoder", x["__classname__"]).load(x) for x in _session["encoders"]]
+            decoders = [lib.registry.get_class("decoder", x["__classname__"]).load(x) for x in _session["decoders"]]
         except KeyError:
             raise CmdRunnerException("Invalid session")
+        WmicWorkerCmd.stop_workers(session)
         session["runner"] = runner
         session["encoders"] = encoders
         session["decoders"] = decoders
+        invalidate_plan(session)
         if not quiet:
             PrintSessionCmd.run(None, session)
 
@@ -97,8 +96,8 @@ class ListRunnersCmd(InteractiveCmd):
     @classmethod
     def run(cls, args, session):
         print("Available Runners:")
-        for runner in sorted(CmdRunner.get_subclasses(), key=lambda x: x.__name__):
-            print("\t{}".format(runner.__name__))
+        for runner in lib.registry.get_names("runner"):
+            print("\t{}".format(runner))
 
 class ListEncodersCmd(InteractiveCmd):
     tag = "list_encoders"
@@ -110,8 +109,8 @@ class ListEncodersCmd(InteractiveCmd):
     @classmethod
     def run(cls, args, session):
         print("Available Encoders:")
-        for encoder in sorted(CmdEncoder.get_subclasses(), key=lambda x: x.__name__):
-            print("\t{}".format(encoder.__name__))
+        for encoder in lib.registry.get_names("encoder"):
+            print("\t{}".format(encoder))
 
 class ListDecodersCmd(InteractiveCmd):
     tag = "list_decoders"
@@ -123,8 +122,8 @@ class ListDecodersCmd(InteractiveCmd):
     @classmethod
     def run(cls, args, session):
         print("Available Decoders:")
-        for decoder in sorted(CmdDecoder.get_subclasses(), key=lambda x: x.__name__):
-            print("\t{}".format(decoder.__name__))
+        for decoder in lib.registry.get_names("decoder"):
+            print("\t{}".format(decoder))
 
 class PushEncoder(InteractiveCmd):
     tag = "push_encoder"
@@ -135,25 +134,26 @@ class PushEncoder(InteractiveCmd):
 
         Encoder arguments should be supplied in either a json form (e.g. {"key" : "value"}),
         a python funcion call form (e.g. (1, 2, key="value")), or a command line argument
-        form (--key="value" 1 2). Note: Special characters need to be escaped within quotes
+        form (--key="value" 1 2). Note: Special characters need to be escaped within quotes, and
+        values containing commas, such as the lists of hosts of encoders which fan out, quoted
 
         Example:
             $push_encoder curl {"url" : "http://www.example.com", "data" : "arg=[*]", "replace" : "*"}
             $push_encoder curl("http://www.example.com", "arg=[*]", replace="*")
             $push_encoder curl --replace=* http://www.example.com "arg=[*]"
+            $push_encoder ssh admin "web1,web2,@hosts.txt"
     """
-    tab_complete_options = [x.__name__ for x in CmdEncoder.get_subclasses()]
+    tab_complete_options = lib.registry.get_names("encoder")
 
     @classmethod
     def run(cls, args, session):
-        available_encoders = {x.__name__.lower() : x for x in CmdEncoder.get_subclasses()}
         match = re.match("([0-9]+)? *([A-Za-z0-9_]+)(.*)", args)
         if match is None:
             raise CmdRunnerException("$push_encoder requires arguments: [index] <encoder_name> [encoder_arguments]")
 
         index, encoder_arg, args = match.groups()
         index = int(index) if index is not None else len(session["encoders"])
-        encoder_cls = available_encoders.get(encoder_arg.lower(), available_encoders.get(encoder_arg.lower() + "encoder"))
+        encoder_cls = lib.registry.find_class("encoder", encoder_arg)
         args = args.strip()
 
         if encoder_cls is None:
@@ -168,7 +168,9 @@ class PushEncoder(InteractiveCmd):
             print(encoder.get_instance())
         except TypeError as e:
             raise CmdRunnerException("Error: {}\n\n{}".format(e, encoder_cls.get_args()))
+        WmicWorkerCmd.stop_workers(session)
         session["encoders"].insert(index, encoder)
+        invalidate_plan(session)
 
 class PopEncoder(InteractiveCmd):
     tag = "pop_encoder"
@@ -189,7 +191,9 @@ class PopEncoder(InteractiveCmd):
             index = -1
         if index >= len(session["encoders"]):
             raise CmdRunnerException("Invalid index '{}' for encoder list length {}".format(args, len(session["encoders"])))
+        WmicWorkerCmd.stop_workers(session)
         session["encoders"].pop(index)
+        invalidate_plan(session)
 
 class PushDecoder(InteractiveCmd):
     tag = "push_decoder"
@@ -207,18 +211,17 @@ class PushDecoder(InteractiveCmd):
             $push_decoder curl("http://www.example.com", "arg=[*]", replace="*")
             $push_decoder curl --replace=* http://www.example.com "arg=[*]"
     """
-    tab_complete_options = [x.__name__ for x in CmdDecoder.get_subclasses()]
+    tab_complete_options = lib.registry.get_names("decoder")
 
     @classmethod
     def run(cls, args, session):
-        available_decoders = {x.__name__.lower() : x for x in CmdDecoder.get_subclasses()}
         match = re.match("([0-9]+)? *([A-Za-z0-9_]+)(.*)", args)
         if match is None:
             raise CmdRunnerException("$push_decoder requires arguments: [index] <decoder_name> [decoder_arguments]")
 
         index, decoder_arg, args = match.groups()
         index = int(index) if index is not None else len(session["decoders"])
-        decoder_cls = available_decoders.get(decoder_arg.lower(), available_decoders.get(decoder_arg.lower() + "decoder"))
+        decoder_cls = lib.registry.find_class("decoder", decoder_arg)
         args = args.strip()
 
         if decoder_cls is None:
@@ -272,18 +275,17 @@ class SetRunner(InteractiveCmd):
             $set_runner bash(timeout=2)
             $set_runner bash --timeout=2
     """
-    tab_complete_options = [x.__name__ for x in CmdRunner.get_subclasses()]
+    tab_complete_options = lib.registry.get_names("runner")
 
     @classmethod
     def run(cls, args, session):
-        available_runners = {x.__name__.lower() : x for x in CmdRunner.get_subclasses()}
         match = re.match("([A-Za-z0-9_]+)(.*)", args.strip())
         if match is None:
             raise CmdRunnerException("$set_runner requires arguments: <runner_name> [runner_arguments]")
         runner_arg, args = match.groups()
         args = args.strip()
 
-        runner_cls = available_runners.get(runner_arg.lower(), available_runners.get(runner_arg.lower() + "runner"))
+        runner_cls = lib.registry.find_class("runner", runner_arg)
         if runner_cls is None:
             raise CmdRunnerException("'{}' is not a valid runner".format(runner_arg))
 
@@ -296,7 +298,673 @@ class SetRunner(InteractiveCmd):
             print(runner.get_instance())
         except TypeError as e:
             raise CmdRunnerException("Error: {}\n\n{}".format(e, runner_cls.get_args()))
+        WmicWorkerCmd.stop_workers(session)
         session["runner"] = runner
+        invalidate_plan(session)
+
+class BatchCmd(InteractiveCmd):
+    tag = "batch"
+    description = "Run a file of commands concurrently"
+    help = """
+        Run each command in a file concurrently through the current session, printing the
+        results in input order. Blank lines and lines starting with '#' are ignored.
+            $batch [workers] <command_file> [output_file]
+
+        Example:
+            $batch recon.txt
+            $batch 16 recon.txt recon_output.txt
+    """
+    tab_complete_options = glob.glob("*.txt")
+
+    @classmethod
+    def run(cls, args, session, output_file=None):
+        match = re.match("([0-9]+ +)?([^ ]+)(?: +([^ ]+))?$", args.strip())
+        if match is None:
+            raise CmdRunnerException("$batch requires arguments: [workers] <command_file> [output_file]")
+        _workers, command_file, _output_file = match.groups()
+        workers = int(_workers) if _workers is not None else session.get("workers", 8)
+        output_file = _output_file or output_file
+        if workers < 1:
+            raise CmdRunnerException("Invalid number of workers '{}'".format(workers))
+        if not os.path.isfile(command_file):
+            raise CmdRunnerException("Command file '{}' does not exist".format(command_file))
+        with open(command_file) as f:
+            cmds = [x.strip() for x in f.readlines() if len(x.strip()) and not x.strip().startswith("#")]
+
+        import asyncio
+        f = open(output_file, "w", errors="surrogateescape") if output_file is not None else sys.stdout
+        try:
+            asyncio.run(cls.run_batch(cmds, session, workers, f))
+        finally:
+            if f is not sys.stdout:
+                f.close()
+
+    @classmethod
+    async def run_batch(cls, cmds, session, workers, f):
+        failed = 0
+        index = 0
+        starttime = time.monotonic()
+        try:
+            async for cmd, output, error, elapsed in execute_batch_async(cmds, session, workers=workers):
+                index += 1
+                status = "ok" if error is None else "failed: {}".format(error)
+                failed += 0 if error is None else 1
+                print("[{}/{}] {} ({}, {:.2f}s)".format(index, len(cmds), cmd, status, elapsed), file=f)
+                if output is not None:
+                    for line in lib.utils.iter_lines(output.iter_chunks()):
+                        print("<<< {}".format(line), file=f)
+                    f.flush()
+                    output.close()
+        finally:
+            # The event loop is closed once the batch completes
+            await session["runner"].aclose()
+        print("Ran {} commands, {} failed, in {:.2f}s".format(len(cmds), failed, time.monotonic() - starttime))
+
+class SetWorkersCmd(InteractiveCmd):
+    tag = "set_workers"
+    description = "Set the number of concurrent commands"
+    help = """
+        Set the maximum number of commands run concurrently by $batch, by encoders fanning out to
+        multiple hosts and as background jobs.
+            $set_workers <workers>
+    """
+
+    @classmethod
+    def run(cls, args, session):
+        try:
+            workers = int(args.strip())
+        except ValueError:
+            raise CmdRunnerException("Invalid number of workers '{}'".format(args))
+        if workers < 1:
+            raise CmdRunnerException("Invalid number of workers '{}'".format(args))
+        session["workers"] = workers
+        if session.get("jobs") is not None:
+            session["jobs"].resize(workers)
+
+def parse_transfer_args(cmd, args):
+    match = re.match("(\"[^\"]+\"|[^ ]+) +(\"[^\"]+\"|[^ ]+)(?: +(posix|cmd|powershell))?$", args.strip())
+    if match is None:
+        raise CmdRunnerException("${} requires arguments: <source_file> <destination_file> [posix|cmd|powershell]".format(cmd))
+    source, destination, shell = match.groups()
+    return source.strip("\""), destination.strip("\""), shell
+
+def print_progress(done, total):
+    print("\r[*] {}/{} chunks".format(done, total), end="\n" if done == total else "", flush=True)
+
+class UploadCmd(InteractiveCmd):
+    tag = "upload"
+    description = "Upload a file through the encoder chain"
+    help = """
+        Upload a local file through the encoder chain. The file is split into chunks sized to
+        fit the command length limits of the chain, which are sent in parallel and verified
+        with per chunk hashes. Re-running an interrupted upload resumes it. The remote shell
+        is detected from the encoder chain unless specified.
+            $upload <local_file> <remote_file> [posix|cmd|powershell]
+    """
+
+    @classmethod
+    def run(cls, args, session):
+        local_file, remote_file, shell = parse_transfer_args(cls.tag, args)
+        if not os.path.isfile(local_file):
+            raise CmdRunnerException("Local file '{}' does not exist".format(local_file))
+        import lib.transfer
+        starttime = time.monotonic()
+        size = lib.transfer.upload(local_file, remote_file, session, shell=shell, workers=session.get("workers", 8), progress=print_progress)
+        print("Uploaded {} bytes in {:.2f}s".format(size, time.monotonic() - starttime))
+
+class DownloadCmd(InteractiveCmd):
+    tag = "download"
+    description = "Download a file through the encoder chain"
+    help = """
+        Download a remote file through the encoder chain. The file is read in chunks which are
+        fetched in parallel and verified with per chunk hashes. Re-running an interrupted
+        download resumes it. The remote shell is detected from the encoder chain unless
+        specified.
+            $download <remote_file> <local_file> [posix|cmd|powershell]
+    """
+
+    @classmethod
+    def run(cls, args, session):
+        remote_file, local_file, shell = parse_transfer_args(cls.tag, args)
+        import lib.transfer
+        starttime = time.monotonic()
+        size = lib.transfer.download(remote_file, local_file, session, shell=shell, workers=session.get("workers", 8), progress=print_progress)
+        print("Downloaded {} bytes in {:.2f}s".format(size, time.monotonic() - starttime))
+
+class SSHCloseCmd(InteractiveCmd):
+    tag = "ssh_close"
+    description = "Close persistent SSH connections"
+    help = """
+        Close the ControlMaster connections of any multiplexed SSH encoders in the encoders list.
+            $ssh_close
+    """
+
+    @classmethod
+    def run(cls, args, session):
+        close_encoders(session)
+
+class WmicWorkerCmd(InteractiveCmd):
+    tag = "wmic_worker"
+    description = "Start / stop persistent WMIC workers"
+    help = """
+        Start a long running worker loop on the remote system of each WMIC encoder in the encoders
+        list, which subsequent commands are passed to through files on the C$ share rather than a
+        new wmic process each. Workers are stopped on $quit and before the runner or encoders list
+        is changed.
+            $wmic_worker start
+            $wmic_worker stop
+            $wmic_worker status
+    """
+    tab_complete_options = ["start", "stop", "status"]
+
+    @classmethod
+    def run(cls, args, session):
+        args = args.split()
+        if len(args) != 1 or args[0] not in cls.tab_complete_options:
+            raise CmdRunnerException("Usage: $wmic_worker start|stop|status")
+        if args[0] == "stop":
+            cls.stop_workers(session)
+            return
+        # Running workers by name, kept outside the plan so they can be stopped once it is discarded
+        workers = session.setdefault("wmic_workers", {})
+        wmic_encoder = lib.registry.get_class("encoder", "WmicEncoder")
+        found = False
+        for target, _session in get_plan(session).fanout or [(None, session)]:
+            encoders = _session["encoders"]
+            for index, encoder in enumerate(encoders):
+                if not isinstance(encoder, wmic_encoder):
+                    continue
+                found = True
+                name = "[{}] {}".format(index, target or encoder.host or "localhost")
+                if args[0] == "status":
+                    print("{} {}".format(name, "running" if name in workers else "stopped"))
+                    continue
+                if name in workers or not encoder.output:
+                    continue
+                encoder.ready(index, encoders)
+                # The worker commands are run through the hops outside the WMIC encoder
+                hops = {**_session, "encoders" : encoders[:index], "decoders" : [], "plan" : None, "cache" : None, "history" : None}
+                execute(encoder.start_worker(), hops)
+                workers[name] = (encoder, hops)
+                print("[+] Started worker {}".format(name))
+        if not found:
+            raise CmdRunnerException("No WMIC encoders in the encoders list")
+
+    @classmethod
+    def stop_workers(cls, session):
+        """
+        Stop every worker started in the session, raising if one could not be stopped. A worker
+        which could not be stopped is kept, so stopping it can be retried.
+        """
+        workers = session.get("wmic_workers") or {}
+        for name, (encoder, hops) in list(workers.items()):
+            cmd = encoder.stop_worker()
+            if cmd is not None:
+                try:
+                    execute(cmd, hops)
+                except CmdRunnerException:
+                    raise
+                except Exception as e:
+                    # e.g. requests exceptions from the web runner, which the REPL does not catch
+                    raise CmdRunnerException("Unable to stop worker {}: {}".format(name, e))
+            encoder.clear_worker()
+            del workers[name]
+            print("[+] Stopped worker {}".format(name))
+
+class StatsCmd(InteractiveCmd):
+    tag = "stats"
+    description = "Show per stage timings of executed commands"
+    help = """
+        Record the time taken and output size of each encoder, the runner and each decoder for
+        every command, and show the p50 / p95 time and size amplification of each stage.
+            $stats                      Show the summary of the recorded commands
+            $stats on|off               Start / stop recording
+            $stats reset                Clear the recorded commands
+            $stats last                 Show the stages of the last command
+            $stats trace <file>|off     Append a JSON line per command to the file
+            $stats profile on|off       Capture a cProfile summary per command
+            $stats memory on|off        Capture the tracemalloc peak memory per command
+    """
+    tab_complete_options = ["on", "off", "reset", "last", "trace", "profile", "memory"]
+
+    @classmethod
+    def run(cls, args, session):
+        import lib.stats
+        args = args.split()
+        stats = session.get("stats")
+        if not len(args):
+            if stats is None:
+                raise CmdRunnerException("Stats are not being recorded, enable with $stats on")
+            print(stats.summary())
+        elif args == ["on"]:
+            session["stats"] = stats or lib.stats.Stats()
+        elif args == ["off"]:
+            if stats is not None:
+                stats.close()
+            session["stats"] = None
+        elif args[0] in ["reset", "last", "trace", "profile", "memory"]:
+            if stats is None:
+                stats = session["stats"] = lib.stats.Stats()
+            if args == ["reset"]:
+                stats.reset()
+            elif args == ["last"]:
+                cls.print_record(stats.records[-1] if len(stats.records) else None)
+            elif args[0] == "trace" and len(args) == 2:
+                try:
+                    stats.set_trace(None if args[1] == "off" else args[1])
+                except OSError as e:
+                    raise CmdRunnerException("Error opening trace file '{}': {}".format(args[1], e))
+            elif args[0] in ["profile", "memory"] and len(args) == 2 and args[1] in ["on", "off"]:
+                if args[0] == "profile":
+                    stats.profile = args[1] == "on"
+                else:
+                    stats.set_memory(args[1] == "on")
+            else:
+                raise CmdRunnerException("Invalid arguments '{}' for $stats".format(" ".join(args)))
+        else:
+            raise CmdRunnerException("Invalid arguments '{}' for $stats".format(" ".join(args)))
+
+    @classmethod
+    def print_record(cls, record):
+        import lib.stats
+        if record is None:
+            raise CmdRunnerException("No commands have been recorded")
+        print("Command: {}{}".format(record.cmd[:100], "..." if len(record.cmd) > 100 else ""))
+        for name, kind, seconds, size_in, size in record.stages:
+            print("\t{:40s} {:>10s} {:>12d} bytes".format(name, lib.stats.format_time(seconds), size))
+        print("\t{:40s} {:>10s}".format("Total", lib.stats.format_time(record.seconds)))
+        if record.error is not None:
+            print("Error: {}".format(record.error))
+        if record.memory_peak is not None:
+            print("Peak memory: {} bytes".format(record.memory_peak))
+        if record.profile is not None:
+            print("Profile:")
+            for x in record.profile:
+                print("\t{:>10s} {:>8d} {}".format(lib.stats.format_time(x["seconds"]), x["calls"], x["function"]))
+
+class CacheCmd(InteractiveCmd):
+    tag = "cache"
+    description = "Cache command results"
+    help = """
+        Cache the output of commands, keyed by the command and the runner, encoder and decoder
+        arguments, in an sqlite database which persists between sessions. Only enable this for
+        commands whose output does not change, such as whoami or ipconfig /all.
+            $cache                      Show the cache statistics and cached commands
+            $cache on [ttl] [path]      Cache results for ttl seconds (default 300)
+            $cache off                  Stop caching results
+            $cache ttl <seconds>        Set the time to live of new results
+            $cache size <bytes>         Set the maximum size of the cached output
+            $cache flush [text]         Remove all results, or those whose command contains text
+            $cache bypass <command>     Run the command without the cache and store the new result
+    """
+    tab_complete_options = ["on", "off", "ttl", "size", "flush", "bypass"]
+
+    @classmethod
+    def run(cls, args, session):
+        import lib.cache
+        action, args = (args.strip().split(" ", 1) + [""])[:2]
+        cache = session.get("cache")
+        if action == "on":
+            match = re.match("([0-9]+)?(?: *(.+))?$", args.strip())
+            if match is None:
+                raise CmdRunnerException("Invalid arguments '{}' for $cache on".format(args))
+            ttl, path = match.groups()
+            if cache is not None:
+                cache.close()
+            session["cache"] = lib.cache.ResultCache(path or lib.cache.DEFAULT_PATH, ttl=int(ttl or 300))
+            return
+        if action == "off":
+            if cache is not None:
+                cache.close()
+            session["cache"] = None
+            return
+        if cache is None:
+            raise CmdRunnerException("Results are not being cached, enable with $cache on")
+        if action == "":
+            print("Cache: {} (ttl {}s, max size {} bytes, {} hits, {} misses)".format(cache.path, cache.ttl, cache.max_size, cache.hits, cache.misses))
+            for cmd, size, expires, accessed in cache.entries():
+                print("\t{:>10d} bytes  expires in {:>5.0f}s  {}".format(size, expires, cmd[:100]))
+        elif action in ["ttl", "size"]:
+            try:
+                value = int(args.strip())
+            except ValueError:
+                raise CmdRunnerException("Invalid value '{}' for $cache {}".format(args, action))
+            if action == "ttl":
+                cache.ttl = value
+            else:
+                cache.max_size = value
+        elif action == "flush":
+            print("Removed {} cached results".format(cache.flush(args.strip() or None)))
+        elif action == "bypass":
+            if not len(args.strip()):
+                raise CmdRunnerException("$cache bypass requires <command> argument")
+            output = []
+            def _collect(chunks):
+                for chunk in chunks:
+                    output.append(chunk)
+                    yield chunk
+            for line in lib.utils.iter_lines(_collect(execute_stream(args, {**session, "cache" : None}))):
+                print("<<< {}".format(line), flush=True)
+            if is_cacheable(session):
+                cache.set(cache.get_key(args, session), args, "".join(output), session["runner"].exit_status)
+        else:
+            raise CmdRunnerException("Invalid arguments '{}' for $cache".format(action))
+
+class CompletionCmd(InteractiveCmd):
+    tag = "completion"
+    description = "Tab complete remote paths"
+    help = """
+        Tab complete the paths of commands from directory listings of the remote system, fetched in
+        the background through the current encoders and runner and cached for ttl seconds. Every
+        listing runs a command on the remote system, so this is off by default.
+            $completion                 Show the number of cached listings
+            $completion on [ttl]        Complete remote paths, caching listings for ttl seconds (default 30)
+            $completion off             Stop completing remote paths
+            $completion flush           Remove all cached listings
+    """
+    tab_complete_options = ["on", "off", "flush"]
+
+    @classmethod
+    def run(cls, args, session):
+        import lib.completion
+        args = args.split()
+        completer = session.get("completion")
+        if len(args) and args[0] == "on":
+            try:
+                ttl = int(args[1]) if len(args) > 1 else 30
+            except ValueError:
+                raise CmdRunnerException("Invalid ttl '{}' for $completion on".format(args[1]))
+            session["completion"] = lib.completion.PathCompleter(session, ttl=ttl)
+        elif len(args) and args[0] == "off":
+            session["completion"] = None
+        elif completer is None:
+            raise CmdRunnerException("Remote paths are not being completed, enable with $completion on")
+        elif len(args) and args[0] == "flush":
+            completer.flush()
+        elif not len(args):
+            print("Completion: {} cached listings (ttl {}s)".format(len(completer._listings), completer.ttl))
+        else:
+            raise CmdRunnerException("Invalid arguments '{}' for $completion".format(" ".join(args)))
+
+class HistoryCmd(InteractiveCmd):
+    tag = "history"
+    description = "Search and replay the output of past commands"
+    help = """
+        Search the archive of past commands and their output, and show stored output without
+        re-running the command. Archiving is off unless started with --history or $history on, as
+        encoded commands can contain credentials (e.g. WMIC passwords). The archive is only readable
+        by its owner.
+            $history [count]            List the most recent commands (default 20)
+            $history search <text>      List commands whose command or output contains the text
+            $history show <id>          Show the stored output of a command
+            $history encoded <id>       Show the encoded command sent to the runner
+            $history on [path]|off      Start / stop archiving commands
+    """
+    tab_complete_options = ["search", "show", "encoded", "on", "off"]
+
+    @classmethod
+    def run(cls, args, session):
+        import sqlite3
+        import lib.history
+        action, args = (args.strip().split(" ", 1) + [""])[:2]
+        history = session.get("history")
+        if action == "on":
+            if history is not None:
+                history.close()
+            try:
+                session["history"] = lib.history.History(args.strip() or lib.history.DEFAULT_PATH)
+            except (OSError, sqlite3.Error) as e:
+                session["history"] = None
+                raise CmdRunnerException("Unable to open history '{}': {}".format(args.strip() or lib.history.DEFAULT_PATH, e))
+            return
+        if action == "off":
+            if history is not None:
+                history.close()
+            session["history"] = None
+            return
+        if history is None:
+            raise CmdRunnerException("Commands are not being archived, enable with $history on")
+        if action == "" or action.isdigit():
+            cls.print_records(history.recent(int(action or 20)))
+        elif action == "search":
+            if not len(args.strip()):
+                raise CmdRunnerException("$history search requires <text> argument")
+            starttime = time.monotonic()
+            records = history.search(args.strip())
+            cls.print_records(records)
+            print("{} results in {:.2f}ms".format(len(records), (time.monotonic() - starttime) * 1000))
+        elif action in ["show", "encoded"]:
+            try:
+                record = history.get(int(args.strip()))
+            except ValueError:
+                raise CmdRunnerException("Invalid id '{}'".format(args))
+            if record is None:
+                raise CmdRunnerException("Unknown id '{}'".format(args))
+            print(">>> {}".format(record["cmd"]))
+            if action == "encoded":
+                print(record["encoded"])
+            else:
+                for line in record["output"].splitlines():
+                    print("<<< {}".format(line))
+        else:
+            raise CmdRunnerException("Invalid arguments '{}' for $history".format(action))
+
+    @classmethod
+    def print_records(cls, records):
+        for record_id, _time, cmd, size in records[::-1]:
+            print("[{}] {} ({} bytes) {}".format(record_id, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(_time)), size, cmd[:100]))
+
+class LastOutputCmd(InteractiveCmd):
+    tag = "last_output"
+    description = "Save or page through the output of the last command"
+    help = """
+        The output of the last command is kept until the next command is run, in memory or spilled
+        to a temporary file once it is large. Long outputs can be displayed truncated to their first
+        or last lines, with the full output still available here.
+            $last_output                Show the size of the last output
+            $last_output save <file>    Write the last output to the file
+            $last_output head [lines]   Show the first lines of the last output (default 20)
+            $last_output tail [lines]   Show the last lines of the last output (default 20)
+            $last_output display all    Display the whole output of each command (default)
+            $last_output display head|tail <lines>
+                                        Only display the first / last lines of each command's output
+    """
+    tab_complete_options = ["save", "head", "tail", "display"]
+    # Lines longer than this are displayed in pieces, rather than buffered until they end
+    max_line_length = 65536
+
+    @classmethod
+    def run(cls, args, session):
+        action, args = (args.strip().split(" ", 1) + [""])[:2]
+        args = args.strip()
+        if action == "display":
+            match = re.match("(all)$|(head|tail) +([0-9]+)$", args)
+            if match is None:
+                raise CmdRunnerException("Usage: $last_output display all|head <lines>|tail <lines>")
+            session["display"] = ("all", None) if match.group(1) else (match.group(2), int(match.group(3)))
+            return
+        last_output = session.get("last_output")
+        if last_output is None:
+            raise CmdRunnerException("No command output to show")
+        if action == "":
+            print("Last output: {} characters{}".format(len(last_output), " (spilled to disk)" if last_output.spilled else ""))
+        elif action == "save":
+            if not len(args):
+                raise CmdRunnerException("$last_output save requires <file> argument")
+            try:
+                last_output.save(args)
+            except OSError as e:
+                raise CmdRunnerException("Error saving output to '{}': {}".format(args, e))
+            print("[+] Saved {} characters to {}".format(len(last_output), args))
+        elif action in ["head", "tail"]:
+            try:
+                count = int(args or 20)
+            except ValueError:
+                raise CmdRunnerException("Invalid number of lines '{}'".format(args))
+            output = last_output.head(count) if action == "head" else last_output.tail(count)
+            for line in output.splitlines():
+                print("<<< {}".format(line))
+        else:
+            raise CmdRunnerException("Invalid arguments '{}' for $last_output".format(action))
+
+    @classmethod
+    def print_output(cls, chunks, session, output=None):
+        """
+        Print the output of a command as it is received according to the display policy, keeping
+        it as the last output. If output is given the chunks are already held in it.
+        """
+        last_output = session.get("last_output")
+        if last_output is not None:
+            last_output.close()
+        if output is None:
+            last_output = lib.buffer.OutputBuffer()
+            chunks = last_output.tee(chunks)
+        else:
+            last_output = output
+        session["last_output"] = last_output
+        policy, count = session.get("display") or ("all", None)
+        total = 0
+        for line in lib.utils.iter_lines(chunks, max_length=cls.max_line_length):
+            if policy == "all" or (policy == "head" and total < count):
+                print("<<< {}".format(line), flush=True)
+            total += 1
+        if policy == "head" and total > count:
+            print("[... {} more lines, see $last_output ...]".format(total - count))
+        elif policy == "tail":
+            if total > count:
+                print("[... {} earlier lines, see $last_output ...]".format(total - count))
+            for line in last_output.tail(count).splitlines():
+                print("<<< {}".format(line))
+
+def get_job_id(args):
+    if not len(args.strip()):
+        return None
+    try:
+        return int(args.strip().lstrip("%"))
+    except ValueError:
+        raise CmdRunnerException("Invalid job id '{}'".format(args.strip()))
+
+def print_job(job):
+    status = job.status if job.error is None else "{}: {}".format(job.status, job.error)
+    print("[{}] {:8s} {:8.2f}s {:>10d} chars  ({}) {}".format(job.id, status, job.elapsed, len(job.output), job.name, job.cmd[:100]))
+
+class JobsCmd(InteractiveCmd):
+    tag = "jobs"
+    description = "List background jobs"
+    help = """
+        List the commands run in the background by ending them with " &", e.g. ">>> sleep 10; id &".
+        Jobs run concurrently on up to --workers threads (see $set_workers), each through the
+        encoders and runner of the session it was started from, and their output is kept until
+        brought back with $fg. A PersistentBashRunner has a single shell, so its jobs and commands
+        take turns to use it. To send a trailing & to the remote shell instead, e.g. to start a
+        process in the background there, end the command with \\&, which is replaced with &:
+            >>> nohup ./server >/dev/null 2>&1 \\&
+            $jobs                       List the jobs, their status and output size
+    """
+
+    @classmethod
+    def run(cls, args, session):
+        jobs = session["jobs"].jobs
+        if not len(jobs):
+            print("No jobs")
+        for job in list(jobs.values()):
+            print_job(job)
+
+class FgCmd(InteractiveCmd):
+    tag = "fg"
+    description = "Wait for a background job and show its output"
+    help = """
+        Wait for a background job to finish, then display its output as if it had been run in the
+        foreground and keep it as the last output. Ctrl-C stops waiting, leaving the job running.
+            $fg [id]                    Wait for the job (default the most recent one)
+    """
+
+    @classmethod
+    def run(cls, args, session):
+        jobs = session["jobs"]
+        job = jobs.get(get_job_id(args))
+        try:
+            while not job.wait(0.1):
+                pass
+        except KeyboardInterrupt:
+            print()
+            print("[{}] Still running in the background".format(job.id))
+            return
+        jobs.remove(job.id)
+        job.notified = True
+        print(">>> {}".format(job.cmd))
+        LastOutputCmd.print_output(job.output.iter_chunks(), session, output=job.output)
+        if job.error is not None:
+            raise CmdRunnerException(job.error)
+        if job.status == "killed":
+            print("[{}] Killed".format(job.id))
+
+class KillCmd(InteractiveCmd):
+    tag = "kill"
+    description = "Stop a background job"
+    help = """
+        Stop a background job. A queued job never starts, and a running one has its command's process
+        killed (or with PersistentBashRunner interrupted, keeping the shell). The output so far is
+        kept for $fg.
+            $kill <id>                  Stop the job
+    """
+
+    @classmethod
+    def run(cls, args, session):
+        job_id = get_job_id(args)
+        if job_id is None:
+            raise CmdRunnerException("$kill requires <id> argument")
+        job = session["jobs"].get(job_id)
+        if job.finished:
+            raise CmdRunnerException("Job {} has already finished".format(job_id))
+        session["jobs"].kill(job_id)
+        print("[{}] Killing {}".format(job.id, job.cmd[:100]))
+
+class SessionCmd(InteractiveCmd):
+    tag = "session"
+    description = "Create and switch between named sessions"
+    help = """
+        Keep several sessions, each with its own runner, encoders and decoders, and switch between
+        them. Commands run in the current session, and background jobs keep running in the session
+        they were started from. Workers, history, caching and the display policy are shared.
+            $session                    Show the name of the current session
+            $session list               List the sessions and their runner and encoders
+            $session new <name> [file]  Create a session with the bash runner, or loaded from a saved session file
+            $session switch <name>      Make the session current
+    """
+    tab_complete_options = ["list", "new", "switch"]
+
+    @classmethod
+    def run(cls, args, session):
+        action, args = (args.strip().split(" ", 1) + [""])[:2]
+        sessions = session["sessions"]
+        if action == "":
+            print(sessions.current)
+        elif action == "list":
+            for name, _session in sessions.sessions.items():
+                running = len([x for x in session["jobs"].jobs.values() if x.session is _session and not x.finished])
+                print("{} {:16s} {} {}{}".format(
+                    "*" if name == sessions.current else " ", name, _session["runner"].__class__.__name__,
+                    " ".join(x.__class__.__name__ for x in _session["encoders"]),
+                    "  ({} running jobs)".format(running) if running else ""))
+        elif action == "new":
+            match = re.match("([A-Za-z0-9_.-]+)(?: +(.+))?$", args.strip())
+            if match is None:
+                raise CmdRunnerException("Usage: $session new <name> [file]")
+            name, session_file = match.groups()
+            if name in sessions.sessions:
+                raise CmdRunnerException("Session '{}' already exists".format(name))
+            state = {}
+            if session_file is not None:
+                LoadSessionCmd.run(session_file, state, quiet=True)
+            else:
+                state = {"runner" : lib.registry.get_class("runner", "BashRunner")(), "encoders" : [], "decoders" : []}
+            sessions.add(name, state)
+            sessions.switch(name)
+        elif action == "switch":
+            sessions.switch(args.strip())
+        else:
+            raise CmdRunnerException("Invalid arguments '{}' for $session".format(action))
 
 class QuitCmd(InteractiveCmd):
     tag = "quit"
@@ -306,12 +974,24 @@ class QuitCmd(InteractiveCmd):
     @classmethod
     def run(cls, args, session):
         print("Quitting...")
+        # Background jobs run on daemon threads and end with the process
+        sessions = session["sessions"].sessions.values() if "sessions" in session else [session]
+        for _session in sessions:
+            try:
+                # Workers are stopped through the outer hops, before those are closed
+                WmicWorkerCmd.stop_workers(_session)
+            except Exception as e:
+                print("[!] Error stopping WMIC workers: {}".format(e))
+            try:
+                close_encoders(_session)
+            except Exception as e:
+                print("[!] Error closing encoders: {}".format(e))
         sys.exit(0)
 
 # This class needs to be last due to the way it fills in it's tab_complete_options
 class HelpCmd(InteractiveCmd):
     tag = "help"
-    tab_complete_options = [x.tag for x in InteractiveCmd.get_subclasses() if x.tag != "help"] + ["runner", "encoder", "decoder"]
+    tab_complete_options = [x.tag for x in InteractiveCmd.get_commands()] + ["runner", "encoder", "decoder"]
 
     @classmethod
     def run(cls, args, session):
@@ -319,17 +999,13 @@ class HelpCmd(InteractiveCmd):
         if len(cmd):
             cmd = cmd.lstrip("$").split(" ")
             if cmd[0] in ["runner", "encoder", "decoder"]:
-                available_runners = {x.__name__.lower() : x for x in CmdRunner.get_subclasses()}
-                available_encoders = {x.__name__.lower() : x for x in CmdEncoder.get_subclasses()}
-                available_decoders = {x.__name__.lower() : x for x in CmdDecoder.get_subclasses()}
-
                 cls = None
-                list_cmd, available_clsses = {"runner" : (ListRunnersCmd, available_runners), "encoder" : (ListEncodersCmd, available_encoders), "decoder" : (ListDecodersCmd, available_decoders)}[cmd[0]]
+                list_cmd = {"runner" : ListRunnersCmd, "encoder" : ListEncodersCmd, "decoder" : ListDecodersCmd}[cmd[0]]
                 if len(cmd) == 1:
                     list_cmd.run(None, session)
                     print("\nFor help on an individual {} use:\n\t$help {} <name>".format(cmd[0], cmd[0]))
                 else:
-                    cls = available_clsses.get(cmd[1].lower(), available_clsses.get(cmd[1].lower() + cmd[0]))
+                    cls = lib.registry.find_class(cmd[0], cmd[1])
                     if cls is None:
                         raise CmdRunnerException("Unknown {} '{}''".format(cmd[0], cmd[1]))
                     print(cls.get_help())
@@ -344,7 +1020,7 @@ class HelpCmd(InteractiveCmd):
                     print(str(e))
             return
         print("Available commands:")
-        for icmd in sorted(InteractiveCmd.get_subclasses(), key=lambda x: x.__name__):
+        for icmd in sorted(InteractiveCmd.get_commands(), key=lambda x: x.__name__):
             if icmd == cls:
                 continue
             print("\t${:20s} {}".format(icmd.tag, icmd.description))
@@ -355,29 +1031,71 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="cmdrunner")
     parser.add_argument("--session", "-s", type=str, default=None)
     parser.add_argument("--quiet", "-q", action="store_true", default=False)
+    parser.add_argument("--batch", "-b", type=str, default=None, help="Run each command in the given file concurrently")
+    parser.add_argument("--workers", "-w", type=int, default=8, help="Number of concurrent commands for --batch and fan-out")
+    parser.add_argument("--output", "-o", type=str, default=None, help="File to write --batch results to")
+    parser.add_argument("--cache", "-c", type=int, default=None, metavar="TTL", help="Cache command results for TTL seconds")
+    parser.add_argument("--history", action="store_true", default=False, help="Archive commands and their output, see $help history")
+    parser.add_argument("--trace", "-t", type=str, default=None, help="File to append per stage timings of each command to as JSON lines")
     parser.add_argument('cmd', default=[], nargs=argparse.REMAINDER)
     args = parser.parse_args()
+    # Write any binary output preserved by the runners as the original bytes
+    sys.stdout.reconfigure(errors="surrogateescape")
 
     session = {}
     if args.session is not None:
         LoadSessionCmd.run(args.session, session, quiet=args.quiet)
     else:
         session = {
-            "runner" : bash.BashRunner(),
+            "runner" : lib.registry.get_class("runner", "BashRunner")(),
             "encoders" : [],
             "decoders" : [],
         }
         ListRunnersCmd.run(None, session)
         ListEncodersCmd.run(None, session)
+    session["workers"] = args.workers
+    if args.history:
+        import sqlite3
+        import lib.history
+        try:
+            session["history"] = lib.history.History()
+        except (OSError, sqlite3.Error) as e:
+            print("[!] Unable to open history '{}', commands will not be archived: {}".format(lib.history.DEFAULT_PATH, e))
+    if args.cache is not None:
+        import lib.cache
+        session["cache"] = lib.cache.ResultCache(ttl=args.cache)
+    if args.trace is not None:
+        import lib.stats
+        session["stats"] = lib.stats.Stats(trace_path=args.trace)
 
-    if len(args.cmd):
-        print(execute(" ".join(args.cmd), session))
+    if args.batch is not None:
+        try:
+            BatchCmd.run(args.batch, session, output_file=args.output)
+        except CmdRunnerException as e:
+            print(e)
+            sys.exit(1)
+    elif len(args.cmd):
+        for chunk in execute_stream(" ".join(args.cmd), session):
+            sys.stdout.write(chunk)
+            sys.stdout.flush()
+        print()
     else:
         readline.parse_and_bind("tab: complete")
-        readline.set_completer(InteractiveCmd.completer)
+        # Keep path separators within the completed text so remote paths complete as a whole
+        readline.set_completer_delims(" \t\n\"'`$;|&<>=")
+        # Sessions created with $session share the settings of this one and the job pool
+        import lib.jobs
+        import lib.sessions
+        sessions = lib.sessions.Sessions()
+        session = sessions.add("default", session)
+        session["jobs"] = lib.jobs.JobManager(args.workers)
+        readline.set_completer(lambda text, state: InteractiveCmd.completer(text, state, sessions.get()))
         while True:
             try:
-                cmd = input(">>> ").strip()
+                session = sessions.get()
+                for job in session["jobs"].get_finished():
+                    print("[{}] {} {}".format(job.id, job.status.capitalize(), job.cmd[:100]))
+                cmd = input(">>> " if sessions.current == "default" else "{} >>> ".format(sessions.current)).strip()
                 # Ignore empty commands
                 if len(cmd) == 0:
                     continue
@@ -397,9 +1115,14 @@ if __name__ == "__main__":
                     cmd, args = (cmd.lstrip("$").split(" ", 1) + [""])[:2]
                     cls = InteractiveCmd.get_command(cmd)
                     cls.run(args, session)
+                elif cmd.endswith("\\&"):
+                    # An escaped trailing & is left for the remote shell
+                    LastOutputCmd.print_output(execute_stream(cmd[:-2] + "&", session), session)
+                elif re.search("[^&]&$", cmd):
+                    job = session["jobs"].submit(cmd[:-1].rstrip(), session, sessions.current)
+                    print("[{}] {}".format(job.id, job.cmd[:100]))
                 else:
-                    output = execute(cmd, session)
-                    print("\n".join("<<< {}".format(x) for x in output.splitlines()))
+                    LastOutputCmd.print_output(execute_stream(cmd, session), session)
             except KeyboardInterrupt:
                 print()
             except CmdRunnerException as e:
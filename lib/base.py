@@ -1,8 +1,79 @@
+import contextlib
+import contextvars
+import hashlib
+import json
 import readline
+import threading
+import time
+import uuid
+
+import lib.buffer
+import lib.escape
+import lib.utils
 
 class CmdRunnerException(Exception):
     pass
 
+# Exit status of the last command run in the current thread or asyncio task, if known
+_exit_status = contextvars.ContextVar("exit_status", default=None)
+# CancelScope the commands run in the current thread or asyncio task belong to, if any
+_cancel_scope = contextvars.ContextVar("cancel_scope", default=None)
+
+class CancelScope:
+    """
+    Allows the commands run within the scope to be cancelled from another thread. Runners register
+    how to stop a running command (e.g. by signalling its process) with on_cancel().
+    """
+    def __init__(self):
+        self.cancelled = False
+        # Whether a command was running with a way to cancel it when the scope was cancelled
+        self.stopped = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._token = _cancel_scope.set(self)
+        return self
+
+    def __exit__(self, *args):
+        _cancel_scope.reset(self._token)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            callbacks = list(self._callbacks)
+            self.stopped = self.stopped or len(callbacks) > 0
+        for callback in callbacks:
+            callback()
+
+    def add(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+            cancelled = self.cancelled
+            self.stopped = self.stopped or cancelled
+        # Commands started after the scope was cancelled are stopped straight away
+        if cancelled:
+            callback()
+
+    def remove(self, callback):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+@contextlib.contextmanager
+def on_cancel(callback):
+    """
+    Call callback if the current CancelScope, if any, is cancelled while within the with block.
+    """
+    scope = _cancel_scope.get()
+    if scope is None:
+        yield
+        return
+    scope.add(callback)
+    try:
+        yield
+    finally:
+        scope.remove(callback)
+
 class CmdArgument:
     _index = 0
 
@@ -18,54 +89,58 @@ class CmdArgument:
         self._index = CmdArgument._index
         CmdArgument._index += 1
 
-class CmdBase:
+class CmdMeta(type):
+    """
+    Metaclass compiling the CmdArguments of each class into an argument schema when the class is
+    defined. Arguments are inherited from base classes, and their values are stored in __slots__
+    rather than a per instance __dict__.
+    """
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        arguments = sorted([(k, v) for k, v in namespace.items() if isinstance(v, CmdArgument)], key=lambda x: x[1]._index)
+        for k, _ in arguments:
+            del namespace[k]
+        namespace["__slots__"] = tuple(k for k, _ in arguments) + tuple(namespace.get("__slots__", ()))
+        cls = super().__new__(mcs, name, bases, namespace, **kwargs)
+
+        schema = {}
+        for base in bases[::-1]:
+            schema.update(getattr(base, "_arguments", {}))
+        schema.update(arguments)
+        cls._arguments = schema
+        cls._argument_names = tuple(schema)
+        cls._defaults = {k : v.default for k, v in schema.items() if v.default or not v.required}
+        return cls
+
+class CmdBase(metaclass=CmdMeta):
     def __init__(self, *args, **kwargs):
         """
         Permissive __init__ method to assign object attributes from vrious sources:
-          <args> matching the order of the <cls.args> attribute
+          <args> matching the order of the class arguments
           <kwargs> assigning each key, value pair as attributes
-          <cls.default_args> assign each unset key, value pair as default attributes
+          <cls._defaults> assign each unset key, value pair as default attributes
         """
-        def set_argument(name, arg, value):
-            if value != arg.default:
-                if not isinstance(value, arg.arg_type):
-                    raise TypeError("Incorrect argument type for argument '{}', expecting '{}' receivied '{}'".format(name, arg.arg_type.__name__, type(value).__name__))
-            setattr(self, name, value)
-
-        cmd_arguments = {k : v for k, v in self.__class__.__dict__.items() if isinstance(v, CmdArgument)}
-        sorted_arguments = sorted(cmd_arguments.keys(), key=lambda x: cmd_arguments[x]._index)
-        required_arguments = [k for k in cmd_arguments.keys() if cmd_arguments[k].required]
-
-        # Assign arguments based on the class args variable
-        for index, arg in enumerate(sorted_arguments):
-            if index >= len(args):
-                break
-            set_argument(arg, cmd_arguments[arg], args[index])
-
-        # Assign all kwargs
+        arguments = self._arguments
+        if len(args) > len(arguments):
+            raise TypeError("Constructor takes {} positional arguments but {} were given".format(len(arguments), len(args)))
+        values = dict(zip(self._argument_names, args))
         for k, v in kwargs.items():
-            if k in cmd_arguments:
-                if not isinstance(getattr(self, k), CmdArgument):
-                    raise TypeError("Argument repeated '{}' value '{}'".format(k, getattr(self, k)))
-                set_argument(k, cmd_arguments[k], v)
-
-        # Assign all default values
-        for k, v in cmd_arguments.items():
-            if v.default or not v.required:
-                if isinstance(getattr(self, k), CmdArgument):
-                    set_argument(k, v, v.default)
-
-        # Check all required arguments exist
-        for arg in required_arguments:
-            if isinstance(getattr(self, arg), CmdArgument):
-                raise TypeError("Missing required argument '{}'".format(arg))
-
-        # Check no unnecessary arguments were provided
-        if len(args) > len(cmd_arguments):
-            raise TypeError("Constructor takes {} positional arguments but {} were given".format(len(cmd_arguments), len(args)))
-        for x in kwargs.keys():
-            if not x in sorted_arguments:
-                raise TypeError("Constructor got an unexpected keyword argument '{}'".format(x))
+            if k not in arguments:
+                raise TypeError("Constructor got an unexpected keyword argument '{}'".format(k))
+            if k in values:
+                raise TypeError("Argument repeated '{}' value '{}'".format(k, values[k]))
+            values[k] = v
+
+        defaults = self._defaults
+        for k, arg in arguments.items():
+            if k in values:
+                value = values[k]
+                if value != arg.default and not isinstance(value, arg.arg_type):
+                    raise TypeError("Incorrect argument type for argument '{}', expecting '{}' receivied '{}'".format(k, arg.arg_type.__name__, type(value).__name__))
+            elif k in defaults:
+                value = defaults[k]
+            else:
+                raise TypeError("Missing required argument '{}'".format(k))
+            setattr(self, k, value)
 
     @classmethod
     def get_subclasses(cls):
@@ -87,8 +162,7 @@ class CmdBase:
         reqcmdline = []
         optcmdline = []
         arg_help = ""
-        for arg_name in sorted([k for k, v in cls.__dict__.items() if isinstance(v, CmdArgument)], key=lambda x: cls.__dict__[x]._index):
-            arg = getattr(cls, arg_name)
+        for arg_name, arg in cls._arguments.items():
             if arg.required:
                 reqcmdline.append("<{}>".format(arg_name))
             else:
@@ -99,13 +173,13 @@ class CmdBase:
 
     def get_instance(self):
         output = [self.__class__.__name__]
-        for arg in sorted([k for k, v in self.__class__.__dict__.items() if isinstance(v, CmdArgument)], key=lambda x: self.__class__.__dict__[x]._index):
+        for arg in self._argument_names:
             output.append("\t{}: {}".format(arg, str(getattr(self, arg))))
         return "\n".join(output)
 
     def save(self):
         output = {"__classname__" : self.__class__.__name__}
-        for arg in [x for x in self.__class__.__dict__.keys() if isinstance(self.__class__.__dict__[x], CmdArgument)]:
+        for arg in self._argument_names:
             output[arg] = getattr(self, arg)
         return output
 
@@ -116,13 +190,75 @@ class CmdBase:
         return cls(**_args)
 
 class CmdRunner(CmdBase):
+    # Shell the command is run in ("posix", "cmd" or "powershell"), if known
+    shell = None
+    # Maximum length of the command accepted by the runner, if limited
+    max_length = None
+
+    @property
+    def exit_status(self):
+        """
+        Exit status of the last command run in the current thread or asyncio task, or None if the
+        runner does not report one.
+        """
+        return _exit_status.get()
+
+    @exit_status.setter
+    def exit_status(self, value):
+        _exit_status.set(value)
+
     def encode(self, cmd):
         return cmd
 
+    def run_stream(self, cmd):
+        """
+        Generator yielding the command output in chunks as it becomes available. Runners which can
+        produce output incrementally should override this, by default the output of run() is yielded
+        as a single chunk.
+        """
+        yield self.run(cmd)
+
+    async def run_async(self, cmd):
+        """
+        Coroutine returning the command output. Runners which can wait on the command without
+        blocking should override this, by default run() is called in the event loop's executor.
+        """
+        import asyncio
+        # Run in a copy of the context to bring back the exit status set in the executor's thread
+        context = contextvars.copy_context()
+        output = await asyncio.get_running_loop().run_in_executor(None, context.run, self.run, cmd)
+        self.exit_status = context.get(_exit_status)
+        return output
+
+    async def aclose(self):
+        """
+        Release any resources held for the running event loop, awaited by the owner of the loop
+        before it is closed.
+        """
+        pass
+
 class CmdEncoder(CmdBase):
     help = """
     Basic command encoder.
     """
+    # Name of an argument which may specify multiple targets to fan the command out to
+    fanout_argument = None
+    # Shell the command passed to encode() is run in ("posix", "cmd" or "powershell"), if known
+    shell = None
+    # Maximum length of the command passed to encode(), if limited
+    max_length = None
+    # Template safe encoders always wrap the output of escape() in the same fixed text, which allows
+    # their output to be precomputed as a template when the encoder chain is compiled
+    template_safe = False
+    # lib.escape.Escaper implementing escape(), which allows the escaping of consecutive template
+    # safe encoders to be composed into a single pass
+    escaper = None
+    # How a template safe encoder which implements wrap() carries the command, "escape", "base64"
+    # or "auto" to use base64 whenever it is shorter than escaping the command
+    transport = "escape"
+    # Characters either escape() or wrap() does not carry through exactly, "auto" never uses base64
+    # for commands containing them so that both forms run the same command
+    inexact_characters = ""
 
     def encode(self, cmd):
         """
@@ -130,9 +266,39 @@ class CmdEncoder(CmdBase):
         """
         return cmd
 
+    def escape(self, cmd):
+        """
+        Escape the command for embedding in the encoder's template, must be applied character by
+        character and leave alphanumeric characters unchanged. Only used when template_safe is set.
+        """
+        if self.escaper is not None:
+            return self.escaper(cmd)
+        return cmd
+
+    def wrap(self, cmd):
+        """
+        Return a command which runs the command from its base64 encoding, only used when transport
+        is set. The result must not depend on the command other than through the base64 text.
+        """
+        raise NotImplementedError()
+
+    def can_transport(self, cmd):
+        """
+        Return whether wrap() runs exactly the same command as escape(), which "auto" requires
+        before carrying the command base64 encoded.
+        """
+        return not any(x in cmd for x in self.inexact_characters)
+
     def ready(self, index, encoders):
         pass
 
+    def close(self):
+        """
+        Return a command which releases any persistent resources (e.g. connections) held by this
+        encoder, run through the encoders preceding it in the chain, or None.
+        """
+        return None
+
 class CmdDecoder(CmdBase):
     def decode(self, cmd):
         """
@@ -140,60 +306,467 @@ class CmdDecoder(CmdBase):
         """
         return cmd
 
+    def decode_stream(self, chunks):
+        """
+        Generator decoding an iterable of output chunks. Decoders which can work incrementally should
+        override this and keep any partial state between chunks, by default the chunks are collected
+        and passed to decode() in one go.
+        """
+        yield self.decode("".join(chunks))
+
 class InteractiveCmd(CmdBase):
     tag = None
     description = "InteractiveCmd base class"
     tab_complete_options = []
 
+    # Commands by tag, and by every prefix of their tag, filled in as commands are defined
+    _commands = {}
+    _prefixes = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.tag is None:
+            return
+        InteractiveCmd._commands[cls.tag] = cls
+        for index in range(len(cls.tag) + 1):
+            InteractiveCmd._prefixes.setdefault(cls.tag[:index], []).append(cls)
+
+    @classmethod
+    def get_commands(cls):
+        return list(InteractiveCmd._commands.values())
+
     @classmethod
     def get_command(cls, cmd):
         cmd = cmd.lstrip("$")
-        clsses = cls.get_subclasses()
-        index = 1
-        while len(clsses) > 1:
-            if index > len(cmd):
-                raise CmdRunnerException("Ambiguous command '{}', did you mean {}".format(cmd, ", ".join("'{}'".format(x.tag) for x in clsses)))
-            for cls in list(clsses):
-                if not cls.tag.startswith(cmd[:index]):
-                    clsses.remove(cls)
-            index += 1
+        if cmd in InteractiveCmd._commands:
+            return InteractiveCmd._commands[cmd]
+        # Match on the shortest prefix of the command which identifies at most one command
+        for index in range(len(cmd) + 1):
+            clsses = InteractiveCmd._prefixes.get(cmd[:index], [])
+            if len(clsses) <= 1:
+                break
+        else:
+            raise CmdRunnerException("Ambiguous command '{}', did you mean {}".format(cmd, ", ".join("'{}'".format(x.tag) for x in clsses)))
         if len(clsses) == 0:
             raise CmdRunnerException("Unknown command '{}'".format(cmd))
-        return list(clsses)[0]
+        return clsses[0]
 
     @classmethod
     def parse_cmd(cls):
         pass
 
     @classmethod
-    def completer(cls, text, state):
+    def completer(cls, text, state, session=None):
         line = readline.get_line_buffer()
         if line.startswith("$"):
             parts = line.lstrip("$").split(" ")
-            subclsses = cls.get_subclasses()
-            options = []
             if len(parts) > 1:
-                for subcls in subclsses:
-                    if subcls.tag == parts[0]:
-                        options = subcls.tab_complete_options
-                        break
+                subcls = InteractiveCmd._commands.get(parts[0])
+                options = subcls.tab_complete_options if subcls is not None else []
                 if any(x in options for x in parts[1:]):
                     return None
             else:
-                options = ["{} ".format(x.tag) for x in subclsses]
+                options = ["{} ".format(x.tag) for x in InteractiveCmd._prefixes.get(text.lower(), [])]
             try:
                 return [x for x in options if x.lower().startswith(text.lower())][state]
             except IndexError:
                 pass
+            return None
+        # Remote paths, for the arguments of a command or anything that looks like a path
+        completer = session.get("completion") if session is not None else None
+        if completer is not None and (len(line[:readline.get_begidx()].strip()) or "/" in text or "\\" in text):
+            return completer.complete(text, state)
         return None
 
-def execute(cmd, session):
-    for index, encoder in enumerate(session["encoders"]):
-        encoder.ready(index, session["encoders"])
-    for encoder in session["encoders"][::-1]:
-        cmd = encoder.encode(cmd)
+class ExecutionPlan:
+    """
+    Encoder chain compiled once for a session. ready() is run for each encoder at compile time and
+    runs of consecutive template safe encoders are collapsed into a single prebuilt template.
+    """
+    def __init__(self, session):
+        self.key = ExecutionPlan.get_key(session)
+        self.fanout = get_fanout_sessions(session)
+        self.stages = []
+        # Name of each stage, from the chain indexes and classes of the encoders it applies
+        self.names = []
+        if self.fanout is not None:
+            return
+
+        encoders = session["encoders"]
+        for index, encoder in enumerate(encoders):
+            encoder.ready(index, encoders)
+        placeholder = "CMDRUNNER{}".format(uuid.uuid4().hex)
+        template = None
+        indexes = []
+        for index in range(len(encoders) - 1, -1, -1):
+            encoder = encoders[index]
+            if not encoder.template_safe or encoder.transport == "base64":
+                template = None
+                self.stages.append(encoder.encode)
+                indexes.append([index])
+                continue
+            if template is None:
+                template = [placeholder, [], [], []]
+                self.stages.append(template)
+                indexes.append([])
+            template[0] = encoder.encode(template[0])
+            template[1].append(encoder.escape)
+            template[2].append(encoder.escaper)
+            template[3].append(encoder)
+            indexes[-1].append(index)
+        for index, stage in enumerate(self.stages):
+            if callable(stage):
+                continue
+            escapes = stage[1]
+            escapers = stage[2]
+            if len(escapes) > 1 and None not in escapers:
+                escapes = [lib.escape.compose(escapers)]
+            self.stages[index] = (stage[0].split(placeholder), escapes, ExecutionPlan.get_transport(stage[3], escapers))
+        self.names = [ExecutionPlan.get_name(encoders, x) for x in indexes]
+
+    @staticmethod
+    def get_key(session):
+        return (id(session["runner"]), tuple(id(x) for x in session["encoders"]))
+
+    @staticmethod
+    def get_name(encoders, indexes):
+        names = [encoders[x].__class__.__name__ for x in sorted(indexes)]
+        if len(indexes) == 1:
+            return "[{}] {}".format(indexes[0], names[0])
+        if len(set(names)) == 1:
+            return "[{}-{}] {} x{}".format(min(indexes), max(indexes), names[0], len(names))
+        return "[{}-{}] {}".format(min(indexes), max(indexes), "+".join(names))
+
+    @staticmethod
+    def get_transport(encoders, escapers):
+        """
+        Return an (encoder, escaper, overhead) tuple for carrying the command of a template stage
+        base64 encoded, if the innermost encoder of the stage has transport set to "auto". The
+        escaper escapes for that encoder and the ones outside it, and overhead is the escaped length
+        of wrap() of an empty command.
+        """
+        if encoders[0].transport != "auto" or None in escapers:
+            return None
+        # Base64 text is alphanumeric apart from "+/=", which no escaper changes
+        escaper = lib.escape.compose(escapers)
+        return (encoders[0], escaper, len(escaper(encoders[0].wrap(""))))
+
+    @staticmethod
+    def transport(transport, cmd, escaped):
+        """
+        Return the escaped command, or the command carried base64 encoded if that is shorter and
+        the encoder can carry the command exactly.
+        """
+        encoder, escaper, overhead = transport
+        size = len(cmd) if cmd.isascii() else len(cmd.encode(errors="surrogateescape"))
+        if len(escaped) <= overhead + (size + 2) // 3 * 4:
+            return escaped
+        if not encoder.can_transport(cmd):
+            return escaped
+        return escaper(encoder.wrap(cmd))
+
+    @staticmethod
+    def apply(stage, cmd):
+        if callable(stage):
+            return stage(cmd)
+        parts, escapes, transport = stage
+        escaped = cmd
+        for escape in escapes:
+            escaped = escape(escaped)
+        # Commands escaping to less than the overhead of wrap() are never worth carrying as base64
+        if transport is not None and len(escaped) > transport[2]:
+            escaped = ExecutionPlan.transport(transport, cmd, escaped)
+        return escaped.join(parts)
+
+    def encode(self, cmd):
+        for stage in self.stages:
+            cmd = ExecutionPlan.apply(stage, cmd)
+        return cmd
+
+def get_plan(session):
+    """
+    Return the compiled ExecutionPlan for the session, compiling it if the encoder chain or runner
+    has changed since it was last compiled.
+    """
+    plan = session.get("plan")
+    if plan is None or plan.key != ExecutionPlan.get_key(session):
+        plan = ExecutionPlan(session)
+        session["plan"] = plan
+    return plan
+
+def invalidate_plan(session):
+    session.pop("plan", None)
+
+def get_fingerprint(session):
+    """
+    Return a hash of the saved arguments of the session's runner, encoders and decoders.
+    """
+    chain = [session["runner"].save(), [x.save() for x in session["encoders"]], [x.save() for x in session["decoders"]]]
+    return hashlib.sha256(json.dumps(chain, sort_keys=True).encode(errors="surrogateescape")).hexdigest()
+
+def get_fanout_sessions(session):
+    """
+    Expand any encoder fan-out arguments (e.g. a list of hosts) into a list of (target, session)
+    pairs, each with its own encoder instances. Returns None if the session does not fan out.
+    """
+    chains = [([], [])]
+    fanout = False
+    for encoder in session["encoders"]:
+        variants = [(None, encoder)]
+        if encoder.fanout_argument is not None:
+            value = getattr(encoder, encoder.fanout_argument)
+            try:
+                targets = lib.utils.expand_targets(value)
+            except lib.utils.ArgsException as e:
+                raise CmdRunnerException(str(e))
+            if targets != [value]:
+                fanout = True
+                variants = [(x, encoder.__class__.load({**encoder.save(), encoder.fanout_argument : x})) for x in targets]
+        chains = [(labels + ([label] if label is not None else []), encoders + [encoder]) for labels, encoders in chains for label, encoder in variants]
+    if not fanout:
+        return None
+    return [(" -> ".join(labels), {**session, "encoders" : encoders, "plan" : None}) for labels, encoders in chains]
+
+def get_status_error(session):
+    """
+    Return a CmdRunnerException for the last command run through the session if its runner reported
+    a non zero exit status, or None.
+    """
+    status = session["runner"].exit_status
+    if status:
+        return CmdRunnerException("exit status {}".format(status))
+    return None
+
+def is_cacheable(session):
+    """
+    Return whether the result of the last command run through the session may be cached, which it
+    may not if it was cancelled or exited with a non zero status (as timed out commands do). Runners
+    which do not report an exit status raise on failure instead, so their results are cached.
+    """
+    scope = _cancel_scope.get()
+    if scope is not None and scope.cancelled:
+        return False
+    return session["runner"].exit_status in (0, None)
+
+def _execute_concurrently(jobs, workers):
+    def _execute(job):
+        cmd, session = job
+        starttime = time.monotonic()
+        session["runner"].exit_status = None
+        output = lib.buffer.OutputBuffer()
+        try:
+            for chunk in execute_stream(cmd, session):
+                output.write(chunk)
+        except Exception as e:
+            output.close()
+            return None, e, time.monotonic() - starttime
+        return output, get_status_error(session), time.monotonic() - starttime
+
+    # Imported on first use to keep one-shot startup fast
+    import concurrent.futures
+    # Run each job in a copy of the caller's context, carrying over any CancelScope
+    contexts = [contextvars.copy_context() for _ in jobs]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(lambda job, context: context.run(_execute, job), jobs, contexts)
+
+def _format_fanout(sessions, results):
+    failed = []
+    for (target, _), (output, error, elapsed) in zip(sessions, results):
+        if error is not None:
+            failed.append(target)
+            yield "==> {} (failed: {}, {:.2f}s) <==\n".format(target, error, elapsed)
+        else:
+            yield "==> {} ({:.2f}s) <==\n".format(target, elapsed)
+        # Failed commands which ran are shown with their output, e.g. ssh's connection error
+        if output is not None:
+            yield from output.iter_chunks()
+            if len(output) and output.tail_chars(1) != "\n":
+                yield "\n"
+            output.close()
+    yield "Fan-out complete: {} targets, {} failed{}\n".format(len(sessions), len(failed), "".join("\n\t{}".format(x) for x in failed))
+
+def execute_fanout(cmd, sessions, workers=8):
+    """
+    Execute the command against each (target, session) pair from get_fanout_sessions concurrently,
+    yielding the output grouped per target followed by a failure summary.
+    """
+    yield from _format_fanout(sessions, _execute_concurrently([(cmd, x) for _, x in sessions], workers))
+
+def execute_stream(cmd, session):
+    plan = get_plan(session)
+    if plan.fanout is not None:
+        yield from execute_fanout(cmd, plan.fanout, session.get("workers", 8))
+        return
+    cache = session.get("cache")
+    history = session.get("history")
+    key = cache.get_key(cmd, session) if cache is not None else None
+    if key is not None:
+        result = cache.get(key)
+        if result is not None:
+            output, session["runner"].exit_status = result
+            if len(output):
+                yield output
+            return
+
+    record = session["stats"].start(cmd) if session.get("stats") is not None else None
+    output = lib.buffer.OutputBuffer() if cache is not None or history is not None else None
+    try:
+        encoded = _encode(cmd, session, plan, record)
+        for chunk in _run_stream(encoded, session, record):
+            if len(chunk):
+                if output is not None:
+                    output.write(chunk)
+                yield chunk
+    except Exception as e:
+        if record is not None:
+            record.error = str(e) or e.__class__.__name__
+        raise
+    finally:
+        if record is not None:
+            session["stats"].finish(record)
+
+    # Only reached once the command has completed and its output been fully read
+    if output is not None:
+        if cache is not None and len(output) <= cache.max_size and is_cacheable(session):
+            cache.set(key, cmd, output.getvalue(), session["runner"].exit_status)
+        if history is not None:
+            history.add(cmd, encoded, session, output.getvalue(history.max_output))
+        output.close()
+
+def _encode(cmd, session, plan, record=None):
+    """
+    Encode the command through the plan and runner, recording the time taken and encoded size of
+    each stage if a stats record is given.
+    """
+    if record is None:
+        return session["runner"].encode(plan.encode(cmd))
+    for name, stage in zip(plan.names, plan.stages):
+        starttime = time.perf_counter()
+        cmd = ExecutionPlan.apply(stage, cmd)
+        record.add(name, "encode", time.perf_counter() - starttime, len(cmd))
+    starttime = time.perf_counter()
     cmd = session["runner"].encode(cmd)
-    output = session["runner"].run(cmd)
+    record.add("{}.encode".format(session["runner"].__class__.__name__), "encode", time.perf_counter() - starttime, len(cmd))
+    return cmd
+
+def _run_stream(cmd, session, record=None):
+    output = session["runner"].run_stream(cmd)
+    if record is not None:
+        output = record.timed(output, "{}.run".format(session["runner"].__class__.__name__), "run")
+    return _decode_stream(output, session, record)
+
+def _decode_stream(output, session, record=None):
     for decoder in session["decoders"][::-1]:
-        output = decoder.decode(output)
+        output = decoder.decode_stream(output)
+        if record is not None:
+            output = record.timed(output, decoder.__class__.__name__, "decode")
+    return output
+
+def execute(cmd, session):
+    """
+    Return the whole output of the command as a string, use execute_stream() for output which may
+    be large.
+    """
+    return "".join(execute_stream(cmd, session))
+
+def close_encoders(session):
+    """
+    Run the close command of each encoder in the session, innermost first so outer hops are still
+    available to reach the inner ones.
+    """
+    closed = set()
+    cmds = []
+    for _, _session in get_plan(session).fanout or [(None, session)]:
+        encoders = _session["encoders"]
+        for index in range(len(encoders) - 1, -1, -1):
+            cmd = encoders[index].close()
+            # Fanned out sessions share their outer hops, only close those once
+            key = repr([cmd] + [x.save() for x in encoders[:index]])
+            if cmd is not None and key not in closed:
+                closed.add(key)
+                cmds.append((index, cmd, _session))
+    # The shared outer hops are closed after the inner hops of every target
+    for index, cmd, _session in sorted(cmds, key=lambda x: -x[0]):
+        execute(cmd, {**_session, "encoders" : _session["encoders"][:index], "decoders" : [], "plan" : None, "cache" : None, "history" : None})
+
+def execute_batch(cmds, session, workers=8):
+    """
+    Execute multiple commands concurrently through the session on a bounded thread pool, yielding a
+    (cmd, output, error, elapsed) tuple for each command in input order. The output is an
+    OutputBuffer, so the results waiting to be yielded are spilled to disk once large, which the
+    caller should close. Commands which exit with a non zero status have both their output and an
+    error.
+    """
+    for cmd, result in zip(cmds, _execute_concurrently([(x, session) for x in cmds], workers)):
+        yield (cmd, *result)
+
+async def _execute_async_timed(cmd, session, semaphore):
+    async with semaphore:
+        starttime = time.monotonic()
+        session["runner"].exit_status = None
+        try:
+            output = lib.buffer.OutputBuffer()
+            output.write(await execute_async(cmd, session))
+        except Exception as e:
+            output.close()
+            return None, e, time.monotonic() - starttime
+        return output, get_status_error(session), time.monotonic() - starttime
+
+async def execute_async(cmd, session):
+    """
+    Coroutine equivalent of execute(), allowing many commands to be in flight on one event loop.
+    Runners may hold resources such as connection pools for the loop, the owner of the loop should
+    await session["runner"].aclose() before closing it.
+    """
+    import asyncio
+    plan = get_plan(session)
+    if plan.fanout is not None:
+        semaphore = asyncio.Semaphore(session.get("workers", 8))
+        results = await asyncio.gather(*[_execute_async_timed(cmd, x, semaphore) for _, x in plan.fanout])
+        return "".join(_format_fanout(plan.fanout, results))
+    cache = session.get("cache")
+    history = session.get("history")
+    key = cache.get_key(cmd, session) if cache is not None else None
+    if key is not None:
+        result = cache.get(key)
+        if result is not None:
+            output, session["runner"].exit_status = result
+            return output
+
+    record = session["stats"].start(cmd) if session.get("stats") is not None else None
+    try:
+        encoded = _encode(cmd, session, plan, record)
+        starttime = time.perf_counter()
+        output = await session["runner"].run_async(encoded)
+        if record is not None:
+            record.add("{}.run".format(session["runner"].__class__.__name__), "run", time.perf_counter() - starttime, len(output))
+        output = "".join(_decode_stream(iter([output]), session, record))
+    except Exception as e:
+        if record is not None:
+            record.error = str(e) or e.__class__.__name__
+        raise
+    finally:
+        if record is not None:
+            session["stats"].finish(record)
+
+    if cache is not None and len(output) <= cache.max_size and is_cacheable(session):
+        cache.set(key, cmd, output, session["runner"].exit_status)
+    if history is not None:
+        history.add(cmd, encoded, session, lib.buffer.truncate(output, history.max_output))
     return output
+
+async def execute_batch_async(cmds, session, workers=8):
+    """
+    Asynchronous generator equivalent of execute_batch(), running at most <workers> commands at once
+    on the current event loop. Each output is returned whole by the runner's run_async(), then kept
+    in an OutputBuffer until it is yielded.
+    """
+    import asyncio
+    semaphore = asyncio.Semaphore(workers)
+    tasks = [asyncio.ensure_future(_execute_async_timed(x, session, semaphore)) for x in cmds]
+    try:
+        for cmd, task in zip(cmds, tasks):
+            yield (cmd, *await task)
+    finally:
+        for task in tasks:
+            task.cancel()
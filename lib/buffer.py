@@ -0,0 +1,161 @@
+import codecs
+import mmap
+
+TRUNCATED = "\n[... {} characters truncated ...]\n"
+
+class OutputBuffer:
+    """
+    Command output kept in memory until it exceeds <threshold> characters, after which it is spilled
+    to a temporary file (UTF-8, with surrogate escapes preserved) and read back through mmap, so
+    large outputs can be saved, truncated or streamed without holding them in memory.
+    """
+    def __init__(self, threshold=8388608, directory=None):
+        self.threshold = threshold
+        self.directory = directory
+        self.size = 0
+        self._chunks = []
+        self._file = None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self._file is not None:
+            self._file.write(chunk.encode(errors="surrogateescape"))
+            return
+        self._chunks.append(chunk)
+        if self.size > self.threshold:
+            # Imported on first use to keep one-shot startup fast
+            import tempfile
+            self._file = tempfile.TemporaryFile(dir=self.directory)
+            for chunk in self._chunks:
+                self._file.write(chunk.encode(errors="surrogateescape"))
+            self._chunks = []
+
+    def tee(self, chunks):
+        """
+        Write each chunk to the buffer as it is yielded.
+        """
+        for chunk in chunks:
+            self.write(chunk)
+            yield chunk
+
+    def _mmap(self):
+        self._file.flush()
+        if self._file.tell() == 0:
+            return None
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def iter_chunks(self, chunk_size=1048576):
+        if self._file is None:
+            yield from self._chunks
+            return
+        data = self._mmap()
+        if data is None:
+            return
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="surrogateescape")
+        with data:
+            for offset in range(0, len(data), chunk_size):
+                yield decoder.decode(data[offset:offset + chunk_size])
+        yield decoder.decode(b"", final=True)
+
+    def getvalue(self, limit=None):
+        """
+        Return the output, or if it is longer than limit its first and last limit / 2 characters
+        around a truncation marker.
+        """
+        if limit is None or self.size <= limit:
+            return "".join(self.iter_chunks())
+        return self.head_chars(limit // 2) + TRUNCATED.format(self.size - limit // 2 * 2) + self.tail_chars(limit // 2)
+
+    def head_chars(self, count):
+        output = []
+        for chunk in self.iter_chunks():
+            output.append(chunk[:count])
+            count -= len(output[-1])
+            if count <= 0:
+                break
+        return "".join(output)
+
+    def tail_chars(self, count):
+        if self._file is None:
+            return "".join(self._chunks)[-count:] if count else ""
+        data = self._mmap()
+        if data is None:
+            return ""
+        with data:
+            # Each character is at most 4 bytes, trim to the requested count once decoded
+            text = data[max(len(data) - count * 4, 0):].decode(errors="surrogateescape")
+        return text[-count:] if count else ""
+
+    def head(self, count):
+        """
+        Return the first <count> lines of the output.
+        """
+        lines = []
+        for chunk in self.iter_chunks():
+            # Rejoin the partial last line with the start of this chunk
+            if len(lines) and not lines[-1].endswith("\n"):
+                chunk = lines.pop() + chunk
+            parts = chunk.split("\n")
+            lines.extend(x + "\n" for x in parts[:-1])
+            if len(parts[-1]):
+                lines.append(parts[-1])
+            if len(lines) > count:
+                break
+        return "".join(lines[:count])
+
+    def tail(self, count):
+        """
+        Return the last <count> lines of the output.
+        """
+        if not count:
+            return ""
+        if self._file is None:
+            return _tail("".join(self._chunks), "\n", count)
+        data = self._mmap()
+        if data is None:
+            return ""
+        with data:
+            return _tail(data, b"\n", count).decode(errors="surrogateescape")
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            if self._file is None:
+                for chunk in self._chunks:
+                    f.write(chunk.encode(errors="surrogateescape"))
+                return
+            import shutil
+            self._file.flush()
+            self._file.seek(0)
+            shutil.copyfileobj(self._file, f)
+            self._file.seek(0, 2)
+
+    def close(self):
+        self._chunks = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def truncate(text, limit):
+    """
+    Truncate text longer than limit characters in the same way as OutputBuffer.getvalue().
+    """
+    if len(text) <= limit:
+        return text
+    return text[:limit // 2] + TRUNCATED.format(len(text) - limit // 2 * 2) + text[len(text) - limit // 2:]
+
+def _tail(data, newline, count):
+    # Search back from before any trailing newline for the start of the last <count> lines
+    end = len(data) - 1 if data[-1:] == newline else len(data)
+    start = end
+    for _ in range(count):
+        start = data.rfind(newline, 0, start)
+        if start == -1:
+            break
+    return data[start + 1:]
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from lib.base import get_fingerprint
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cmdrunner_cache.sqlite")
+
+class ResultCache:
+    """
+    Cache of command output stored in sqlite, keyed by a fingerprint of the command and the saved
+    runner, encoder and decoder arguments of the session. Entries expire after <ttl> seconds, and
+    the least recently used entries are evicted once the stored output exceeds <max_size> bytes.
+    """
+    def __init__(self, path=DEFAULT_PATH, ttl=300, max_size=67108864):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        columns = [x[1] for x in self._db.execute("PRAGMA table_info(results)").fetchall()]
+        if len(columns) and "status" not in columns:
+            # Results cached before exit statuses were stored may be failures, drop them
+            self._db.execute("DROP TABLE results")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, cmd TEXT, output BLOB, size INTEGER, created REAL, expires REAL, accessed REAL, status INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self._db.commit()
+
+    @staticmethod
+    def get_key(cmd, session):
+        return hashlib.sha256("{}\n{}".format(get_fingerprint(session), cmd).encode(errors="surrogateescape")).hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached (output, exit status) for the key, or None if there is no unexpired entry.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT output, status FROM results WHERE key = ? AND expires > ?", (key, now)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        return row[0].decode(errors="surrogateescape"), row[1]
+
+    def set(self, key, cmd, output, status=None, ttl=None):
+        now = time.time()
+        data = output.encode(errors="surrogateescape")
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (key, cmd, data, len(data), now, now + (self.ttl if ttl is None else ttl), now, status))
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM results WHERE expires <= ?", (now,))
+        size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if size <= self.max_size:
+            return
+        # Remove the least recently used entries until the cache fits again
+        for key, _size in self._db.execute("SELECT key, size FROM results ORDER BY accessed").fetchall():
+            self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+            size -= _size
+            if size <= self.max_size:
+                break
+
+    def entries(self):
+        """
+        Return a (cmd, size, seconds until expiry, last access time) tuple for each unexpired entry,
+        most recently used first.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute("SELECT cmd, size, expires, accessed FROM results WHERE expires > ? ORDER BY accessed DESC", (now,)).fetchall()
+        return [(cmd, size, expires - now, accessed) for cmd, size, expires, accessed in rows]
+
+    def flush(self, pattern=None):
+        """
+        Remove all entries, or those whose command contains the pattern, returning the number removed.
+        """
+        with self._lock:
+            if pattern is None:
+                cursor = self._db.execute("DELETE FROM results")
+            else:
+                cursor = self._db.execute("DELETE FROM results WHERE instr(cmd, ?) > 0", (pattern,))
+            self._db.commit()
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
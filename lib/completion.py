@@ -0,0 +1,153 @@
+import collections
+import itertools
+import queue
+import threading
+import time
+
+from lib.base import execute, get_fingerprint, get_plan
+from lib.transfer import get_shell
+
+MARKER = "CMDRUNNER-DIRS"
+
+class PathCompleter:
+    """
+    Tab completion of remote paths from directory listings fetched through the session. Listings
+    are fetched on a background thread and kept for <ttl> seconds in an LRU cache of <max_entries>
+    directories, so completion only ever answers from the cache. After each listing the first
+    <prefetch> subdirectories are listed too, ready for when the completion descends into one.
+    """
+    def __init__(self, session, ttl=30, max_entries=256, prefetch=8, wait=0.05):
+        self.session = session
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prefetch = prefetch
+        self.wait = wait
+        self._listings = collections.OrderedDict()
+        self._pending = set()
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._thread = None
+        self._matches = []
+
+    def get_listing_cmd(self, shell, path):
+        if shell == "posix":
+            return "ls -1Ap -- '{}' 2>/dev/null".format(path.replace("'", "'\\''"))
+        if shell == "powershell":
+            return "Get-ChildItem -Force -LiteralPath '{}' | ForEach-Object {{ if ($_.PSIsContainer) {{ '{}' }}; $_.Name }}".format(path.replace("'", "''"), MARKER)
+        return "(for /D %d in (\"{0}\\*\") do @(echo {1}& echo %~nxd)) & for %f in (\"{0}\\*\") do @echo %~nxf".format(path.rstrip("\\"), MARKER)
+
+    def parse_listing(self, shell, output):
+        """
+        Return a {name : is_directory} dict of the entries in the listing.
+        """
+        entries = {}
+        directory = False
+        for line in output.splitlines():
+            line = line.rstrip("\r")
+            if line == MARKER:
+                directory = True
+            elif shell == "posix" and line.endswith("/"):
+                entries[line[:-1]] = True
+            elif len(line):
+                entries[line] = directory
+                directory = False
+        return entries
+
+    def complete(self, text, state):
+        """
+        readline completer for the path being typed, returning None rather than waiting on a
+        listing which is not cached yet.
+        """
+        if state == 0:
+            self._matches = self.get_matches(text)
+        try:
+            return self._matches[state]
+        except IndexError:
+            return None
+
+    def get_matches(self, text):
+        if get_plan(self.session).fanout is not None:
+            return []
+        shell = get_shell(self.session)
+        separator = "/" if shell == "posix" else "\\"
+        directory, _, prefix = text.rpartition(separator)
+        path = directory + separator if len(directory) or text.startswith(separator) else "."
+        key = (get_fingerprint(self.session), path)
+        entries = self.get(key, shell)
+        if entries is None:
+            return []
+        head = text[:len(text) - len(prefix)]
+        insensitive = shell != "posix"
+        matches = []
+        for name, is_directory in sorted(entries.items()):
+            if name.lower().startswith(prefix.lower()) if insensitive else name.startswith(prefix):
+                matches.append("{}{}{}".format(head, name, separator if is_directory else " "))
+        return matches
+
+    def get(self, key, shell):
+        """
+        Return the cached entries of the directory, queueing a fetch and waiting briefly for it if
+        it is not cached.
+        """
+        with self._lock:
+            entries = self._get(key)
+            if entries is not None:
+                return entries
+            self._fetch(key, shell, 0)
+            self._ready.wait_for(lambda: self._get(key) is not None, timeout=self.wait)
+            return self._get(key)
+
+    def _get(self, key):
+        listing = self._listings.get(key)
+        if listing is None:
+            return None
+        expires, entries = listing
+        if expires < time.monotonic():
+            del self._listings[key]
+            return None
+        self._listings.move_to_end(key)
+        return entries
+
+    def _fetch(self, key, shell, priority):
+        if key in self._pending:
+            return
+        self._pending.add(key)
+        self._queue.put((priority, next(self._sequence), key, shell))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._fetcher, daemon=True)
+            self._thread.start()
+
+    def _fetcher(self):
+        while True:
+            priority, _, key, shell = self._queue.get()
+            fingerprint, path = key
+            entries = None
+            try:
+                # Listings are neither cached as results nor archived in the history
+                output = execute(self.get_listing_cmd(shell, path), {**self.session, "cache" : None, "history" : None, "stats" : None})
+                entries = self.parse_listing(shell, output)
+            except Exception:
+                pass
+            with self._lock:
+                self._pending.discard(key)
+                if entries is None:
+                    continue
+                self._listings[key] = (time.monotonic() + self.ttl, entries)
+                self._listings.move_to_end(key)
+                while len(self._listings) > self.max_entries:
+                    self._listings.popitem(last=False)
+                self._ready.notify_all()
+                # Only prefetch from listings that were asked for, not from prefetched ones
+                if priority == 0:
+                    separator = "/" if shell == "posix" else "\\"
+                    base = "" if path == "." else path
+                    for name in [x for x, is_directory in sorted(entries.items()) if is_directory][:self.prefetch]:
+                        _key = (fingerprint, "{}{}{}".format(base, name, separator))
+                        if _key not in self._listings:
+                            self._fetch(_key, shell, 1)
+
+    def flush(self):
+        with self._lock:
+            self._listings.clear()
@@ -0,0 +1,104 @@
+import base64
+import codecs
+import re
+import zlib
+
+from lib.base import CmdDecoder
+
+def _to_bytes(chunks):
+    # Runners preserve binary output as surrogate escapes, reverse this to recover the raw bytes
+    for chunk in chunks:
+        yield chunk.encode("utf-8", "surrogateescape")
+
+def _to_text(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="surrogateescape")
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+def _decode_base64(chunks):
+    buffer = ""
+    for chunk in chunks:
+        buffer += re.sub("[^A-Za-z0-9+/=]", "", chunk)
+        # Only decode complete 4 character groups, keeping the remainder for the next chunk
+        index = len(buffer) - len(buffer) % 4
+        if index > 0:
+            yield base64.b64decode(buffer[:index])
+            buffer = buffer[index:]
+    if len(buffer):
+        yield base64.b64decode(buffer + "=" * (-len(buffer) % 4))
+
+def _decompress(chunks, wbits=None):
+    """
+    Incrementally decompress the byte chunks, if wbits is None either a zlib stream or a raw deflate
+    stream is detected from the header.
+    """
+    decompressor = None
+    header = b""
+    for chunk in chunks:
+        if decompressor is None:
+            header += chunk
+            if wbits is None:
+                if len(header) < 2:
+                    continue
+                wbits = 15 if header[0] & 0x0f == 8 and (header[0] << 8 | header[1]) % 31 == 0 else -15
+            decompressor = zlib.decompressobj(wbits)
+            chunk = header
+        yield decompressor.decompress(chunk)
+    if decompressor is None:
+        if not len(header):
+            return
+        decompressor = zlib.decompressobj(wbits or -15)
+        yield decompressor.decompress(header)
+    yield decompressor.flush()
+
+class Base64Decoder(CmdDecoder):
+    help = """
+        Decoder which base64 decodes the command output. Pair with CompressEncoder using the
+        base64 format to have the output encoded remotely.
+    """
+
+    def decode(self, output):
+        return "".join(self.decode_stream([output]))
+
+    def decode_stream(self, chunks):
+        yield from _to_text(_decode_base64(chunks))
+
+class GzipDecoder(CmdDecoder):
+    help = """
+        Decoder which decompresses gzip compressed command output. Pair with CompressEncoder
+        using the gzip format to have the output compressed remotely, this requires a runner
+        which preserves binary output such as BashRunner.
+    """
+
+    def decode(self, output):
+        return "".join(self.decode_stream([output]))
+
+    def decode_stream(self, chunks):
+        yield from _to_text(_decompress(_to_bytes(chunks), wbits=31))
+
+class ZlibDecoder(CmdDecoder):
+    help = """
+        Decoder which decompresses zlib or raw deflate compressed command output. Pair with
+        CompressEncoder using the zlib format to have the output compressed remotely, this
+        requires a runner which preserves binary output such as BashRunner.
+    """
+
+    def decode(self, output):
+        return "".join(self.decode_stream([output]))
+
+    def decode_stream(self, chunks):
+        yield from _to_text(_decompress(_to_bytes(chunks)))
+
+class GzipBase64Decoder(CmdDecoder):
+    help = """
+        Decoder which base64 decodes and then decompresses gzip compressed command output. Pair
+        with CompressEncoder using the gzip+base64 format to have the output compressed remotely,
+        this is safe to use with text only runners such as WebRunner.
+    """
+
+    def decode(self, output):
+        return "".join(self.decode_stream([output]))
+
+    def decode_stream(self, chunks):
+        yield from _to_text(_decompress(_decode_base64(chunks), wbits=31))
@@ -0,0 +1,56 @@
+import lib.encoders.powershell
+import lib.escape
+
+from lib.base import CmdEncoder, CmdArgument, CmdRunnerException
+
+class CompressEncoder(CmdEncoder):
+    help = """
+        Encoder which wraps the command so its output is compressed and / or base64 encoded
+        remotely before it is returned through the rest of the chain. This should be the last
+        encoder in the chain, paired with the matching decoder:
+            base64       Base64Decoder
+            gzip         GzipDecoder
+            zlib         ZlibDecoder
+            gzip+base64  GzipBase64Decoder
+
+        The remote shell is detected from the preceding encoders unless specified. The gzip and
+        zlib formats produce binary output, so are only supported on POSIX shells.
+    """
+    format = CmdArgument(arg_type=str, default="gzip+base64", description="Output format, one of base64, gzip, zlib or gzip+base64")
+    shell = CmdArgument(arg_type=str, default=None, required=False, description="Shell the command is run in, one of posix, cmd or powershell")
+
+    posix_formats = {
+        "base64" : "base64 -w0",
+        "gzip" : "gzip -c",
+        # Strip the gzip header and trailer to leave a raw deflate stream
+        "zlib" : "gzip -c | tail -c +11 | head -c -8",
+        "gzip+base64" : "gzip -c | base64 -w0",
+    }
+    powershell_formats = {
+        "base64" : "[Convert]::ToBase64String([Text.Encoding]::UTF8.GetBytes($o))",
+        "gzip+base64" : "$m=New-Object IO.MemoryStream;$g=New-Object IO.Compression.GZipStream($m,[IO.Compression.CompressionMode]::Compress);$b=[Text.Encoding]::UTF8.GetBytes($o);$g.Write($b,0,$b.Length);$g.Close();[Convert]::ToBase64String($m.ToArray())",
+    }
+    __slots__ = ("_shell",)
+
+    def ready(self, index, encoders):
+        # Commands run in the shell of the closest preceding encoder which declares one
+        self._shell = self.shell
+        for encoder in encoders[:index][::-1]:
+            self._shell = self._shell or encoder.shell
+        self._shell = self._shell or "posix"
+
+    def encode(self, cmd):
+        shell = getattr(self, "_shell", self.shell or "posix")
+        if shell == "posix":
+            if self.format not in self.posix_formats:
+                raise CmdRunnerException("Unsupported format '{}'".format(self.format))
+            return "( {} ) 2>&1 | {}".format(cmd, self.posix_formats[self.format])
+
+        if self.format not in self.powershell_formats:
+            raise CmdRunnerException("Unsupported format '{}' for shell '{}'".format(self.format, shell))
+        if shell == "powershell":
+            return "$o=& {{ {} }} 2>&1 | Out-String;{}".format(cmd, self.powershell_formats[self.format])
+        if shell == "cmd":
+            script = "$o=cmd /c '{}' 2>&1 | Out-String;{}".format(lib.escape.POWERSHELL_SINGLE_QUOTE(cmd), self.powershell_formats[self.format])
+            return lib.encoders.powershell.PowerShellEncoder(compress=False).encode(script)
+        raise CmdRunnerException("Unsupported shell '{}'".format(shell))
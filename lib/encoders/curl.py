@@ -9,8 +9,12 @@ class CurlEncoder(CmdEncoder):
     url = CmdArgument(arg_type=str, description="The URL to connect to")
     data = CmdArgument(arg_type=str, description="The POST data to send in the HTTP request")
     replace = CmdArgument(arg_type=str, default="***", description="The string to replace with the encoded command")
+    template_safe = True
+
+    def escape(self, cmd):
+        return urllib.parse.quote_plus(cmd)
 
     def encode(self, cmd):
-        cmd = urllib.parse.quote_plus(cmd)
+        cmd = self.escape(cmd)
         data = self.data.replace(self.replace, cmd)
         return "curl -s -k  -X POST --data-binary \"{}\" \"{}\"".format(data, self.url)
@@ -1,10 +1,15 @@
 from lib.base import CmdEncoder
 
 import lib.encoders.wincmd
+import lib.escape
 
 class EchoEncoder(CmdEncoder):
     help = """
         Simple encoder which encodes the command within an 'echo' command, used for debugging.
     """
+    template_safe = True
+    max_length = 8191
+    escaper = lib.escape.CMD
+
     def encode(self, cmd):
         return lib.encoders.wincmd.WinCmdEncoder().encode("echo {}".format(cmd))
@@ -1,11 +1,28 @@
 import base64
+import zlib
 
-from lib.base import CmdEncoder
+from lib.base import CmdEncoder, CmdArgument
 
 class PowerShellEncoder(CmdEncoder):
     help = """
         Encoder which run the given command within powershell.
+
+        When compress is enabled the command is also deflate compressed and wrapped in a small stub
+        which decompresses and runs it, whichever of the two forms is shorter is used.
     """
-    def encode(self, cmd):
+    shell = "powershell"
+    compress = CmdArgument(arg_type=bool, default=True, description="Whether to compress the command when it makes it shorter")
+
+    def encode_command(self, cmd):
         cmd = base64.b64encode(cmd.encode("UTF-16")[2:]).decode()
         return "powershell -NoProfile –ExecutionPolicy Bypass -EncodedCommand {}".format(cmd)
+
+    def encode(self, cmd):
+        encoded = self.encode_command(cmd)
+        if not self.compress:
+            return encoded
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        data = base64.b64encode(compressor.compress(cmd.encode()) + compressor.flush()).decode()
+        stub = "$s=New-Object IO.Compression.DeflateStream([IO.MemoryStream][Convert]::FromBase64String('{}'),[IO.Compression.CompressionMode]::Decompress);iex (New-Object IO.StreamReader($s,[Text.Encoding]::UTF8)).ReadToEnd()".format(data)
+        compressed = self.encode_command(stub)
+        return compressed if len(compressed) < len(encoded) else encoded
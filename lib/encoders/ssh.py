@@ -1,20 +1,75 @@
-from lib.base import CmdEncoder, CmdArgument
+import base64
+import uuid
+
+from lib.base import CmdEncoder, CmdArgument, CmdRunnerException
+
+import lib.escape
 
 class SSHEncoder(CmdEncoder):
     help = """
         Encoder which runs the given command on the target SSH server.
+
+        Multiple hosts can be targeted at once by specifying a comma separated list, a CIDR range or
+        a file of hosts (e.g. @hosts.txt) as the host, the command is then run against every host in
+        parallel. Quote the host, as unquoted commas separate arguments, e.g.
+            $push_encoder ssh admin "web1,web2,10.0.0.0/28"
+
+        When multiplex is enabled an OpenSSH ControlMaster connection is established on first use
+        and reused for subsequent commands, avoiding a new key exchange and authentication for every
+        command. The master connections are closed with $ssh_close or on $quit.
+
+        Each hop escapes the backslashes, quotes, $ and backticks of the command it wraps, so the
+        escaping compounds with every hop. With transport set to base64 the command is instead
+        written base64 encoded to a temporary file on the host, then decoded and run by the login
+        shell, which keeps deep chains a manageable size. Both forms run exactly the command given.
+        With transport set to auto (the default) base64 is used whenever it is shorter, escape never
+        uses base64.
     """
+    fanout_argument = "host"
+    template_safe = True
+    shell = "posix"
+    max_length = 131072
+    escaper = lib.escape.POSIX_DOUBLE_QUOTE
     username = CmdArgument(arg_type=str, description="The SSH user")
-    host = CmdArgument(arg_type=str, description="The SSH host")
+    host = CmdArgument(arg_type=str, description="The SSH host, list of hosts, CIDR range or @hosts_file")
     identity = CmdArgument(arg_type=str, default=None, required=False, description="Path to the identity file to use")
+    multiplex = CmdArgument(arg_type=bool, default=False, description="Whether to reuse a persistent ControlMaster connection")
+    control_path = CmdArgument(arg_type=str, default="/tmp/.cmdrunner-%r@%h:%p", description="Path of the ControlMaster socket on the system running ssh")
+    control_persist = CmdArgument(arg_type=int, default=600, description="Number of seconds an idle ControlMaster connection is kept open")
+    transport = CmdArgument(arg_type=str, default="auto", description="How the command is carried to the host, one of escape, base64 or auto")
 
-    def encode(self, cmd):
-        cmd = cmd.replace("\\", "\\\\").replace("\"", "\\\"").replace("|", "\\|")
+    def get_options(self):
         ssh_options = []
         if self.identity is not None:
             ssh_options.append("-i {}".format(self.identity))
         ssh_options.append("-o \"StrictHostKeyChecking no\"")
         ssh_options.append("-o \"UserKnownHostsFile /dev/null\"")
         ssh_options.append("-o \"LogLevel ERROR\"")
-        ssh_options = " ".join(ssh_options)
-        return "ssh {} {}@{} \"{}\"".format(ssh_options, self.username, self.host, cmd)
+        if self.multiplex:
+            ssh_options.append("-o \"ControlMaster auto\"")
+            ssh_options.append("-o \"ControlPath {}\"".format(self.control_path))
+            ssh_options.append("-o \"ControlPersist {}\"".format(self.control_persist))
+        return " ".join(ssh_options)
+
+    def ready(self, index, encoders):
+        if self.transport not in ["escape", "base64", "auto"]:
+            raise CmdRunnerException("Unsupported transport '{}', expected escape, base64 or auto".format(self.transport))
+
+    def wrap(self, cmd):
+        # Sourced from a file rather than piped into sh, which leaves stdin to the command and avoids
+        # the pipes escape() would change. The file removes itself first, so the exit status is the
+        # command's own and the file is removed even if the command exits the shell.
+        path = "/tmp/.cmdrunner-{}".format(uuid.uuid4().hex[:16])
+        script = "rm -f {}\n{}".format(path, cmd)
+        return "echo {1}>{0}.b64;base64 -d {0}.b64>{0};rm -f {0}.b64;. {0}".format(path, base64.b64encode(script.encode(errors="surrogateescape")).decode())
+
+    def encode(self, cmd):
+        if self.transport == "base64":
+            cmd = self.wrap(cmd)
+        cmd = self.escape(cmd)
+        return "ssh {} {}@{} \"{}\"".format(self.get_options(), self.username, self.host, cmd)
+
+    def close(self):
+        if not self.multiplex:
+            return None
+        return "ssh -O exit -o \"ControlPath {}\" {}@{}".format(self.control_path, self.username, self.host)
@@ -1,9 +1,51 @@
-from lib.base import CmdEncoder
+import base64
+import uuid
+
+from lib.base import CmdEncoder, CmdArgument, CmdRunnerException
+
+import lib.escape
 
 class WinCmdEncoder(CmdEncoder):
     help = """
         Encoder to run the given command in a windows cmd.exe shell.
+
+        Each hop caret escapes the metacharacters of the command it wraps, doubling the carets of
+        every hop inside it. With transport set to base64 the command is instead written base64
+        encoded to a temporary file in C:\\Windows\\Temp, then decoded with certutil and run. With
+        transport set to auto (the default) base64 is used whenever it is shorter and the command
+        is a single line of ASCII text without quotes or %, which both forms run the same way.
     """
-    
+    template_safe = True
+    shell = "cmd"
+    max_length = 8191
+    escaper = lib.escape.CMD
+    # Quotes disable caret escaping, % is expanded by the shell running cmd rather than cmd itself,
+    # and each line is run as a separate command
+    inexact_characters = "\"%\r\n"
+    transport = CmdArgument(arg_type=str, default="auto", description="How the command is carried to cmd.exe, one of escape, base64 or auto")
+
+    def ready(self, index, encoders):
+        if self.transport not in ["escape", "base64", "auto"]:
+            raise CmdRunnerException("Unsupported transport '{}', expected escape, base64 or auto".format(self.transport))
+
+    def can_transport(self, cmd):
+        # certutil writes the bytes as is, which for /F reads in the OEM code page, and skips lines
+        # starting with ;
+        return super().can_transport(cmd) and cmd.isascii() and not cmd.startswith(";")
+
+    def wrap(self, cmd):
+        # The decoded file deletes itself first, for /F having already read all of it, so the exit
+        # status is the command's own
+        path = "C:\\Windows\\Temp\\cmdrunner-{}".format(uuid.uuid4().hex[:16])
+        script = "del {}.txt\n{}".format(path, cmd)
+        return " & ".join([
+          ">{}.b64 echo {}".format(path, base64.b64encode(script.encode(errors="surrogateescape")).decode()),
+          "certutil -f -decode {0}.b64 {0}.txt >nul".format(path),
+          "del {}.b64".format(path),
+          "for /F \"delims=\" %c in ({}.txt) do @cmd /S /C %c".format(path),
+        ])
+
     def encode(self, cmd):
-        return "cmd /S /C {}".format(cmd.replace("^", "^^").replace("&", "^&").replace(">", "^>").replace("(", "^(").replace(")", "^)").replace("|", "^|"))
+        if self.transport == "base64":
+            cmd = self.wrap(cmd)
+        return "cmd /S /C {}".format(self.escape(cmd))
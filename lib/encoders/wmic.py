@@ -1,51 +1,175 @@
+import base64
+import itertools
 import random
 
 import lib.encoders.wincmd
+import lib.escape
 
-from lib.base import CmdEncoder, CmdArgument
+from lib.base import CmdEncoder, CmdArgument, CmdRunnerException
 
 class WmicEncoder(CmdEncoder):
     help = """
         Encoder which runs the given command on a remote server via WMIC.
+
+        Multiple hosts can be targeted at once by specifying a comma separated list, a CIDR range or
+        a file of hosts (e.g. @hosts.txt) as the host, the command is then run against every host in
+        parallel. Quote the host, as unquoted commas separate arguments, e.g.
+            $push_encoder wmic "web1,web2,10.0.0.0/28" administrator password
+
+        Capturing output normally costs a wmic process creation and four share operations per
+        command. Starting a worker with $wmic_worker start instead launches a single long running
+        loop on the remote system, each command is then just dropped as a file on the C$ share and
+        its output read back once the worker has run it.
+
+        Each hop escapes the quotes of the command it wraps, which breaks down once WMIC hops are
+        nested. With transport set to base64 the command is instead dropped base64 encoded on the
+        C$ share, and the remote process only decodes it with certutil and runs each line of it, so
+        hops nest to any depth. With transport set to auto (the default) base64 is used when
+        another WMIC hop is nested inside this one, or the escaped command would be too long.
     """
-    host = CmdArgument(arg_type=str, description="Hostname of the remote system")
+    fanout_argument = "host"
+    shell = "cmd"
+    max_length = 8191
+    host = CmdArgument(arg_type=str, description="Hostname of the remote system, list of hosts, CIDR range or @hosts_file")
     username = CmdArgument(arg_type=str, default=None, required=False, description="Username to access the remote system")
     password = CmdArgument(arg_type=str, default=None, required=False, description="Password to access the remote system")
-    delay = CmdArgument(arg_type=int, default=2, description="How long to wait for the command to complete")
+    delay = CmdArgument(arg_type=int, default=2, description="How long to wait for the command to complete when not polling")
     output = CmdArgument(arg_type=bool, default=True, description="Whether the output of the command should be captured")
+    poll = CmdArgument(arg_type=bool, default=True, description="Whether to poll for a completion marker instead of waiting a fixed delay")
+    timeout = CmdArgument(arg_type=int, default=60, description="Maximum number of seconds to poll for the command to complete")
+    transport = CmdArgument(arg_type=str, default="auto", description="How the command is carried to the host, one of escape, base64 or auto")
+    __slots__ = ("_delay", "_timeout", "_skipencoding", "_nested", "_worker", "_sequence")
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._worker = None
+        self._sequence = None
 
     def ready(self, index, encoders):
+        if self.transport not in ["escape", "base64", "auto"]:
+            raise CmdRunnerException("Unsupported transport '{}', expected escape, base64 or auto".format(self.transport))
         # Calculate the delay and encoding requirements based on other encoders in the chain
         self._delay = sum([getattr(x, "delay", 0) for x in encoders[index + 1:]]) + self.delay
-        self._skipencoding = sum([1 if x.__class__ == self.__class__ else 0 for x in encoders[:index + 1]]) == 1
+        self._timeout = sum([getattr(x, "timeout", 0) for x in encoders[index + 1:]]) + self.timeout
+        self._nested = any(x.__class__ == self.__class__ for x in encoders[index + 1:])
+        # The command is only caret escaped when it ends up within the escaped command of an outer
+        # WMIC hop, a command carried base64 encoded is run as is
+        outer = [x for x in encoders[:index] if x.__class__ == self.__class__]
+        self._skipencoding = not len(outer) or outer[-1].transport != "escape"
 
-    def encode(self, cmd):
-        host = self.host or "localhost"
+    def get_wmic_args(self):
         wmic_args = []
         if self.host is not None:
             wmic_args.append("/NODE:\"{}\"".format(self.host))
             wmic_args.append("/User:\"{}\"".format(self.username))
             wmic_args.append("/Password:\"{}\"".format(self.password))
-        wmic_args = " ".join(wmic_args)
-
-        if self.output:
-            alphabet = "ABCDEFGHJIKLMNOPQRSTUVWXYZabcdefghjiklmnopqrstuvwxyz0123456789"
-            tmp_dir = "".join(random.choice(alphabet) for x in range(8))
-            tmp_path = "{}\\{}.log".format(tmp_dir, "".join(random.choice(alphabet) for x in range(8)))
-            # TODO: This is a bit of a mess and only works with 2 levels of recursion
-            if self._skipencoding:
-                remote_cmd = "cmd /S /C ({}) > C:\\{}".format(cmd, tmp_path).replace("\"", "\\\"")
-            else:
-                remote_cmd = lib.encoders.wincmd.WinCmdEncoder().encode("({}) > C:\\{}".format(cmd, tmp_path)).replace("\"", "\\\"")
-            cmd = " && ".join([
-              "mkdir \\\\{}\\C$\\{}".format(host, tmp_dir),
-              "wmic {} process call create \"{}\" >nul".format(wmic_args, remote_cmd),
+        return " ".join(wmic_args)
+
+    def get_remote_cmd(self, remote_cmd):
+        if self._skipencoding:
+            return lib.escape.WMIC("cmd /S /C {}".format(remote_cmd))
+        return lib.escape.WMIC(lib.encoders.wincmd.WinCmdEncoder(transport="escape").encode(remote_cmd))
+
+    def get_transport(self, cmd):
+        """
+        Return how the command is carried to the host, resolving auto to escape or base64.
+        """
+        if self.transport != "auto":
+            return self.transport
+        # Escaping never shortens the command, so only commands which fit need escaping to measure
+        if self._nested or len(cmd) > self.max_length or len(self.get_remote_cmd(cmd)) > self.max_length:
+            return "base64"
+        return "escape"
+
+    def start_worker(self):
+        """
+        Return the command which starts a worker loop on the remote system. The loop decodes each
+        numbered .b64 command file dropped in its directory, runs each line of it and writes the
+        output to the matching .out file, until a stop file appears.
+        """
+        alphabet = "ABCDEFGHJIKLMNOPQRSTUVWXYZabcdefghjiklmnopqrstuvwxyz0123456789"
+        self._worker = "".join(random.choice(alphabet) for x in range(8))
+        self._sequence = itertools.count(1)
+        path = "C:\\{}".format(self._worker)
+        loop = "for /L %i in (0,0,1) do @((if exist {0}\\stop (del /Q {0}\\* & exit)) & (for %f in ({0}\\*.b64) do @(certutil -f -decode \"%f\" \"%~dpnf.txt\" >nul & del \"%f\" & (for /F \"usebackq delims=\" %c in (\"%~dpnf.txt\") do @cmd /S /C %c) > \"%~dpnf.tmp\" 2>&1 & del \"%~dpnf.txt\" & move /Y \"%~dpnf.tmp\" \"%~dpnf.out\" >nul)) & ping -n 2 127.0.0.1 >nul)".format(path)
+        return " && ".join([
+          "mkdir \\\\{}\\C$\\{}".format(self.host or "localhost", self._worker),
+          "wmic {} process call create \"{}\" >nul".format(self.get_wmic_args(), self.get_remote_cmd(loop)),
+        ])
+
+    def stop_worker(self):
+        """
+        Return the command which stops the remote worker loop and removes its directory, or None if
+        no worker has been started. The worker is only forgotten by clear_worker(), once the command
+        has been run.
+        """
+        if self._worker is None:
+            return None
+        share = "\\\\{}\\C$\\{}".format(self.host or "localhost", self._worker)
+        return " & ".join([
+          "type nul > {}\\stop".format(share),
+          "(for /L %i in (1,1,{}) do @if exist {}\\stop ping -n 2 127.0.0.1 >nul)".format(self.timeout, share),
+          "rmdir /S /Q {}".format(share),
+        ])
+
+    def clear_worker(self):
+        self._worker = None
+        self._sequence = None
+
+    def encode(self, cmd):
+        host = self.host or "localhost"
+        wmic_args = self.get_wmic_args()
+
+        worker = self._worker
+        if self.output and worker is not None:
+            # Write the command to a temporary name first so the worker never reads it half written
+            path = "\\\\{}\\C$\\{}\\{}".format(host, worker, next(self._sequence))
+            return " & ".join([
+              " && ".join([
+                ">{}.new echo {}".format(path, base64.b64encode(cmd.encode()).decode()),
+                "move /Y {0}.new {0}.b64 >nul".format(path),
+                "(for /L %i in (1,1,{}) do @if not exist {}.out ping -n 2 127.0.0.1 >nul)".format(self._timeout, path),
+              ]),
+              "type {}.out".format(path),
+              "del {}.out".format(path)
+            ])
+
+        transport = self.get_transport(cmd)
+        if not self.output and transport == "escape":
+            cmd = lib.escape.WMIC(cmd)
+            return "wmic {} process call create \"{}\"".format(wmic_args, cmd)
+
+        alphabet = "ABCDEFGHJIKLMNOPQRSTUVWXYZabcdefghjiklmnopqrstuvwxyz0123456789"
+        tmp_dir = "".join(random.choice(alphabet) for x in range(8))
+        steps = ["mkdir \\\\{}\\C$\\{}".format(host, tmp_dir)]
+        if transport == "base64":
+            # Only the fixed command decoding and running the file is escaped, whatever the command
+            cmd_path = "{}\\{}".format(tmp_dir, "".join(random.choice(alphabet) for x in range(8)))
+            steps.append(">\\\\{}\\C$\\{}.b64 echo {}".format(host, cmd_path, base64.b64encode(cmd.encode(errors="surrogateescape")).decode()))
+            cmd = "certutil -f -decode C:\\{0}.b64 C:\\{0}.txt >nul & (for /F \"delims=\" %c in (C:\\{0}.txt) do @cmd /S /C %c)".format(cmd_path)
+            if not self.output:
+                remote_cmd = self.get_remote_cmd("{} & rmdir /S /Q C:\\{}".format(cmd, tmp_dir))
+                steps.append("wmic {} process call create \"{}\"".format(wmic_args, remote_cmd))
+                return " && ".join(steps)
+
+        tmp_path = "{}\\{}.log".format(tmp_dir, "".join(random.choice(alphabet) for x in range(8)))
+        done_path = "{}\\{}.done".format(tmp_dir, "".join(random.choice(alphabet) for x in range(8)))
+        remote_cmd = "({}) > C:\\{}".format(cmd, tmp_path)
+        if self.poll:
+            # Write a completion marker once the command has finished
+            remote_cmd += " & type nul > C:\\{}".format(done_path)
+        steps.append("wmic {} process call create \"{}\" >nul".format(wmic_args, self.get_remote_cmd(remote_cmd)))
+        if not self.poll:
+            return " && ".join(steps + [
               "ping -n {} 127.0.0.1 >nul".format(self._delay),
               "type \\\\{}\\C$\\{}".format(host, tmp_path),
               "rmdir /S /Q \\\\{}\\C$\\{}".format(host, tmp_dir)
             ])
-            return cmd
-
-        cmd = cmd.replace("\"", "\\\"")
-        return "wmic {} process call create \"{}\"".format(wmic_args, cmd)
+        # Poll the share for the completion marker every second, up to the timeout
+        return " & ".join([
+          " && ".join(steps + [
+            "(for /L %i in (1,1,{}) do @if not exist \\\\{}\\C$\\{} ping -n 2 127.0.0.1 >nul)".format(self._timeout, host, done_path),
+          ]),
+          "type \\\\{}\\C$\\{}".format(host, tmp_path),
+          "rmdir /S /Q \\\\{}\\C$\\{}".format(host, tmp_dir)
+        ])
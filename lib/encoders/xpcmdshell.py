@@ -1,10 +1,16 @@
 from lib.base import CmdEncoder
 
+import lib.escape
+
 class XpCmdShellEncoder(CmdEncoder):
     help = """
         Encoder to run the given command in a Mircosoft SQL Server xp_cmdshell stored procedure.
     """
+    template_safe = True
+    shell = "cmd"
+    max_length = 8000
+    escaper = lib.escape.TSQL
 
     def encode(self, cmd):
-        cmd = cmd.replace("'", "''")
+        cmd = self.escape(cmd)
         return "EXEC xp_cmdshell '{}';".format(cmd)
@@ -0,0 +1,65 @@
+import functools
+
+class Escaper:
+    """
+    Character by character escaping compiled from a {character : replacement} map.
+
+    The map is applied as a sequence of str.replace passes, ordered so no pass sees the output of an
+    earlier one, which in CPython is much faster than str.translate with multi character
+    replacements. Maps where no such order exists fall back to str.translate.
+    """
+    def __init__(self, replacements):
+        self.replacements = {k : v for k, v in replacements.items() if k != v}
+        self.passes = Escaper.get_passes(self.replacements)
+        self.table = str.maketrans(self.replacements)
+
+    @staticmethod
+    def get_passes(replacements):
+        """
+        Order the replacements so each character is replaced before any character whose
+        replacement contains it, returning None if the replacements are cyclic.
+        """
+        passes = []
+        remaining = dict(replacements)
+        while len(remaining):
+            ready = [k for k in remaining if not any(k in v for x, v in remaining.items() if x != k)]
+            if not len(ready):
+                return None
+            for k in ready:
+                passes.append((k, remaining.pop(k)))
+        return passes[::-1]
+
+    def __call__(self, value):
+        if self.passes is None:
+            return value.translate(self.table)
+        for character, replacement in self.passes:
+            value = value.replace(character, replacement)
+        return value
+
+def compose(escapers):
+    """
+    Return a single Escaper equivalent to applying each of the escapers in turn.
+    """
+    return _compose(tuple(escapers))
+
+@functools.lru_cache(maxsize=256)
+def _compose(escapers):
+    characters = set(x for escaper in escapers for x in escaper.replacements)
+    replacements = {}
+    for character in characters:
+        value = character
+        for escaper in escapers:
+            value = escaper(value)
+        replacements[character] = value
+    return Escaper(replacements)
+
+# cmd.exe metacharacters, escaped with a caret
+CMD = Escaper({"^" : "^^", "&" : "^&", ">" : "^>", "(" : "^(", ")" : "^)", "|" : "^|"})
+# Within a double quoted POSIX shell string, as passed to ssh. Only these characters are special
+# within double quotes, so the string is exactly the command
+POSIX_DOUBLE_QUOTE = Escaper({"\\" : "\\\\", "\"" : "\\\"", "$" : "\\$", "`" : "\\`"})
+# Within a single quoted T-SQL or PowerShell string
+TSQL = Escaper({"'" : "''"})
+POWERSHELL_SINGLE_QUOTE = TSQL
+# Within the double quoted command line of wmic process call create
+WMIC = Escaper({"\"" : "\\\""})
@@ -0,0 +1,170 @@
+import atexit
+import glob
+import json
+import os
+import queue
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+from lib.base import get_fingerprint
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cmdrunner_history")
+
+class History:
+    """
+    Archive of every command executed through a session with this object set as
+    session["history"]. Each command, its encoded form, the session fingerprint and its output are
+    appended as a zlib compressed JSON record to the current segment file, and indexed in an sqlite
+    trigram full text index for substring searches. Records are written on a background thread so
+    logging does not delay the command. Outputs longer than <max_output> characters are archived
+    truncated to their start and end. Encoded commands may contain credentials, so the archive is
+    only readable by its owner.
+    """
+    def __init__(self, path=DEFAULT_PATH, segment_size=16777216, max_output=4194304):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_output = max_output
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        # Tighten archives created before their permissions were restricted
+        os.chmod(path, 0o700)
+        for name in glob.glob(os.path.join(path, "index.sqlite*")) + glob.glob(os.path.join(path, "segment-*.log")):
+            os.chmod(name, 0o600)
+        self._db = self._connect()
+        self._db.execute("CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, time REAL, cmd TEXT, fingerprint TEXT, size INTEGER, segment INTEGER, offset INTEGER, length INTEGER)")
+        try:
+            # Contentless, as the text is kept compressed in the segment files
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(cmd, output, content='', tokenize='trigram')")
+            self.indexed = True
+        except sqlite3.OperationalError:
+            # SQLite without FTS5 or the trigram tokenizer, searches fall back to scanning the segments
+            self.indexed = False
+        self._db.commit()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _connect(self):
+        path = os.path.join(self.path, "index.sqlite")
+        # SQLite gives the -wal and -shm files the permissions of the database file
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        umask = os.umask(0o077)
+        try:
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+        finally:
+            os.umask(umask)
+        return db
+
+    def add(self, cmd, encoded, session, output):
+        """
+        Queue a command to be archived, returning immediately.
+        """
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._writer, daemon=True)
+                    self._thread.start()
+        self._queue.put((time.time(), cmd, encoded, get_fingerprint(session), output))
+
+    def _writer(self):
+        db = self._connect()
+        segment = max([int(os.path.basename(x).split(".")[0].split("-")[1]) for x in glob.glob(os.path.join(self.path, "segment-*.log"))] + [0])
+        while True:
+            items = [self._queue.get()]
+            # Write everything queued so far in a single transaction
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for item in items:
+                    if item is not None:
+                        segment = self._write(db, segment, *item)
+                db.commit()
+            except Exception as e:
+                print("[!] Error archiving command: {}".format(e))
+            finally:
+                for item in items:
+                    self._queue.task_done()
+            if None in items:
+                db.close()
+                return
+
+    def _write(self, db, segment, _time, cmd, encoded, fingerprint, output):
+        data = zlib.compress(json.dumps({"time" : _time, "cmd" : cmd, "encoded" : encoded, "fingerprint" : fingerprint, "output" : output}).encode())
+        path = os.path.join(self.path, "segment-{:06d}.log".format(segment))
+        if segment == 0 or os.path.getsize(path) >= self.segment_size:
+            segment += 1
+            path = os.path.join(self.path, "segment-{:06d}.log".format(segment))
+        with os.fdopen(os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), "ab") as f:
+            offset = f.tell()
+            f.write(struct.pack(">I", len(data)) + data)
+        cursor = db.execute("INSERT INTO records (time, cmd, fingerprint, size, segment, offset, length) VALUES (?, ?, ?, ?, ?, ?, ?)", (_time, _to_text(cmd), fingerprint, len(output), segment, offset + 4, len(data)))
+        if self.indexed:
+            # Binary output preserved as surrogate escapes can't be stored in sqlite text
+            db.execute("INSERT INTO search (rowid, cmd, output) VALUES (?, ?, ?)", (cursor.lastrowid, _to_text(cmd), _to_text(output)))
+        return segment
+
+    def flush(self):
+        """
+        Wait for all queued commands to be written.
+        """
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def get(self, record_id):
+        """
+        Return the archived record with the given id, or None.
+        """
+        self.flush()
+        row = self._db.execute("SELECT segment, offset, length FROM records WHERE id = ?", (record_id,)).fetchone()
+        if row is None:
+            return None
+        return self._read(*row)
+
+    def _read(self, segment, offset, length):
+        with open(os.path.join(self.path, "segment-{:06d}.log".format(segment)), "rb") as f:
+            f.seek(offset)
+            return json.loads(zlib.decompress(f.read(length)))
+
+    def recent(self, limit=20):
+        """
+        Return an (id, time, cmd, size) tuple for each of the most recent records, newest first.
+        """
+        self.flush()
+        return self._db.execute("SELECT id, time, cmd, size FROM records ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+
+    def search(self, text, limit=20):
+        """
+        Return an (id, time, cmd, size) tuple for the most recent records whose command or output
+        contains the text, ignoring case, newest first.
+        """
+        self.flush()
+        # The trigram index can only match text of at least three characters
+        if self.indexed and len(text) >= 3:
+            query = "\"{}\"".format(text.replace("\"", "\"\""))
+            return self._db.execute("SELECT id, time, cmd, size FROM records WHERE id IN (SELECT rowid FROM search WHERE search MATCH ?) ORDER BY id DESC LIMIT ?", (query, limit)).fetchall()
+        results = []
+        text = text.lower()
+        for row in self._db.execute("SELECT id, time, cmd, size, segment, offset, length FROM records ORDER BY id DESC"):
+            record = self._read(*row[4:])
+            if text in record["cmd"].lower() or text in record["output"].lower():
+                results.append(row[:4])
+                if len(results) == limit:
+                    break
+        return results
+
+def _to_text(value):
+    return value.encode(errors="surrogateescape").decode(errors="replace")
@@ -0,0 +1,174 @@
+import collections
+import itertools
+import queue
+import threading
+import time
+
+import lib.buffer
+
+from lib.base import CancelScope, CmdRunnerException, execute_stream
+
+class Job:
+    """
+    A command run in the background, with its output kept in an OutputBuffer.
+    """
+    def __init__(self, job_id, cmd, session, name):
+        self.id = job_id
+        self.cmd = cmd
+        self.session = session
+        # Name of the session the job was started from
+        self.name = name
+        self.status = "queued"
+        self.error = None
+        self.output = lib.buffer.OutputBuffer()
+        self.starttime = None
+        self.endtime = None
+        self.killed = False
+        self.notified = False
+        self._done = threading.Event()
+        self._scope = CancelScope()
+        # Held while writing output, so none is written once the job is killed
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self._done.is_set()
+
+    @property
+    def elapsed(self):
+        if self.starttime is None:
+            return 0
+        return (self.endtime or time.time()) - self.starttime
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+class JobManager:
+    """
+    Runs commands as background jobs on a pool of <workers> daemon threads, so jobs never delay
+    exiting, and can be resized while jobs are running. A killed job finishes immediately and its
+    command is cancelled through the runner's cancel hook, or for runners without one the command's
+    output stream is closed once it next produces output.
+    """
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.jobs = collections.OrderedDict()
+        self._ids = itertools.count(1)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        # Notified when a job finishes or the pool is resized, to start waiting jobs
+        self._slots = threading.Condition()
+        self._running = 0
+
+    def submit(self, cmd, session, name):
+        with self._lock:
+            job = Job(next(self._ids), cmd, session, name)
+            self.jobs[job.id] = job
+            self._start_threads()
+        self._queue.put(job)
+        return job
+
+    def _start_threads(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def resize(self, workers):
+        """
+        Run up to <workers> jobs at once. Running jobs are not stopped when the pool shrinks, new
+        jobs wait until fewer than <workers> are running.
+        """
+        with self._slots:
+            self.workers = workers
+            self._slots.notify_all()
+        with self._lock:
+            if len(self.jobs):
+                self._start_threads()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            # Once the pool shrinks, threads beyond its size wait here rather than exit
+            with self._slots:
+                while self._running >= self.workers:
+                    self._slots.wait()
+                self._running += 1
+            try:
+                self._run(job)
+            finally:
+                with self._slots:
+                    self._running -= 1
+                    self._slots.notify()
+
+    def _run(self, job):
+        with job._lock:
+            if job.killed:
+                return
+            job.status = "running"
+            job.starttime = time.time()
+        with job._scope:
+            chunks = execute_stream(job.cmd, job.session)
+            try:
+                for chunk in chunks:
+                    with job._lock:
+                        # Let a cancelled command finish cleanly, e.g. to keep a persistent shell
+                        if job.killed and not job._scope.stopped:
+                            break
+                        if not job.killed:
+                            job.output.write(chunk)
+                status, error = "done", None
+            except Exception as e:
+                status, error = "failed", str(e) or e.__class__.__name__
+            finally:
+                chunks.close()
+        with job._lock:
+            if not job.killed:
+                job.status, job.error = status, error
+                job.endtime = time.time()
+                job._done.set()
+
+    def get(self, job_id=None):
+        """
+        Return the job with the given id, or the most recent job if no id is given.
+        """
+        with self._lock:
+            if job_id is None:
+                if not len(self.jobs):
+                    raise CmdRunnerException("No jobs")
+                return next(reversed(self.jobs.values()))
+            if job_id not in self.jobs:
+                raise CmdRunnerException("Unknown job {}".format(job_id))
+            return self.jobs[job_id]
+
+    def kill(self, job_id):
+        job = self.get(job_id)
+        with job._lock:
+            if job.finished:
+                return job
+            # A queued job is skipped once dequeued
+            job.killed = True
+            job.status = "killed"
+            job.endtime = time.time()
+            job.starttime = job.starttime or job.endtime
+            job._done.set()
+        job._scope.cancel()
+        return job
+
+    def remove(self, job_id):
+        """
+        Forget the job, leaving its output to the caller.
+        """
+        with self._lock:
+            return self.jobs.pop(job_id)
+
+    def get_finished(self):
+        """
+        Return the jobs which have finished since this was last called.
+        """
+        with self._lock:
+            jobs = [x for x in self.jobs.values() if x.finished and not x.notified]
+        for job in jobs:
+            job.notified = True
+        return jobs
@@ -0,0 +1,101 @@
+import ast
+import glob
+import importlib
+import json
+import os
+
+PLUGIN_TYPES = {
+    "runner" : ("lib.runners", "CmdRunner"),
+    "encoder" : ("lib.encoders", "CmdEncoder"),
+    "decoder" : ("lib.decoders", "CmdDecoder"),
+}
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), "__pycache__", "plugins.json")
+
+_manifest = None
+_classes = {}
+
+def _get_files():
+    files = {}
+    for package, _ in PLUGIN_TYPES.values():
+        for path in glob.glob(os.path.join(os.path.dirname(__file__), package.split(".")[-1], "*.py")):
+            if os.path.basename(path).startswith("_"):
+                continue
+            stat = os.stat(path)
+            files[path] = [stat.st_mtime_ns, stat.st_size]
+    return files
+
+def _scan(files):
+    """
+    Build the plugin manifest by parsing the plugin modules, without importing them.
+    """
+    # Map of class name to (module, base class names) for every class defined in a plugin module
+    definitions = {}
+    for path in sorted(files):
+        package = "lib." + os.path.basename(os.path.dirname(path))
+        module = "{}.{}".format(package, os.path.splitext(os.path.basename(path))[0])
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in tree.body:
+            if isinstance(node, ast.ClassDef):
+                bases = [x.id if isinstance(x, ast.Name) else x.attr for x in node.bases if isinstance(x, (ast.Name, ast.Attribute))]
+                definitions[node.name] = (module, bases)
+
+    def _is_plugin(name, base_name, seen=()):
+        if name not in definitions or name in seen:
+            return False
+        return any(x == base_name or _is_plugin(x, base_name, seen + (name,)) for x in definitions[name][1])
+
+    plugins = {}
+    for plugin_type, (package, base_name) in PLUGIN_TYPES.items():
+        plugins[plugin_type] = {name : module for name, (module, _) in definitions.items() if module.startswith(package + ".") and _is_plugin(name, base_name)}
+    return plugins
+
+def get_manifest():
+    """
+    Return the plugin manifest mapping each plugin type to a {class name : module} dict. The
+    manifest is cached on disk and only rebuilt when a plugin module changes.
+    """
+    global _manifest
+    if _manifest is not None:
+        return _manifest
+    files = _get_files()
+    try:
+        with open(MANIFEST_PATH) as f:
+            cached = json.load(f)
+        if cached["files"] == files:
+            _manifest = cached["plugins"]
+            return _manifest
+    except (OSError, ValueError, KeyError):
+        pass
+    _manifest = _scan(files)
+    try:
+        os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+        with open(MANIFEST_PATH, "w") as f:
+            json.dump({"files" : files, "plugins" : _manifest}, f)
+    except OSError:
+        pass
+    return _manifest
+
+def get_names(plugin_type):
+    return sorted(get_manifest()[plugin_type])
+
+def get_class(plugin_type, name):
+    """
+    Return the plugin class with the exact class name, importing its module on first use. Raises
+    KeyError for unknown plugins.
+    """
+    key = (plugin_type, name)
+    if key not in _classes:
+        _classes[key] = getattr(importlib.import_module(get_manifest()[plugin_type][name]), name)
+    return _classes[key]
+
+def find_class(plugin_type, name):
+    """
+    Return the plugin class matching the case insensitive name, with or without the plugin type
+    suffix (e.g. 'bash' or 'BashRunner'), or None.
+    """
+    names = {x.lower() : x for x in get_manifest()[plugin_type]}
+    match = names.get(name.lower(), names.get(name.lower() + plugin_type))
+    if match is None:
+        return None
+    return get_class(plugin_type, match)
@@ -1,25 +1,273 @@
+import codecs
 import os
+import re
+import selectors
 import signal
 import subprocess
+import threading
 import time
+import uuid
 
-from lib.base import CmdRunner, CmdArgument
+from lib.base import CmdRunner, CmdArgument, on_cancel
 
 class BashRunner(CmdRunner):
     timeout = CmdArgument(default=30, arg_type=int, description="Number of seconds to wait for the command to complete")
+    kill_timeout = CmdArgument(default=2, arg_type=int, description="Number of seconds to wait after SIGTERM before sending SIGKILL")
     help = """
         Basic runner to run commands in a bash shell.
+
+        Output which is not valid UTF-8 is preserved using surrogate escapes, so binary output can
+        be passed on to decoders such as GzipDecoder.
     """
+    shell = "posix"
+    max_length = 131072
+    chunk_size = 65536
 
     def run(self, cmd):
         """
         Simple CmdRunner which just executes the command.
         """
-        starttime = time.time()
-        proc = subprocess.Popen(["/bin/bash", "-c", cmd], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
-        while proc.poll() is None:
-            if self.timeout is not None and time.time() - starttime > self.timeout:
-                print("[!] Command timed out")
-                os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
-            time.sleep(0.2)
-        return proc.communicate()[0].decode()
+        return b"".join(self._run(cmd)).decode(errors="surrogateescape")
+
+    def run_stream(self, cmd):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="surrogateescape")
+        for chunk in self._run(cmd):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b"", final=True)
+
+    async def run_async(self, cmd):
+        import asyncio
+        proc = await asyncio.create_subprocess_exec("/bin/bash", "-c", cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        signals = [signal.SIGTERM, signal.SIGKILL]
+        output = []
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(proc.stdout.read(self.chunk_size), self._remaining(deadline))
+                except asyncio.TimeoutError:
+                    # Give up on the output pipe if it is held open by an orphaned process
+                    if not len(signals):
+                        break
+                    deadline = self._signal(proc, signals.pop(0))
+                    continue
+                if not chunk:
+                    break
+                output.append(chunk)
+
+            # Output has been closed, wait for the process itself to exit
+            while len(signals):
+                try:
+                    await asyncio.wait_for(proc.wait(), self._remaining(deadline))
+                    break
+                except asyncio.TimeoutError:
+                    deadline = self._signal(proc, signals.pop(0))
+        finally:
+            if proc.returncode is None:
+                self._signal(proc, signal.SIGKILL)
+                await proc.wait()
+        self.exit_status = proc.returncode
+        return b"".join(output).decode(errors="surrogateescape")
+
+    def _run(self, cmd):
+        """
+        Execute the command, yielding output chunks as soon as they are available. Output is drained
+        continuously so the child never blocks on a full pipe, and the command is terminated with
+        SIGTERM then SIGKILL if it runs past the timeout.
+        """
+        self.exit_status = None
+        proc = subprocess.Popen(["/bin/bash", "-c", cmd], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        signals = [signal.SIGTERM, signal.SIGKILL]
+        try:
+            with selectors.DefaultSelector() as selector, on_cancel(lambda: self.cancel(proc)):
+                selector.register(proc.stdout, selectors.EVENT_READ)
+                while True:
+                    remaining = self._remaining(deadline)
+                    if remaining == 0:
+                        # Give up on the output pipe if it is held open by an orphaned process
+                        if not len(signals):
+                            break
+                        deadline = self._signal(proc, signals.pop(0))
+                        continue
+                    if not selector.select(remaining):
+                        continue
+                    chunk = os.read(proc.stdout.fileno(), self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+            # Output has been closed, wait for the process itself to exit
+            while len(signals):
+                try:
+                    proc.wait(self._remaining(deadline))
+                    break
+                except subprocess.TimeoutExpired:
+                    deadline = self._signal(proc, signals.pop(0))
+        finally:
+            if proc.poll() is None:
+                self._signal(proc, signal.SIGKILL)
+            proc.stdout.close()
+            proc.wait()
+        self.exit_status = proc.returncode
+
+    def cancel(self, proc):
+        """
+        Stop the command being run by proc, called from another thread when it is cancelled.
+        """
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _remaining(self, deadline):
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def _signal(self, proc, sig):
+        if sig == signal.SIGTERM:
+            print("[!] Command timed out")
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+        return time.monotonic() + self.kill_timeout
+
+class PersistentBashRunner(BashRunner):
+    help = """
+        Runner which sends each command to a single long lived bash shell, avoiding the cost of
+        starting a new shell for every command. Shell state such as the working directory and
+        environment variables persists between commands. Commands are run one at a time.
+
+        A timed out command is interrupted with SIGINT. If it is still running kill_timeout seconds
+        later, e.g. as it ignores SIGINT, the processes it started are killed, leaving the shell. Only
+        a command which still keeps the shell busy after that, such as a loop of builtins ignoring
+        SIGINT, gets the shell restarted, losing its state.
+    """
+    __slots__ = ("_lock", "_proc")
+    # Commands share a single shell, so use the blocking run() in an executor
+    run_async = CmdRunner.run_async
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._proc = None
+
+    def _get_shell(self):
+        if self._proc is None or self._proc.poll() is not None:
+            self._proc = subprocess.Popen(["/bin/bash"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+            # Returning from the function on SIGINT aborts just the current command, leaving the shell
+            # running. The trap is set for each command in case the previous one changed it.
+            self._proc.stdin.write(b"__cmdrunner_run() { trap 'return 130 2>/dev/null' INT; eval \"$1\" < /dev/null; }\n")
+            self._proc.stdin.flush()
+        return self._proc
+
+    def _close_shell(self):
+        try:
+            os.killpg(self._proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self._proc.stdin.close()
+        self._proc.stdout.close()
+        self._proc.wait()
+        self._proc = None
+
+    def _run(self, cmd):
+        """
+        Send the command to the shell followed by a unique marker carrying its exit status, yielding
+        output chunks until the marker is seen.
+        """
+        with self._lock:
+            proc = self._get_shell()
+            marker = "__CMDRUNNER_{}__".format(uuid.uuid4().hex).encode()
+            pattern = re.compile(re.escape(marker) + rb"([0-9]+)\n")
+            proc.stdin.write("__cmdrunner_run '{}'\nprintf '%s%d\\n' '{}' \"$?\"\n".format(cmd.replace("'", "'\\''"), marker.decode()).encode())
+            proc.stdin.flush()
+
+            self.exit_status = None
+            status = None
+            buffer = b""
+            deadline = None if self.timeout is None else time.monotonic() + self.timeout
+            signals = [signal.SIGINT, signal.SIGKILL]
+            try:
+                with selectors.DefaultSelector() as selector, on_cancel(lambda: self.cancel(proc)):
+                    selector.register(proc.stdout, selectors.EVENT_READ)
+                    while True:
+                        remaining = self._remaining(deadline)
+                        if remaining == 0:
+                            if not len(signals):
+                                break
+                            deadline = self._signal(proc, signals.pop(0))
+                            continue
+                        if not selector.select(remaining):
+                            continue
+                        chunk = os.read(proc.stdout.fileno(), self.chunk_size)
+                        if not chunk:
+                            break
+                        buffer += chunk
+                        match = pattern.search(buffer)
+                        if match is not None:
+                            status = self.exit_status = int(match.group(1))
+                            yield buffer[:match.start()]
+                            return
+                        # Hold back anything which may be the start of the marker
+                        index = buffer.find(marker)
+                        index = index if index != -1 else max(len(buffer) - len(marker) + 1, 0)
+                        if index > 0:
+                            yield buffer[:index]
+                            buffer = buffer[index:]
+                yield buffer
+            finally:
+                # The shell is left in an unknown state if the marker was never seen
+                if status is None:
+                    if proc.poll() is None:
+                        print("[!] Restarted the shell, its working directory, variables and other state were lost")
+                    self._close_shell()
+                    # e.g. the command ran exit, or was killed
+                    self.exit_status = proc.returncode
+
+    def cancel(self, proc):
+        # Interrupt just the current command as on a timeout, which releases the shell
+        try:
+            os.killpg(proc.pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+
+    def _signal(self, proc, sig):
+        if sig == signal.SIGINT:
+            print("[!] Command timed out")
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+        else:
+            # Kill the command's processes but not the shell, which then carries on once they exit
+            for pid in self._get_group(proc.pid):
+                if pid != proc.pid:
+                    try:
+                        os.kill(pid, sig)
+                    except ProcessLookupError:
+                        pass
+        return time.monotonic() + self.kill_timeout
+
+    def _get_group(self, pgid):
+        """
+        Return the ids of the processes in the process group.
+        """
+        if os.path.isdir("/proc"):
+            pids = []
+            for name in os.listdir("/proc"):
+                if not name.isdigit():
+                    continue
+                try:
+                    with open("/proc/{}/stat".format(name)) as f:
+                        stat = f.read()
+                except OSError:
+                    continue
+                # The command name in brackets may contain spaces, the group is the third field after it
+                if int(stat.rsplit(")", 1)[1].split()[2]) == pgid:
+                    pids.append(int(name))
+            return pids
+        output = subprocess.run(["pgrep", "-g", str(pgid)], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        return [int(x) for x in output.split()]
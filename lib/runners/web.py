@@ -1,20 +1,118 @@
+import threading
+import weakref
 import requests
+import requests.adapters
 import urllib.parse
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 from lib.base import CmdRunner, CmdArgument
 
 class WebRunner(CmdRunner):
     help = """
         HTTP runner which POSTS command to the provided URL.
+
+        Requests are sent over a pooled keep-alive session, so subsequent commands reuse the
+        established TCP / TLS connection to the server. Asynchronous requests share a pooled aiohttp
+        session per event loop in the same way.
     """
     url = CmdArgument(arg_type=str, description="The URL to connect to")
     data = CmdArgument(arg_type=str, description="The POST data to send in the HTTP request")
     replace = CmdArgument(arg_type=str, default="***", description="The string to replace with the encoded command")
+    pool_size = CmdArgument(arg_type=int, default=10, description="Maximum number of pooled connections to keep alive")
+    compress = CmdArgument(arg_type=bool, default=True, description="Whether to request compressed responses")
+    stream = CmdArgument(arg_type=bool, default=True, description="Whether to read the response body incrementally")
+    chunk_size = 65536
+    __slots__ = ("_session", "_async_sessions")
+
+    _lock = threading.Lock()
+
+    def get_session(self):
+        with self._lock:
+            if getattr(self, "_session", None) is None:
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+                self._session = requests.Session()
+                self._session.mount("http://", adapter)
+                self._session.mount("https://", adapter)
+                self._session.headers.update({
+                    "Content-Type" : "application/x-www-form-urlencoded",
+                    "Accept-Encoding" : "gzip, deflate" if self.compress else "identity",
+                })
+            return self._session
+
+    def post(self, cmd, stream=False):
+        data = self.data.replace(self.replace, cmd)
+        return self.get_session().post(self.url, data=data, stream=stream)
 
     def run(self, cmd):
+        return self.post(cmd).text
+
+    def run_stream(self, cmd):
+        if not self.stream:
+            yield self.run(cmd)
+            return
+        with self.post(cmd, stream=True) as r:
+            # Without a declared charset iter_content would yield raw bytes
+            if r.encoding is None:
+                r.encoding = "utf-8"
+            yield from r.iter_content(chunk_size=self.chunk_size, decode_unicode=True)
+
+    async def run_async(self, cmd):
+        # Fall back to running the blocking request in an executor if aiohttp is not installed
+        if aiohttp is None:
+            return await super().run_async(cmd)
         data = self.data.replace(self.replace, cmd)
-        r = requests.post(self.url, headers={"Content-Type" : "application/x-www-form-urlencoded"}, data=data)
-        return r.text
+        session = await self.get_async_session()
+        async with session.post(self.url, data=data) as r:
+            return await r.text(errors="replace")
+
+    async def get_async_session(self):
+        """
+        Return the aiohttp session for the running event loop, created on first use with a pool of
+        at most pool_size keep-alive connections. The session is closed by aclose(), or otherwise
+        when the loop shuts down its asynchronous generators, as asyncio.run() does before closing
+        the loop.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if getattr(self, "_async_sessions", None) is None:
+                self._async_sessions = weakref.WeakKeyDictionary()
+            entry = self._async_sessions.get(loop)
+            if entry is not None:
+                return entry[0]
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                headers={
+                    "Content-Type" : "application/x-www-form-urlencoded",
+                    "Accept-Encoding" : "gzip, deflate" if self.compress else "identity",
+                },
+                auto_decompress=self.compress)
+            closer = self._close_on_shutdown(loop, session)
+            self._async_sessions[loop] = (session, closer)
+        # Started on the loop, so the loop finalizes it when shutting down
+        await closer.asend(None)
+        return session
+
+    async def _close_on_shutdown(self, loop, session):
+        try:
+            yield
+        finally:
+            # The session refers to the loop, so the entry has to be removed for the loop to be freed
+            with self._lock:
+                self._async_sessions.pop(loop, None)
+            await session.close()
+
+    async def aclose(self):
+        import asyncio
+        with self._lock:
+            sessions = getattr(self, "_async_sessions", None)
+            entry = sessions.get(asyncio.get_running_loop()) if sessions is not None else None
+        if entry is not None:
+            await entry[1].aclose()
 
     def encode(self, cmd):
         return urllib.parse.quote_plus(cmd)
@@ -0,0 +1,63 @@
+import collections
+
+from lib.base import CmdRunnerException
+
+class Session(collections.ChainMap):
+    """
+    A named session, holding its own runner, encoders and other state, while the keys in
+    Sessions.shared are read from and written to the settings shared by all the sessions. Copies
+    such as {**session, "cache" : None} are plain dicts as before.
+    """
+    def __init__(self, state, settings):
+        super().__init__(state, settings)
+
+    def _get_map(self, key):
+        return self.maps[1] if key in Sessions.shared else self.maps[0]
+
+    def __setitem__(self, key, value):
+        self._get_map(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._get_map(key)[key]
+
+    def pop(self, key, *args):
+        return self._get_map(key).pop(key, *args)
+
+class Sessions:
+    """
+    The named sessions of the REPL, one of which is current, and the settings they share so that
+    changing one (e.g. $cache off) in any session changes it in all of them.
+    """
+    # Keys of the settings shared by all the sessions
+    shared = ("workers", "history", "cache", "display", "sessions", "jobs")
+
+    def __init__(self):
+        self.settings = {}
+        self.sessions = collections.OrderedDict()
+        self.current = None
+
+    def add(self, name, state):
+        """
+        Add a session from a dict of its state, any shared settings in which replace the current
+        ones, making it current if it is the first session.
+        """
+        if name in self.sessions:
+            raise CmdRunnerException("Session '{}' already exists".format(name))
+        session = Session({}, self.settings)
+        for k, v in state.items():
+            session[k] = v
+        session["sessions"] = self
+        self.sessions[name] = session
+        if self.current is None:
+            self.current = name
+        return session
+
+    def get(self, name=None):
+        name = self.current if name is None else name
+        if name not in self.sessions:
+            raise CmdRunnerException("Unknown session '{}'".format(name))
+        return self.sessions[name]
+
+    def switch(self, name):
+        self.get(name)
+        self.current = name
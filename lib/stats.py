@@ -0,0 +1,174 @@
+import collections
+import cProfile
+import json
+import math
+import pstats
+import threading
+import time
+import tracemalloc
+
+class CommandRecord:
+    """
+    Timings and sizes of each stage of a single command, in the order the stages were applied.
+    Each stage is a [name, kind, seconds, bytes_in, bytes_out] list, kind being one of "encode",
+    "run" or "decode".
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.time = time.time()
+        self.starttime = time.perf_counter()
+        self.seconds = None
+        self.stages = []
+        self.size = len(cmd)
+        self.error = None
+        self.profile = None
+        self.memory_peak = None
+        self._chained = []
+        self._profiler = None
+        self._memory = None
+
+    def add(self, name, kind, seconds, size):
+        self.stages.append([name, kind, seconds, self.size, size])
+        self.size = size
+
+    def timed(self, chunks, name, kind):
+        """
+        Wrap a generator of output chunks, recording the time spent producing the chunks and their
+        total length. Stages wrapped this way are chained together, so the time of each excludes
+        the time of the stages feeding it once the record is finished.
+        """
+        stage = [name, kind, 0, 0, 0]
+        self._chained.append(stage)
+        return self._timed(chunks, stage)
+
+    def _timed(self, chunks, stage):
+        chunks = iter(chunks)
+        while True:
+            starttime = time.perf_counter()
+            chunk = next(chunks, None)
+            stage[2] += time.perf_counter() - starttime
+            if chunk is None:
+                return
+            stage[4] += len(chunk)
+            yield chunk
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.starttime
+        inclusive = 0
+        for stage in self._chained:
+            stage[2], inclusive = stage[2] - inclusive, stage[2]
+            stage[3], self.size = self.size, stage[4]
+            self.stages.append(stage)
+        self._chained = []
+
+    def to_dict(self, max_cmd_length=1000):
+        return {
+            "time" : self.time,
+            "cmd" : self.cmd[:max_cmd_length],
+            "seconds" : self.seconds,
+            "error" : self.error,
+            "stages" : [{"name" : x[0], "kind" : x[1], "seconds" : x[2], "bytes_in" : x[3], "bytes" : x[4]} for x in self.stages],
+            "profile" : self.profile,
+            "memory_peak" : self.memory_peak,
+        }
+
+class Stats:
+    """
+    Collects a CommandRecord for each command executed through a session with this object set as
+    session["stats"], keeping the most recent <history> records. Records are optionally appended to
+    a JSON lines trace file, and each command can be profiled with cProfile and / or tracemalloc.
+    """
+    def __init__(self, history=1000, trace_path=None, profile=False, memory=False):
+        self.records = collections.deque(maxlen=history)
+        self.trace_path = None
+        self.profile = profile
+        self.memory = memory
+        self._trace = None
+        self._lock = threading.Lock()
+        self.set_trace(trace_path)
+
+    def set_trace(self, trace_path):
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+            self.trace_path = trace_path
+            if trace_path is not None:
+                self._trace = open(trace_path, "a")
+
+    def set_memory(self, memory):
+        self.memory = memory
+        if not memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def close(self):
+        self.set_trace(None)
+        self.set_memory(False)
+
+    def reset(self):
+        self.records.clear()
+
+    def start(self, cmd):
+        record = CommandRecord(cmd)
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            record._memory = tracemalloc.get_traced_memory()[0]
+        if self.profile:
+            record._profiler = cProfile.Profile()
+            try:
+                record._profiler.enable()
+            except ValueError:
+                # Another command on a different thread is already being profiled
+                record._profiler = None
+        return record
+
+    def finish(self, record, limit=20):
+        if record._profiler is not None:
+            record._profiler.disable()
+            profile = pstats.Stats(record._profiler).sort_stats(pstats.SortKey.CUMULATIVE)
+            record.profile = [{"function" : pstats.func_std_string(x), "calls" : profile.stats[x][1], "seconds" : profile.stats[x][3]} for x in profile.fcn_list[:limit]]
+            record._profiler = None
+        if record._memory is not None and tracemalloc.is_tracing():
+            record.memory_peak = tracemalloc.get_traced_memory()[1] - record._memory
+        record.finish()
+        with self._lock:
+            self.records.append(record)
+            if self._trace is not None:
+                self._trace.write(json.dumps(record.to_dict()) + "\n")
+                self._trace.flush()
+
+    def summary(self):
+        """
+        Return the p50 and p95 time of each stage across the recorded commands, along with the
+        median size of its output and the median size amplification of encoders and decoders.
+        """
+        stages = collections.OrderedDict()
+        totals = []
+        for record in list(self.records):
+            totals.append(record.seconds)
+            for name, kind, seconds, size_in, size in record.stages:
+                stages.setdefault((name, kind), []).append((seconds, size, size / size_in if size_in else None))
+
+        lines = ["{:40s} {:>6s} {:>10s} {:>10s} {:>12s} {:>8s}".format("Stage", "Count", "p50", "p95", "Bytes", "Amplify")]
+        for (name, kind), values in stages.items():
+            ratios = [x[2] for x in values if x[2] is not None]
+            amplification = "{:.2f}x".format(percentile(ratios, 50)) if kind != "run" and len(ratios) else "-"
+            lines.append("{:40s} {:>6d} {:>10s} {:>10s} {:>12d} {:>8s}".format(name, len(values), format_time(percentile([x[0] for x in values], 50)), format_time(percentile([x[0] for x in values], 95)), int(percentile([x[1] for x in values], 50)), amplification))
+        if len(totals):
+            lines.append("{:40s} {:>6d} {:>10s} {:>10s}".format("Total", len(totals), format_time(percentile(totals, 50)), format_time(percentile(totals, 95))))
+        return "\n".join(lines)
+
+def percentile(values, percent):
+    """
+    Nearest rank percentile of the values.
+    """
+    values = sorted(values)
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)] if len(values) else 0
+
+def format_time(seconds):
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return "{:.2f}{}".format(seconds / scale, unit)
+    return "{:.0f}ns".format(seconds / 1e-9)
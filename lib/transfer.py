@@ -0,0 +1,243 @@
+import base64
+import concurrent.futures
+import hashlib
+import json
+import os
+import random
+import re
+import shlex
+
+import lib.encoders.powershell
+
+from lib.base import CmdRunnerException, execute, get_plan
+
+HASH_PATTERN = re.compile("CMDRUNNER ([0-9a-f]{32})")
+PART_PATTERN = re.compile("CMDRUNNER .*\\.([0-9]+) ([0-9a-f]{32})")
+SIZE_PATTERN = re.compile("CMDRUNNER ([0-9]+)")
+CHUNK_PATTERN = re.compile("CMDRUNNER ([0-9a-f]{32})[^\\n]*\\s+CMDRUNNER ([A-Za-z0-9+/=]*)")
+
+class PosixTransfer:
+    """
+    Builds file transfer commands for a POSIX shell with coreutils.
+    """
+    def write_chunk(self, path, data):
+        return "printf %s {} | base64 -d > {} && echo \"CMDRUNNER $(md5sum < {})\"".format(base64.b64encode(data).decode(), shlex.quote(path), shlex.quote(path))
+
+    def list_chunks(self, prefix):
+        return "for f in {}.*; do [ -f \"$f\" ] && echo \"CMDRUNNER $f $(md5sum < \"$f\")\"; done; true".format(shlex.quote(prefix))
+
+    def assemble(self, path, prefix, count):
+        return "for i in $(seq 0 {}); do cat {}.$i; done > {} && rm -f {}.* && echo \"CMDRUNNER $(md5sum < {})\"".format(count - 1, shlex.quote(prefix), shlex.quote(path), shlex.quote(prefix), shlex.quote(path))
+
+    def size(self, path):
+        return "echo \"CMDRUNNER $(wc -c < {})\"".format(shlex.quote(path))
+
+    def read_chunk(self, path, index, chunk_size):
+        dd = "dd if={} bs={} skip={} count=1 2>/dev/null".format(shlex.quote(path), chunk_size, index)
+        return "echo \"CMDRUNNER $({} | md5sum)\"; echo \"CMDRUNNER $({} | base64 -w0)\"".format(dd, dd)
+
+class PowerShellTransfer:
+    """
+    Builds file transfer commands as PowerShell scripts, wrapped in an encoded powershell command
+    line when the chain runs them in cmd.exe.
+    """
+    md5 = "[BitConverter]::ToString([Security.Cryptography.MD5]::Create().ComputeHash($b)).Replace('-','').ToLower()"
+
+    def __init__(self, wrap=False):
+        self.wrap = wrap
+
+    def _script(self, script):
+        if self.wrap:
+            return lib.encoders.powershell.PowerShellEncoder().encode(script)
+        return script
+
+    def _quote(self, value):
+        return "'{}'".format(value.replace("'", "''"))
+
+    def write_chunk(self, path, data):
+        return self._script("$b=[Convert]::FromBase64String('{}');[IO.File]::WriteAllBytes({},$b);'CMDRUNNER '+{}".format(base64.b64encode(data).decode(), self._quote(path), self.md5))
+
+    def list_chunks(self, prefix):
+        return self._script("Get-ChildItem -Path {} -Filter {} | ForEach-Object {{ $b=[IO.File]::ReadAllBytes($_.FullName);'CMDRUNNER '+$_.FullName+' '+{} }}".format(self._quote(os.path.dirname(prefix.replace("\\", "/")) or "."), self._quote(os.path.basename(prefix.replace("\\", "/")) + ".*"), self.md5))
+
+    def assemble(self, path, prefix, count):
+        return self._script("$o=[IO.File]::Create({});0..{}|ForEach-Object {{ $p={}+'.'+$_;$b=[IO.File]::ReadAllBytes($p);$o.Write($b,0,$b.Length);Remove-Item -LiteralPath $p }};$o.Close();'CMDRUNNER '+(Get-FileHash -LiteralPath {} -Algorithm MD5).Hash.ToLower()".format(self._quote(path), count - 1, self._quote(prefix), self._quote(path)))
+
+    def size(self, path):
+        return self._script("'CMDRUNNER '+(Get-Item -LiteralPath {}).Length".format(self._quote(path)))
+
+    def read_chunk(self, path, index, chunk_size):
+        return self._script("$f=[IO.File]::OpenRead({});$f.Seek({},0)|Out-Null;$b=New-Object byte[] {};$r=$f.Read($b,0,{});$f.Close();[Array]::Resize([ref]$b,$r);'CMDRUNNER '+{};'CMDRUNNER '+[Convert]::ToBase64String($b)".format(self._quote(path), index * chunk_size, chunk_size, chunk_size, self.md5))
+
+def get_shell(session):
+    """
+    Return the shell the innermost command of the session is run in, defaulting to "posix".
+    """
+    for encoder in session["encoders"][::-1]:
+        if encoder.shell is not None:
+            return encoder.shell
+    return session["runner"].shell or "posix"
+
+def get_transfer(session, shell=None):
+    shell = shell or get_shell(session)
+    if shell == "posix":
+        return PosixTransfer()
+    if shell in ["cmd", "powershell", "windows"]:
+        return PowerShellTransfer(wrap=shell != "powershell")
+    raise CmdRunnerException("Unsupported shell '{}' for file transfers".format(shell))
+
+def fits(cmd, session):
+    """
+    Check that the command fits within the maximum command length at every stage of the chain.
+    """
+    for encoder in session["encoders"][::-1]:
+        if encoder.max_length is not None and len(cmd) > encoder.max_length:
+            return False
+        cmd = encoder.encode(cmd)
+    cmd = session["runner"].encode(cmd)
+    return session["runner"].max_length is None or len(cmd) <= session["runner"].max_length
+
+def get_chunk_size(session, transfer, path, max_chunk_size):
+    """
+    Binary search for the largest upload chunk size which fits the chain's command length budget.
+    """
+    # Probe with data which encodes to "+" characters, the most expensive base64 character to escape,
+    # and with incompressible data in case an encoder compresses the command
+    probe = random.Random(0).randbytes(max_chunk_size)
+    low, high = 0, max_chunk_size // 3
+    while low < high:
+        mid = (low + high + 1) // 2
+        if fits(transfer.write_chunk(path, b"\xfb\xef\xbe" * mid), session) and fits(transfer.write_chunk(path, probe[:mid * 3]), session):
+            low = mid
+        else:
+            high = mid - 1
+    if low == 0:
+        raise CmdRunnerException("Chain command length budget is too small to upload any data")
+    return low * 3
+
+def _run(cmd, session, pattern):
+    output = execute(cmd, session)
+    match = pattern.search(output)
+    if match is None:
+        raise CmdRunnerException("Unexpected output from remote command: {}".format(output.strip()[:200]))
+    return match
+
+def _check_session(session):
+    if get_plan(session).fanout is not None:
+        raise CmdRunnerException("File transfers are not supported with fanned out encoders")
+
+def _run_parallel(func, items, workers, progress):
+    """
+    Call func for each item on a bounded thread pool, reporting progress as each call completes and
+    raising the first error once all calls have finished.
+    """
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(func, x) for x in items]
+        try:
+            for done, future in enumerate(concurrent.futures.as_completed(futures)):
+                error = error or future.exception()
+                progress(done + 1)
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            raise
+    if error is not None:
+        raise error
+
+def upload(local_path, remote_path, session, shell=None, workers=8, max_chunk_size=1048576, retries=3, progress=None):
+    """
+    Upload a local file through the session in chunks sized to fit the chain, sending chunks in
+    parallel. Chunks already present remotely with a matching hash are skipped, so an interrupted
+    upload can be resumed by running it again.
+    """
+    _check_session(session)
+    session = {**session, "cache" : None, "history" : None}
+    transfer = get_transfer(session, shell)
+    prefix = "{}.cmdrunner-part".format(remote_path)
+    chunk_size = get_chunk_size(session, transfer, prefix + ".99999999", max_chunk_size)
+    size = os.path.getsize(local_path)
+    count = max((size + chunk_size - 1) // chunk_size, 1)
+
+    with open(local_path, "rb") as f:
+        hashes = [hashlib.md5(f.read(chunk_size)).hexdigest() for x in range(count)]
+    existing = {int(m.group(1)) : m.group(2) for m in PART_PATTERN.finditer(execute(transfer.list_chunks(prefix), session))}
+    pending = [x for x in range(count) if existing.get(x) != hashes[x]]
+
+    def _upload(index):
+        with open(local_path, "rb") as f:
+            f.seek(index * chunk_size)
+            data = f.read(chunk_size)
+        for attempt in range(retries):
+            try:
+                if _run(transfer.write_chunk("{}.{}".format(prefix, index), data), session, HASH_PATTERN).group(1) == hashes[index]:
+                    return
+            except Exception as e:
+                if attempt == retries - 1:
+                    raise CmdRunnerException("Chunk {} failed: {}".format(index, e))
+        raise CmdRunnerException("Chunk {} failed hash verification".format(index))
+
+    _run_parallel(_upload, pending, workers, lambda done: progress(count - len(pending) + done, count) if progress else None)
+
+    with open(local_path, "rb") as f:
+        digest = hashlib.md5()
+        for data in iter(lambda: f.read(chunk_size), b""):
+            digest.update(data)
+    if _run(transfer.assemble(remote_path, prefix, count), session, HASH_PATTERN).group(1) != digest.hexdigest():
+        raise CmdRunnerException("Uploaded file '{}' failed hash verification".format(remote_path))
+    return size
+
+def download(remote_path, local_path, session, shell=None, workers=8, chunk_size=262144, retries=3, progress=None):
+    """
+    Download a remote file through the session in parallel chunks. Completed chunks are recorded
+    alongside the partial download, so an interrupted download can be resumed by running it again.
+    """
+    _check_session(session)
+    session = {**session, "cache" : None, "history" : None}
+    transfer = get_transfer(session, shell)
+    size = int(_run(transfer.size(remote_path), session, SIZE_PATTERN).group(1))
+    count = max((size + chunk_size - 1) // chunk_size, 1)
+    partial_path = "{}.cmdrunner-part".format(local_path)
+    state_path = "{}.cmdrunner-state".format(local_path)
+
+    state = {"size" : size, "chunk_size" : chunk_size, "done" : []}
+    if os.path.isfile(state_path) and os.path.isfile(partial_path):
+        with open(state_path) as f:
+            _state = json.load(f)
+        if _state.get("size") == size and _state.get("chunk_size") == chunk_size:
+            state = _state
+    if not len(state["done"]):
+        with open(partial_path, "wb") as f:
+            f.truncate(size)
+    done = set(state["done"])
+    pending = [x for x in range(count) if x not in done]
+
+    def _download(index):
+        for attempt in range(retries):
+            try:
+                match = _run(transfer.read_chunk(remote_path, index, chunk_size), session, CHUNK_PATTERN)
+                data = base64.b64decode(match.group(2))
+                if hashlib.md5(data).hexdigest() == match.group(1):
+                    break
+            except Exception as e:
+                if attempt == retries - 1:
+                    raise CmdRunnerException("Chunk {} failed: {}".format(index, e))
+        else:
+            raise CmdRunnerException("Chunk {} failed hash verification".format(index))
+        with open(partial_path, "r+b") as f:
+            f.seek(index * chunk_size)
+            f.write(data)
+        return index
+
+    def _progress(done):
+        # Record completed chunks as they finish so an interrupted download can be resumed
+        with open(state_path, "w") as f:
+            json.dump(state, f)
+        if progress is not None:
+            progress(len(state["done"]), count)
+
+    _run_parallel(lambda index: state["done"].append(_download(index)), pending, workers, _progress)
+
+    os.replace(partial_path, local_path)
+    os.remove(state_path)
+    return size
@@ -1,5 +1,6 @@
 import ast
 import io
+import ipaddress
 import json
 import tokenize
 
@@ -79,3 +80,69 @@ def get_args(argument_string):
         # Reset key to None, this can be bypassed using continue statement above
         key = None
     return args, kwargs
+
+def _is_complete_line(line):
+    # A trailing "\r" is held back as it may be the start of a "\r\n" split across chunks
+    return line.splitlines()[0] != line and not line.endswith("\r")
+
+def iter_lines(chunks, max_length=None):
+    """
+    Split an iterable of text chunks into lines, yielding each line as soon as it is complete. Lines
+    longer than max_length are yielded in pieces of at least max_length characters.
+    """
+    partial = []
+    partial_length = 0
+    for chunk in chunks:
+        lines = chunk.splitlines(True)
+        if len(partial) and len(lines):
+            # Only rejoin the partial line once this chunk could complete it
+            if len(lines) == 1 and not _is_complete_line(lines[0]) and not partial[-1].endswith("\r"):
+                partial.append(chunk)
+                partial_length += len(chunk)
+                if max_length is not None and partial_length >= max_length and not chunk.endswith("\r"):
+                    yield "".join(partial)
+                    partial = []
+                    partial_length = 0
+                continue
+            lines[:1] = ("".join(partial) + lines[0]).splitlines(True)
+            partial = []
+            partial_length = 0
+        if len(lines) and not _is_complete_line(lines[-1]):
+            partial.append(lines.pop())
+            partial_length = len(partial[-1])
+        for line in lines:
+            yield line.splitlines()[0]
+    if len(partial):
+        yield from "".join(partial).splitlines()
+
+def expand_targets(value):
+    """
+    Expand a target specification into a list of targets. Comma separated lists, CIDR ranges
+    (e.g. 10.0.0.0/24) and files containing one target per line (e.g. @hosts.txt) are supported.
+    """
+    if not isinstance(value, str):
+        return [value]
+    targets = []
+    for target in value.split(","):
+        target = target.strip()
+        if len(target) == 0:
+            continue
+        if target.startswith("@"):
+            try:
+                with open(target[1:]) as f:
+                    lines = [x.strip() for x in f.readlines()]
+            except OSError:
+                raise ArgsException("Unable to read targets file '{}'".format(target[1:]))
+            for line in lines:
+                if len(line) and not line.startswith("#"):
+                    targets.extend(expand_targets(line))
+        elif "/" in target:
+            try:
+                network = ipaddress.ip_network(target, strict=False)
+            except ValueError:
+                targets.append(target)
+                continue
+            targets.extend([str(x) for x in network.hosts()] or [str(network.network_address)])
+        else:
+            targets.append(target)
+    return targets
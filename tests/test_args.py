@@ -0,0 +1,87 @@
+import tracemalloc
+
+import pytest
+
+from lib.base import CmdArgument, CmdBase, CmdRunnerException
+from lib.encoders.ssh import SSHEncoder
+from lib.utils import ArgsException, get_args
+
+class Base(CmdBase):
+    host = CmdArgument(arg_type=str, description="Host")
+    port = CmdArgument(default=22, description="Port")
+
+class Derived(Base):
+    __slots__ = ("_state",)
+    verbose = CmdArgument(default=False, description="Verbose")
+    user = CmdArgument(arg_type=str, default=None, required=False, description="User")
+
+def test_schema():
+    # Compiled once when the class is defined, inherited arguments first in definition order
+    assert list(Base._arguments) == ["host", "port"]
+    assert Derived._argument_names == ("host", "port", "verbose", "user")
+    assert Derived._defaults == {"port" : 22, "verbose" : False, "user" : None}
+    assert [x.required for x in Derived._arguments.values()] == [True, False, False, False]
+    # The CmdArguments are replaced by slots
+    assert Derived.__slots__ == ("verbose", "user", "_state") and not hasattr(Derived("host"), "__dict__")
+
+def test_constructor():
+    instance = Derived("host", 2222, user="user")
+    assert [instance.host, instance.port, instance.verbose, instance.user] == ["host", 2222, False, "user"]
+    assert Derived(host="host", verbose=True).save() == {"__classname__" : "Derived", "host" : "host", "port" : 22, "verbose" : True, "user" : None}
+    # None is accepted for an argument defaulting to None
+    assert Derived("host", user=None).user is None
+
+@pytest.mark.parametrize("args, kwargs, message", [
+    ([], {}, "Missing required argument 'host'"),
+    (["host", 22, False, None, 1], {}, "Constructor takes 4 positional arguments but 5 were given"),
+    (["host"], {"password" : "password"}, "Constructor got an unexpected keyword argument 'password'"),
+    (["host"], {"host" : "host"}, "Argument repeated 'host' value 'host'"),
+    (["host", "22"], {}, "Incorrect argument type for argument 'port', expecting 'int' receivied 'str'"),
+])
+def test_invalid(args, kwargs, message):
+    with pytest.raises(TypeError) as e:
+        Derived(*args, **kwargs)
+    assert str(e.value) == message
+
+def test_invalid_argument():
+    with pytest.raises(CmdRunnerException, match="Must specify a type"):
+        CmdArgument()
+    with pytest.raises(CmdRunnerException, match="Unsupported argument type"):
+        CmdArgument(default=[])
+
+def test_save_load():
+    instance = Derived("host", user="user")
+    assert Derived.load(instance.save()).save() == instance.save()
+    assert instance.get_instance() == "Derived\n\thost: host\n\tport: 22\n\tverbose: False\n\tuser: user"
+    assert Derived.get_args().splitlines()[0] == "Derived [--port=<int>] [--verbose=<bool>] [--user=<str>] <host>"
+
+def test_memory():
+    # Fan out creates an instance per target, which only hold their argument values
+    tracemalloc.start()
+    try:
+        encoders = [SSHEncoder("user", "host{}".format(x)) for x in range(10000)]
+        size = tracemalloc.get_traced_memory()[0] / len(encoders)
+    finally:
+        tracemalloc.stop()
+    assert size < 250
+
+@pytest.mark.parametrize("argument_string, expected", [
+    ("", ([], {})),
+    ("{\"host\": \"host\", \"port\": 22}", ([], {"host" : "host", "port" : 22})),
+    ("(\"user\", \"host\", multiplex=True)", (["user", "host"], {"multiplex" : True})),
+    ("user host --multiplex=true --port 2222", (["user", "host"], {"multiplex" : True, "port" : 2222})),
+    ("user host multiplex=True identity=None", (["user", "host"], {"multiplex" : True, "identity" : None})),
+    ("user \"a b\" --port=-1", (["user", "a b"], {"port" : -1})),
+])
+def test_get_args(argument_string, expected):
+    assert get_args(argument_string) == expected
+
+def test_get_args_invalid():
+    with pytest.raises(ArgsException, match="Invalid keyword name"):
+        get_args("--1x=2")
+
+def test_get_args_construct():
+    # Each form builds the same instance
+    for argument_string in ["host --port=2222 --user=user", "(\"host\", 2222, user=\"user\")", "{\"host\": \"host\", \"port\": 2222, \"user\": \"user\"}"]:
+        args, kwargs = get_args(argument_string)
+        assert Derived(*args, **kwargs).save() == Derived("host", 2222, user="user").save()
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+from lib.base import CmdDecoder, CmdRunner, execute, execute_async, execute_batch_async
+from lib.encoders.ssh import SSHEncoder
+from lib.runners.bash import BashRunner
+from lib.runners.echo import EchoRunner
+
+class UpperDecoder(CmdDecoder):
+    def decode(self, cmd):
+        return cmd.upper()
+
+class BlockingRunner(CmdRunner):
+    # A third party runner with only a blocking run()
+    def run(self, cmd):
+        time.sleep(0.2)
+        self.exit_status = len(cmd)
+        return cmd
+
+def get_session(runner):
+    return {"runner" : runner, "encoders" : [], "decoders" : []}
+
+def test_equivalent():
+    session = {"runner" : EchoRunner(), "encoders" : [SSHEncoder("user", "host0"), SSHEncoder("user", "host1")], "decoders" : [UpperDecoder()]}
+    assert asyncio.run(execute_async("echo \"$HOME\"", session)) == execute("echo \"$HOME\"", session)
+
+def test_concurrent(monkeypatch):
+    # Waited on natively by the event loop rather than with the blocking run() in the executor
+    monkeypatch.setattr(BashRunner, "run", None)
+    session = get_session(BashRunner())
+    async def run():
+        return await asyncio.gather(*[execute_async("sleep 0.5; echo {}".format(x), session) for x in range(50)])
+    starttime = time.monotonic()
+    assert asyncio.run(run()) == ["{}\n".format(x) for x in range(50)]
+    # All in flight at once
+    assert time.monotonic() - starttime < 2
+
+def test_fallback():
+    # Blocking runners are run in the executor, with the exit status of each kept per task
+    runner = BlockingRunner()
+    async def run(cmd):
+        return await execute_async(cmd, get_session(runner)), runner.exit_status
+    async def run_all():
+        return await asyncio.gather(*[run("x" * x) for x in range(1, 5)])
+    starttime = time.monotonic()
+    assert asyncio.run(run_all()) == [("x" * x, x) for x in range(1, 5)]
+    assert time.monotonic() - starttime < 0.6
+
+def test_batch():
+    cmds = ["echo {}; exit {}".format(x, x % 2) for x in range(10)]
+    async def run():
+        results = []
+        async for cmd, output, error, elapsed in execute_batch_async(cmds, get_session(BashRunner()), workers=3):
+            results.append((cmd, output.getvalue(), error is None))
+            output.close()
+        return results
+    # In input order, with the commands exiting with a non zero status having both output and an error
+    assert asyncio.run(run()) == [(x, "{}\n".format(y), y % 2 == 0) for y, x in enumerate(cmds)]
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from lib.base import CancelScope, execute, execute_stream
+from lib.runners.bash import BashRunner
+
+IGNORE_SIGTERM = "python3 -c 'import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); print(\"started\", flush=True); time.sleep(30)'"
+
+@pytest.fixture
+def runner():
+    runner = BashRunner()
+    runner.timeout = 1
+    runner.kill_timeout = 1
+    return runner
+
+@pytest.mark.parametrize("cmd, output, status", [
+    ("echo out; echo err >&2", "out\nerr\n", 0),
+    ("printf x; exit 3", "x", 3),
+    ("kill -9 $$", "", -9),
+])
+def test_run(runner, cmd, output, status):
+    assert runner.run(cmd) == output
+    assert runner.exit_status == status
+
+def test_large_output(runner):
+    # Much more than a pipe buffer, read while the command is still writing it
+    runner.timeout = 10
+    assert runner.run("head -c 10000000 /dev/zero") == "\0" * 10000000
+    assert runner.exit_status == 0
+
+def test_binary(runner):
+    output = runner.run("printf '\\xff\\xfe\\x00abc'")
+    assert output == "\udcff\udcfe\0abc" and output.encode(errors="surrogateescape") == b"\xff\xfe\0abc"
+
+def test_stream(runner):
+    # Chunks arrive as they are written, before the command completes
+    times = []
+    starttime = time.monotonic()
+    for chunk in runner.run_stream("echo first; sleep 0.5; echo second"):
+        if chunk:
+            times.append((chunk, time.monotonic() - starttime))
+    assert "".join(x for x, _ in times) == "first\nsecond\n"
+    assert times[0][0] == "first\n" and times[0][1] < 0.4
+
+def test_stream_split_character(runner):
+    # A multi-byte character written in two pieces is decoded once complete
+    chunks = list(runner.run_stream("printf '\\xe2\\x82'; sleep 0.2; printf '\\xac\\xff'"))
+    assert "".join(chunks) == "€\udcff"
+
+@pytest.mark.parametrize("cmd", ["sleep 30", IGNORE_SIGTERM])
+def test_timeout(runner, cmd, capsys):
+    starttime = time.monotonic()
+    output = runner.run(cmd)
+    # SIGTERM after the timeout, then SIGKILL kill_timeout seconds later if it is ignored
+    elapsed = time.monotonic() - starttime
+    assert elapsed < 1.9 if cmd == "sleep 30" else 1.9 < elapsed < 4
+    assert runner.exit_status in (-15, -9, 143, 137)
+    assert "[!] Command timed out" in capsys.readouterr().out
+    if cmd == IGNORE_SIGTERM:
+        assert output == "started\n"
+
+def test_orphaned_output(runner):
+    # A background process holding the output pipe open is killed with the command's group
+    starttime = time.monotonic()
+    assert runner.run("(sleep 30; echo late) & echo done") == "done\n"
+    assert time.monotonic() - starttime < 4
+
+async def run_async(runner, cmd):
+    # The exit status is kept per task
+    output = await runner.run_async(cmd)
+    return output, runner.exit_status
+
+def test_run_async(runner):
+    async def run():
+        return await asyncio.gather(*[run_async(runner, "echo {}; exit {}".format(x, x)) for x in range(3)])
+    assert asyncio.run(run()) == [("0\n", 0), ("1\n", 1), ("2\n", 2)]
+
+def test_run_async_timeout(runner, capsys):
+    starttime = time.monotonic()
+    assert asyncio.run(run_async(runner, "echo before; " + IGNORE_SIGTERM)) == ("before\nstarted\n", -9)
+    assert 1.9 < time.monotonic() - starttime < 4
+    assert "[!] Command timed out" in capsys.readouterr().out
+
+def test_cancel(runner):
+    runner.timeout = 30
+    session = {"runner" : runner, "encoders" : [], "decoders" : []}
+    with CancelScope() as scope:
+        threading.Timer(0.5, scope.cancel).start()
+        starttime = time.monotonic()
+        chunks = list(execute_stream("echo before; sleep 30; echo after", session))
+    assert "".join(chunks) == "before\n" and time.monotonic() - starttime < 2
+    assert scope.stopped and runner.exit_status == -9
+    # A command run after the scope is cancelled is stopped straight away
+    with scope:
+        execute("sleep 30", session)
+    assert runner.exit_status == -9
@@ -0,0 +1,71 @@
+import os
+import re
+import subprocess
+import sys
+import time
+
+import pytest
+
+import cmdrunner
+
+from lib.base import CmdRunnerException
+from lib.runners.bash import BashRunner
+
+@pytest.fixture
+def session():
+    return {"runner" : BashRunner(), "encoders" : [], "decoders" : [], "workers" : 4}
+
+@pytest.fixture
+def command_file(tmp_path):
+    path = tmp_path / "commands.txt"
+    # The first command finishes last, but is still printed first
+    path.write_text("# recon\nsleep 0.5; echo first\n\necho second\n  printf 'two\\nlines'; exit 2\n")
+    return str(path)
+
+def check_output(output):
+    assert re.match("".join([
+        r"\[1/3\] sleep 0.5; echo first \(ok, 0.[0-9]+s\)\n<<< first\n",
+        r"\[2/3\] echo second \(ok, 0.[0-9]+s\)\n<<< second\n",
+        r"\[3/3\] printf 'two\\nlines'; exit 2 \(failed: exit status 2, 0.[0-9]+s\)\n<<< two\n<<< lines\n",
+        r"Ran 3 commands, 1 failed, in [0-9.]+s\n$",
+    ]), output), output
+
+def test_batch(session, command_file, capsys):
+    cmdrunner.BatchCmd.run(command_file, session)
+    check_output(capsys.readouterr().out)
+
+def test_output_file(session, command_file, tmp_path, capsys):
+    output_file = str(tmp_path / "output.txt")
+    cmdrunner.BatchCmd.run("2 {} {}".format(command_file, output_file), session)
+    # Only the summary is printed
+    summary = capsys.readouterr().out
+    with open(output_file) as f:
+        check_output(f.read() + summary)
+
+def test_concurrent(session, tmp_path, capsys):
+    path = tmp_path / "sleep.txt"
+    path.write_text("sleep 0.5\n" * 8)
+    starttime = time.monotonic()
+    cmdrunner.BatchCmd.run("8 {}".format(path), session)
+    # Roughly the latency of one command rather than the sum of all of them
+    assert time.monotonic() - starttime < 2
+    assert "Ran 8 commands, 0 failed" in capsys.readouterr().out
+
+@pytest.mark.parametrize("args, error", [
+    ("", "requires arguments"),
+    ("0 commands.txt", "Invalid number of workers '0'"),
+    ("missing.txt", "Command file 'missing.txt' does not exist"),
+])
+def test_invalid(session, args, error):
+    with pytest.raises(CmdRunnerException, match=error):
+        cmdrunner.BatchCmd.run(args, session)
+
+def test_cli(command_file, tmp_path):
+    output_file = str(tmp_path / "output.txt")
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "cmdrunner.py", "--batch", command_file, "--workers", "2", "--output", output_file], cwd=cwd, capture_output=True, text=True)
+    assert result.returncode == 0
+    with open(output_file) as f:
+        check_output(f.read() + result.stdout.splitlines(True)[-1])
+    result = subprocess.run([sys.executable, "cmdrunner.py", "--batch", str(tmp_path / "missing.txt")], cwd=cwd, capture_output=True, text=True)
+    assert result.returncode == 1 and "does not exist" in result.stdout
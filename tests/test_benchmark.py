@@ -0,0 +1,71 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench", "benchmark.py")
+
+@pytest.fixture(scope="module")
+def benchmark():
+    spec = importlib.util.spec_from_file_location("benchmark", PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module._register_chains(module.PAYLOAD_SIZES)
+    return module
+
+def run(*args):
+    return subprocess.run([sys.executable, PATH, "--filter", "args.get_args.json", "--min-time", "0.01", "--min-repeat", "2", *args], capture_output=True, text=True)
+
+def write_baseline(path, seconds):
+    with open(path, "w") as f:
+        json.dump({"results" : {"args.get_args.json" : {"min" : seconds}, "bash.latency" : {"min" : 1}}}, f)
+
+def test_baseline(benchmark):
+    # Every stored baseline is still a benchmark
+    names = [x[0] for x in benchmark.BENCHMARKS]
+    with open(benchmark.BASELINE_PATH) as f:
+        assert sorted(json.load(f)["results"]) == sorted(names)
+    assert "execute.ssh5_wmic_powershell.10000000" in names and len(names) == len(set(names))
+
+def test_measure(benchmark):
+    calls = []
+    times = benchmark.measure(lambda: calls.append(None), 0, 10)
+    # After a warm up call
+    assert len(times) == 10 and len(calls) == 11
+
+def test_compare(benchmark):
+    baseline = {"a" : {"min" : 1.0}, "b" : {"min" : 1.0}}
+    results = {"a" : {"min" : 1.2}, "b" : {"min" : 1.3}, "c" : {"min" : 5.0}}
+    assert benchmark.compare(results, baseline, 0.25) == ["b"]
+    assert benchmark.compare(results, baseline, 0.1) == ["a", "b"]
+
+def test_output(tmp_path):
+    result = run("--output", "-", "--baseline", str(tmp_path / "missing.json"))
+    assert result.returncode == 0, result.stderr
+    output = json.loads(result.stdout)
+    assert list(output["results"]) == ["args.get_args.json"]
+    assert output["results"]["args.get_args.json"]["repeat"] >= 2
+
+def test_regression(tmp_path):
+    path = str(tmp_path / "baseline.json")
+    write_baseline(path, 1)
+    assert run("--baseline", path).returncode == 0
+    # Much faster than is possible
+    write_baseline(path, 1e-12)
+    result = run("--baseline", path)
+    assert result.returncode == 1 and "REGRESSION" in result.stderr
+
+def test_save_baseline(tmp_path):
+    path = str(tmp_path / "baseline.json")
+    write_baseline(path, 1e-12)
+    # Regressions are only stored when forced, and filtered out benchmarks are kept
+    assert run("--baseline", path, "--save-baseline").returncode == 0
+    with open(path) as f:
+        assert json.load(f)["results"] == {"args.get_args.json" : {"min" : 1e-12}, "bash.latency" : {"min" : 1}}
+    assert run("--baseline", path, "--save-baseline", "--force").returncode == 0
+    with open(path) as f:
+        results = json.load(f)["results"]
+    assert results["args.get_args.json"]["min"] > 1e-12 and results["bash.latency"] == {"min" : 1}
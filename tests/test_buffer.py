@@ -0,0 +1,77 @@
+import random
+
+import pytest
+
+import cmdrunner
+import lib.buffer
+
+from lib.base import execute_batch
+from lib.runners.bash import BashRunner
+
+# Multi-byte and surrogate escaped characters, which must survive being spilled
+ALPHABET = "ab\né€\U0001f600\udcff"
+
+def get_text(size, seed=0):
+    rng = random.Random(seed)
+    return "".join(rng.choice(ALPHABET) for _ in range(size))
+
+def get_buffer(text, threshold, chunk_size=7):
+    buffer = lib.buffer.OutputBuffer(threshold=threshold)
+    for index in range(0, len(text), chunk_size):
+        buffer.write(text[index:index + chunk_size])
+    return buffer
+
+@pytest.mark.parametrize("threshold", [1 << 20, 100])
+def test_buffer(threshold, tmp_path):
+    text = get_text(5000)
+    buffer = get_buffer(text, threshold)
+    assert buffer.spilled == (threshold == 100)
+    assert len(buffer) == len(text) and buffer.getvalue() == text
+    # Decoded in small pieces, splitting multi-byte characters
+    assert "".join(buffer.iter_chunks(chunk_size=3)) == text
+    lines = text.splitlines(True)
+    for count in [0, 1, 5, len(lines), len(lines) + 1]:
+        assert buffer.head(count) == "".join(lines[:count])
+        assert buffer.tail(count) == ("".join(lines[-count:]) if count else "")
+    for count in [0, 1, 10, 6000]:
+        assert buffer.head_chars(count) == text[:count]
+        assert buffer.tail_chars(count) == (text[-count:] if count else "")
+    buffer.save(str(tmp_path / "output"))
+    assert (tmp_path / "output").read_bytes() == text.encode(errors="surrogateescape")
+    # Writing after a read carries on from the end
+    buffer.write("end")
+    assert buffer.getvalue() == text + "end"
+    buffer.close()
+
+def test_truncate():
+    text = get_text(1000)
+    buffer = get_buffer(text, 100)
+    assert buffer.getvalue(100) == lib.buffer.truncate(text, 100)
+    assert buffer.getvalue(100).startswith(text[:50]) and buffer.getvalue(100).endswith(text[-50:])
+    assert "[... 900 characters truncated ...]" in buffer.getvalue(100)
+    assert buffer.getvalue(2000) == text
+
+def test_empty():
+    buffer = lib.buffer.OutputBuffer(threshold=0)
+    buffer.write("")
+    assert buffer.getvalue() == "" and buffer.tail(5) == "" and buffer.head(5) == "" and buffer.tail_chars(5) == ""
+
+def test_tee():
+    buffer = lib.buffer.OutputBuffer(threshold=10)
+    assert list(buffer.tee(["abc", "defghijkl", "mn"])) == ["abc", "defghijkl", "mn"]
+    assert buffer.spilled and buffer.getvalue() == "abcdefghijklmn"
+
+@pytest.fixture
+def session():
+    return {"runner" : BashRunner(), "encoders" : [], "decoders" : []}
+
+def test_batch(session):
+    results = list(execute_batch(["seq 3", "printf x; exit 2"], session, workers=2))
+    assert [(x[0], x[1].getvalue()) for x in results] == [("seq 3", "1\n2\n3\n"), ("printf x; exit 2", "x")]
+    assert results[0][2] is None and str(results[1][2]) == "exit status 2"
+
+def test_last_output(session, capsys):
+    cmdrunner.LastOutputCmd.run("display tail 2", session)
+    cmdrunner.LastOutputCmd.print_output(iter(["1\n2", "\n3\n", "4"]), session)
+    assert capsys.readouterr().out == "[... 2 earlier lines, see $last_output ...]\n<<< 3\n<<< 4\n"
+    assert session["last_output"].getvalue() == "1\n2\n3\n4"
@@ -0,0 +1,94 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import lib.cache
+
+from lib.base import execute, execute_async
+from lib.encoders.ssh import SSHEncoder
+from lib.runners.bash import BashRunner
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = lib.cache.ResultCache(str(tmp_path / "cache.sqlite"), ttl=60)
+    yield cache
+    cache.close()
+
+@pytest.fixture
+def session(cache, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return {"runner" : BashRunner(), "encoders" : [], "decoders" : [], "cache" : cache}
+
+def test_hit(session, cache):
+    # The counter file changes on every run, so a second run only returns 1 if it was cached
+    assert execute("echo x >> count; wc -l < count", session) == "1\n"
+    assert execute("echo x >> count; wc -l < count", session) == "1\n"
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert session["runner"].exit_status == 0
+
+def test_ttl(session, cache):
+    cache.ttl = 0
+    execute("echo x >> count; wc -l < count", session)
+    assert execute("echo x >> count; wc -l < count", session) == "2\n"
+    assert cache.entries() == []
+
+def test_fingerprint(session, cache):
+    # Changing any runner or encoder argument misses the cached result
+    execute("echo a", session)
+    session["runner"].timeout = 10
+    execute("echo a", session)
+    assert (cache.hits, cache.misses) == (0, 2)
+    key = cache.get_key("echo a", session)
+    assert key != cache.get_key("echo a", {**session, "encoders" : [SSHEncoder("user", "host")]})
+
+@pytest.mark.parametrize("cmd", ["echo failed; exit 3", "kill -9 $$"])
+def test_failure_not_cached(session, cache, cmd):
+    execute(cmd, session)
+    assert session["runner"].exit_status != 0
+    assert cache.entries() == []
+
+def test_status_restored(session, cache):
+    key = cache.get_key("false", session)
+    cache.set(key, "false", "", 1)
+    session["runner"].exit_status = None
+    assert execute("false", session) == ""
+    assert session["runner"].exit_status == 1
+
+def test_flush(session, cache):
+    execute("echo a", session)
+    execute("echo b", session)
+    assert cache.flush("echo a") == 1
+    assert [x[0] for x in cache.entries()] == ["echo b"]
+    assert cache.flush() == 1
+
+def test_eviction(cache):
+    cache.max_size = 10
+    cache.set("a", "a", "x" * 6)
+    time.sleep(0.01)
+    cache.set("b", "b", "x" * 6)
+    # The least recently used entry is evicted, and output larger than the cache is not stored
+    assert cache.get("a") is None and cache.get("b") == ("x" * 6, None)
+    cache.set("c", "c", "x" * 11)
+    assert cache.get("c") is None
+
+def test_async(session, cache):
+    cache.max_size = 4
+    assert asyncio.run(execute_async("echo 1234", session)) == "1234\n"
+    assert asyncio.run(execute_async("echo 12", session)) == "12\n"
+    assert asyncio.run(execute_async("echo fail; exit 1", session)) == "fail\n"
+    assert [x[0] for x in cache.entries()] == ["echo 12"]
+
+def test_old_schema(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE results (key TEXT PRIMARY KEY, cmd TEXT, output BLOB, size INTEGER, created REAL, expires REAL, accessed REAL)")
+    db.execute("INSERT INTO results VALUES ('a', 'a', x'00', 1, 0, 1e12, 0)")
+    db.commit()
+    db.close()
+    cache = lib.cache.ResultCache(path)
+    assert cache.get("a") is None
+    cache.set("a", "a", "out", 0)
+    assert cache.get("a") == ("out", 0)
+    cache.close()
@@ -0,0 +1,150 @@
+import os
+import time
+
+import pytest
+
+import cmdrunner
+
+from lib.base import CmdRunnerException, get_fingerprint
+from lib.completion import MARKER, PathCompleter
+from lib.encoders.ssh import SSHEncoder
+from lib.encoders.wincmd import WinCmdEncoder
+from lib.runners.bash import BashRunner
+from lib.runners.echo import EchoRunner
+
+class RecordingRunner(BashRunner):
+    # Records each command run, taking delay seconds to run each
+    cmds = []
+    delay = 0
+
+    def run_stream(self, cmd):
+        RecordingRunner.cmds.append(cmd)
+        time.sleep(RecordingRunner.delay)
+        return super().run_stream(cmd)
+
+@pytest.fixture
+def session():
+    RecordingRunner.cmds = []
+    RecordingRunner.delay = 0
+    return {"runner" : RecordingRunner(), "encoders" : [], "decoders" : []}
+
+@pytest.fixture
+def tree(tmp_path):
+    for path in ["alpha/one", "alpha/two", "beta", "it's here", "a b"]:
+        (tmp_path / path).mkdir(parents=True)
+    for path in ["apple.txt", "alpha/file.txt", "Archive.zip"]:
+        (tmp_path / path).write_text("")
+    return str(tmp_path)
+
+def wait_matches(completer, text, timeout=10):
+    endtime = time.monotonic() + timeout
+    while time.monotonic() < endtime:
+        matches = completer.get_matches(text)
+        if len(matches):
+            return matches
+        time.sleep(0.01)
+    return []
+
+def wait_cached(completer, count, timeout=10):
+    endtime = time.monotonic() + timeout
+    while len(completer._listings) < count and time.monotonic() < endtime:
+        time.sleep(0.01)
+    return len(completer._listings)
+
+def test_complete(session, tree):
+    completer = PathCompleter(session)
+    # Directories end in a separator to carry on completing, files in a space
+    assert wait_matches(completer, tree + "/a") == [tree + x for x in ["/a b/", "/alpha/", "/apple.txt "]]
+    assert completer.get_matches(tree + "/it") == [tree + "/it's here/"]
+    assert completer.get_matches(tree + "/A") == [tree + "/Archive.zip "]
+    assert completer.get_matches(tree + "/z") == []
+    assert [completer.complete(tree + "/al", x) for x in range(2)] == [tree + "/alpha/", None]
+
+def test_cached(session, tree):
+    completer = PathCompleter(session)
+    wait_matches(completer, tree + "/")
+    count = len(RecordingRunner.cmds)
+    # Answered from the cache without running anything, well within the time of a keystroke
+    starttime = time.perf_counter()
+    for _ in range(100):
+        assert completer.get_matches(tree + "/al") == [tree + "/alpha/"]
+    assert (time.perf_counter() - starttime) / 100 < 0.05
+    assert len(RecordingRunner.cmds) == count
+
+def test_prefetch(session, tree):
+    completer = PathCompleter(session)
+    wait_matches(completer, tree + "/")
+    # The subdirectories are listed before the completion descends into them
+    assert wait_cached(completer, 5) == 5
+    RecordingRunner.delay = 10
+    assert completer.get_matches(tree + "/alpha/") == [tree + x for x in ["/alpha/file.txt ", "/alpha/one/", "/alpha/two/"]]
+    assert completer.get_matches(tree + "/it's here/") == []
+    # Only listings which were asked for are prefetched from
+    assert not any("/alpha/one" in x for x in RecordingRunner.cmds)
+
+def test_slow(session, tree):
+    completer = PathCompleter(session)
+    RecordingRunner.delay = 0.5
+    # A slow listing is not waited for
+    starttime = time.perf_counter()
+    assert completer.get_matches(tree + "/be") == []
+    assert time.perf_counter() - starttime < 0.3
+    assert wait_matches(completer, tree + "/be") == [tree + "/beta/"]
+    # Only fetched once, however many keystrokes there were while it was pending
+    assert len([x for x in RecordingRunner.cmds if x.endswith("{}/' 2>/dev/null".format(tree))]) == 1
+
+def test_expiry(session, tree):
+    completer = PathCompleter(session, ttl=0.2, prefetch=0)
+    wait_matches(completer, tree + "/")
+    os.mkdir(tree + "/gamma")
+    assert completer.get_matches(tree + "/g") == []
+    time.sleep(0.3)
+    assert wait_matches(completer, tree + "/g") == [tree + "/gamma/"]
+
+def test_lru(session, tree):
+    completer = PathCompleter(session, max_entries=2, prefetch=0)
+    wait_matches(completer, tree + "/alpha/o")
+    completer.get_matches(tree + "/beta/")
+    wait_cached(completer, 2)
+    # The least recently used listing is dropped, which is beta once alpha is used again
+    assert completer.get_matches(tree + "/alpha/t") == [tree + "/alpha/two/"]
+    wait_matches(completer, tree + "/b")
+    assert [x[1] for x in completer._listings] == [tree + "/alpha/", tree + "/"]
+
+def test_windows():
+    # Windows listings are matched case insensitively, with the directories marked
+    session = {"runner" : EchoRunner(), "encoders" : [WinCmdEncoder()], "decoders" : []}
+    completer = PathCompleter(session)
+    entries = completer.parse_listing("cmd", "{0}\r\nProgram Files\r\n{0}\r\nUsers\r\nboot.ini\r\n".format(MARKER))
+    assert entries == {"Program Files" : True, "Users" : True, "boot.ini" : False}
+    completer._listings[(get_fingerprint(session), "C:\\")] = (time.monotonic() + 30, entries)
+    assert completer.get_matches("C:\\pro") == ["C:\\Program Files\\"]
+    assert completer.get_matches("C:\\B") == ["C:\\boot.ini "]
+    assert completer.get_listing_cmd("cmd", "C:\\") == "(for /D %d in (\"C:\\*\") do @(echo {0}& echo %~nxd)) & for %f in (\"C:\\*\") do @echo %~nxf".format(MARKER)
+
+def test_session_change(session, tree):
+    completer = PathCompleter(session)
+    wait_matches(completer, tree + "/")
+    # Listings are kept per encoder chain, so another chain has to list the directory itself
+    session["encoders"].append(SSHEncoder("user", "host"))
+    RecordingRunner.delay = 10
+    assert completer.get_matches(tree + "/") == []
+
+def test_fanout(session):
+    session["encoders"] = [SSHEncoder("user", "web1,web2")]
+    assert PathCompleter(session).get_matches("/") == [] and RecordingRunner.cmds == []
+
+def test_cmd(session, capsys):
+    with pytest.raises(CmdRunnerException, match="not being completed"):
+        cmdrunner.CompletionCmd.run("", session)
+    with pytest.raises(CmdRunnerException, match="Invalid ttl 'x'"):
+        cmdrunner.CompletionCmd.run("on x", session)
+    cmdrunner.CompletionCmd.run("on 5", session)
+    completer = session["completion"]
+    completer._listings["key"] = (time.monotonic() + 5, {})
+    cmdrunner.CompletionCmd.run("", session)
+    assert capsys.readouterr().out == "Completion: 1 cached listings (ttl 5s)\n"
+    cmdrunner.CompletionCmd.run("flush", session)
+    assert len(completer._listings) == 0
+    cmdrunner.CompletionCmd.run("off", session)
+    assert session["completion"] is None
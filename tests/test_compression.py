@@ -0,0 +1,98 @@
+import base64
+import gzip
+import random
+import zlib
+
+import pytest
+
+from lib.base import CmdRunnerException, execute
+from lib.decoders.compression import Base64Decoder, GzipBase64Decoder, GzipDecoder, ZlibDecoder
+from lib.encoders.compress import CompressEncoder
+from lib.runners.bash import BashRunner
+
+TEXT = "".join("drwxr-xr-x 2 root root 4096 Jan {} 12:00 dir{} é中\U0001f600\n".format(x % 28, x) for x in range(500))
+
+def to_text(data):
+    # As runners return binary output
+    return data.decode("utf-8", "surrogateescape")
+
+def raw_deflate(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+FORMATS = {
+    "base64" : (Base64Decoder, lambda x: base64.b64encode(x).decode()),
+    "gzip" : (GzipDecoder, lambda x: to_text(gzip.compress(x))),
+    "zlib" : (ZlibDecoder, lambda x: to_text(raw_deflate(x))),
+    "gzip+base64" : (GzipBase64Decoder, lambda x: base64.b64encode(gzip.compress(x)).decode()),
+}
+
+def split(text, seed, max_size):
+    rng = random.Random(seed)
+    chunks = []
+    index = 0
+    while index < len(text):
+        size = rng.randint(0, max_size)
+        chunks.append(text[index:index + size])
+        index += size
+    return chunks
+
+@pytest.mark.parametrize("name", sorted(FORMATS))
+def test_decode_stream(name):
+    decoder, encode = FORMATS[name]
+    encoded = encode(TEXT.encode())
+    assert decoder().decode(encoded) == TEXT
+    # Chunks split base64 groups, compressed blocks and multibyte characters anywhere
+    for seed, max_size in enumerate([1, 3, 7, 100, 5000]):
+        assert "".join(decoder().decode_stream(split(encoded, seed, max_size))) == TEXT
+
+@pytest.mark.parametrize("name", sorted(FORMATS))
+def test_empty(name):
+    decoder, encode = FORMATS[name]
+    assert decoder().decode("") == ""
+    assert "".join(decoder().decode_stream(iter([]))) == ""
+    assert decoder().decode(encode(b"")) == ""
+
+def test_incremental():
+    # Output is decoded as it arrives rather than once the whole stream has been read
+    encoded = base64.b64encode(gzip.compress(TEXT.encode())).decode()
+    stream = GzipBase64Decoder().decode_stream(iter(split(encoded, 0, 64)))
+    decoded = next(x for x in stream if len(x))
+    assert 0 < len(decoded) < len(TEXT) and TEXT.startswith(decoded)
+
+def test_base64_wrapped():
+    # Line wrapped and unpadded base64, as from base64 without -w0
+    encoded = base64.b64encode(TEXT.encode()).decode().rstrip("=")
+    wrapped = "\r\n".join(encoded[x:x + 76] for x in range(0, len(encoded), 76))
+    assert "".join(Base64Decoder().decode_stream(split(wrapped, 0, 50))) == TEXT
+
+def test_zlib_header():
+    # Streams with a zlib header are detected as well as raw deflate
+    encoded = to_text(zlib.compress(TEXT.encode()))
+    assert ZlibDecoder().decode(encoded) == TEXT
+    assert "".join(ZlibDecoder().decode_stream(split(encoded, 0, 1))) == TEXT
+
+def test_binary():
+    # Invalid UTF-8 in the output survives as surrogate escapes, like uncompressed output
+    data = bytes(range(256)) * 4
+    for name, (decoder, encode) in FORMATS.items():
+        assert decoder().decode(encode(data)) == to_text(data), name
+
+@pytest.mark.parametrize("name", sorted(FORMATS))
+def test_roundtrip(name):
+    cmd = "for i in $(seq 2000); do echo \"-rw-r--r-- 1 root root 4096 Jan 1 12:00 file$i.log\"; done"
+    session = {"runner" : BashRunner(), "encoders" : [], "decoders" : []}
+    expected = execute(cmd, session)
+    compressed = execute(cmd, {**session, "encoders" : [CompressEncoder(format=name)]})
+    decoded = execute(cmd, {**session, "encoders" : [CompressEncoder(format=name)], "decoders" : [FORMATS[name][0]()]})
+    assert decoded == expected
+    if name != "base64":
+        # Repetitive output like directory listings is several times smaller to transfer
+        assert len(compressed.encode("utf-8", "surrogateescape")) * 5 < len(expected)
+
+def test_unsupported():
+    # Binary formats cannot be returned through cmd.exe or powershell
+    with pytest.raises(CmdRunnerException, match="Unsupported format 'gzip' for shell 'cmd'"):
+        CompressEncoder(format="gzip", shell="cmd").encode("dir")
+    with pytest.raises(CmdRunnerException, match="Unsupported format 'lzma'"):
+        CompressEncoder(format="lzma").encode("ls")
@@ -0,0 +1,76 @@
+import random
+
+import pytest
+
+import lib.escape
+
+from lib.base import ExecutionPlan
+from lib.encoders.curl import CurlEncoder
+from lib.encoders.echo import EchoEncoder
+from lib.encoders.powershell import PowerShellEncoder
+from lib.encoders.ssh import SSHEncoder
+from lib.encoders.wincmd import WinCmdEncoder
+from lib.encoders.xpcmdshell import XpCmdShellEncoder
+
+# The replace chains each encoder used before lib.escape, ssh has since also escaped $ and backticks
+REFERENCE = {
+    "CMD" : lambda x: x.replace("^", "^^").replace("&", "^&").replace(">", "^>").replace("(", "^(").replace(")", "^)").replace("|", "^|"),
+    "POSIX_DOUBLE_QUOTE" : lambda x: x.replace("\\", "\\\\").replace("\"", "\\\"").replace("$", "\\$").replace("`", "\\`"),
+    "TSQL" : lambda x: x.replace("'", "''"),
+    "WMIC" : lambda x: x.replace("\"", "\\\""),
+}
+ESCAPES = {
+    WinCmdEncoder : REFERENCE["CMD"],
+    EchoEncoder : REFERENCE["CMD"],
+    SSHEncoder : REFERENCE["POSIX_DOUBLE_QUOTE"],
+    XpCmdShellEncoder : REFERENCE["TSQL"],
+}
+ENCODERS = [
+    lambda: WinCmdEncoder(transport="escape"),
+    EchoEncoder,
+    XpCmdShellEncoder,
+    lambda: SSHEncoder(username="user", host="host", transport="escape"),
+    lambda: PowerShellEncoder(compress=False),
+    lambda: CurlEncoder(url="http://host/", data="cmd=***"),
+]
+ALPHABET = "ab01 ^&<>()|\\\"'`$%;=\n\té中\U0001f600"
+
+def random_strings(seed, count=2000):
+    rand = random.Random(seed)
+    for _ in range(count):
+        yield "".join(rand.choice(ALPHABET) for _ in range(rand.randint(0, 40)))
+
+@pytest.mark.parametrize("name", sorted(REFERENCE))
+def test_dialect(name):
+    escaper = getattr(lib.escape, name)
+    for value in random_strings(name):
+        assert escaper(value) == REFERENCE[name](value)
+
+def test_compose():
+    rand = random.Random(0)
+    names = sorted(REFERENCE)
+    for value in random_strings("compose"):
+        chain = [rand.choice(names) for _ in range(rand.randint(1, 6))]
+        expected = value
+        for name in chain:
+            expected = REFERENCE[name](expected)
+        assert lib.escape.compose([getattr(lib.escape, x) for x in chain])(value) == expected
+
+def test_cyclic_fallback():
+    escaper = lib.escape.Escaper({"a" : "b", "b" : "a"})
+    assert escaper.passes is None
+    assert escaper("abba") == "baab"
+
+def test_plan(monkeypatch):
+    rand = random.Random(0)
+    for index, value in enumerate(random_strings("plan", count=500)):
+        encoders = [rand.choice(ENCODERS)() for _ in range(rand.randint(1, 6))]
+        encoded = ExecutionPlan({"runner" : None, "encoders" : encoders}).encode(value)
+        # Each encoder applied in turn with its original escaping, innermost (last) first
+        with monkeypatch.context() as m:
+            for cls, escape in ESCAPES.items():
+                m.setattr(cls, "escape", lambda self, cmd, escape=escape: escape(cmd))
+            expected = value
+            for encoder in encoders[::-1]:
+                expected = encoder.encode(expected)
+        assert encoded == expected, [x.__class__.__name__ for x in encoders]
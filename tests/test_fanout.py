@@ -0,0 +1,63 @@
+import asyncio
+import os
+import re
+
+import pytest
+
+import cmdrunner
+
+from lib.base import CmdRunnerException, execute, execute_async, get_fanout_sessions
+from lib.encoders.ssh import SSHEncoder
+from lib.runners.bash import BashRunner
+from lib.utils import ArgsException, expand_targets
+
+def test_expand_targets(tmp_path):
+    assert expand_targets("host") == ["host"]
+    assert expand_targets(" web1, web2 ,,") == ["web1", "web2"]
+    assert expand_targets("10.0.0.0/30") == ["10.0.0.1", "10.0.0.2"]
+    assert expand_targets("10.0.0.5/32") == ["10.0.0.5"]
+    # Not a network, e.g. a path
+    assert expand_targets("share/path") == ["share/path"]
+    path = tmp_path / "hosts.txt"
+    path.write_text("# web servers\nweb1\n\nweb2, 10.0.1.0/31\n")
+    assert expand_targets("db1,@{}".format(path)) == ["db1", "web1", "web2", "10.0.1.0", "10.0.1.1"]
+    assert expand_targets(22) == [22]
+    with pytest.raises(ArgsException):
+        expand_targets("@{}".format(tmp_path / "missing.txt"))
+
+def test_quoted_hosts():
+    session = {"runner" : BashRunner(), "encoders" : [], "decoders" : []}
+    cmdrunner.PushEncoder.run("ssh admin \"web1,web2\"", session)
+    cmdrunner.PushEncoder.run("ssh root \"10.0.0.0/30\"", session)
+    labels = [x for x, _ in get_fanout_sessions(session)]
+    assert labels == ["web1 -> 10.0.0.1", "web1 -> 10.0.0.2", "web2 -> 10.0.0.1", "web2 -> 10.0.0.2"]
+    assert get_fanout_sessions({**session, "encoders" : [SSHEncoder("admin", "web1")]}) is None
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    # Fails to connect to hosts whose name contains "bad", otherwise runs the command with sh
+    path = tmp_path / "ssh"
+    path.write_text("#!/bin/sh\nfor cmd; do case \"$cmd\" in *bad*) echo \"connection refused\"; exit 255;; esac; done\nexec sh -c \"$cmd\"\n")
+    path.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}{}{}".format(tmp_path, os.pathsep, os.environ["PATH"]))
+    return {"runner" : BashRunner(), "encoders" : [SSHEncoder("user", "web1,bad1,web2")], "decoders" : [], "workers" : 2}
+
+def check_output(output):
+    assert re.match(r"==> web1 \([0-9.]+s\) <==\nok\n==> bad1 \(failed: exit status 255, [0-9.]+s\) <==\nconnection refused\n==> web2 \([0-9.]+s\) <==\nok\n", output)
+    assert output.endswith("Fan-out complete: 3 targets, 1 failed\n\tbad1\n")
+
+def test_fanout(session):
+    check_output(execute("echo ok", session))
+
+def test_fanout_async(session):
+    check_output(asyncio.run(execute_async("echo ok", session)))
+
+def test_fanout_exit_status(session):
+    session["encoders"] = [SSHEncoder("user", "web1,web2")]
+    output = execute("exit 3", session)
+    assert "failed: exit status 3" in output and output.endswith("2 failed\n\tweb1\n\tweb2\n")
+
+def test_invalid_targets(session, tmp_path):
+    session["encoders"] = [SSHEncoder("user", "@{}".format(tmp_path / "missing.txt"))]
+    with pytest.raises(CmdRunnerException, match="Unable to read targets file"):
+        execute("echo ok", session)
@@ -0,0 +1,84 @@
+import os
+import stat
+import subprocess
+import sys
+
+import pytest
+
+import cmdrunner
+import lib.history
+
+from lib.base import CmdRunnerException, execute
+from lib.runners.bash import BashRunner
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def history(tmp_path):
+    history = lib.history.History(str(tmp_path / "history"), max_output=100)
+    yield history
+    history.close()
+
+@pytest.fixture
+def session(history):
+    return {"runner" : BashRunner(), "encoders" : [], "decoders" : [], "history" : history}
+
+def get_mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+def test_archive(session, history):
+    execute("echo first", session)
+    execute("printf 'second\\nneedle\\n'", session)
+    records = history.recent()
+    assert [x[2] for x in records] == ["printf 'second\\nneedle\\n'", "echo first"]
+    record = history.get(records[0][0])
+    assert record["output"] == "second\nneedle\n" and record["encoded"] == "printf 'second\\nneedle\\n'"
+
+@pytest.mark.parametrize("indexed", [True, False])
+def test_search(session, history, indexed):
+    history.indexed = history.indexed and indexed
+    for x in range(50):
+        execute("echo line{}".format(x), session)
+    execute("echo NeedleInOutput", session)
+    assert [x[2] for x in history.search("needleinoutput")] == ["echo NeedleInOutput"]
+    assert len(history.search("line", limit=5)) == 5
+    # Shorter than a trigram
+    assert [x[2] for x in history.search("49")] == ["echo line49"]
+
+def test_max_output(session, history):
+    execute("seq 1000", session)
+    output = history.get(history.recent()[0][0])["output"]
+    assert len(output) <= 200 and output.startswith("1\n") and output.endswith("1000\n")
+
+def test_permissions(session, history):
+    execute("echo secret", session)
+    history.flush()
+    assert get_mode(history.path) == 0o700
+    names = os.listdir(history.path)
+    assert "index.sqlite" in names and any(x.startswith("segment-") for x in names)
+    for name in names:
+        assert get_mode(os.path.join(history.path, name)) == 0o600, name
+
+def test_existing_permissions(tmp_path):
+    path = tmp_path / "history"
+    path.mkdir(mode=0o755)
+    (path / "segment-000001.log").write_bytes(b"")
+    (path / "segment-000001.log").chmod(0o644)
+    lib.history.History(str(path)).close()
+    assert get_mode(path) == 0o700 and get_mode(path / "segment-000001.log") == 0o600
+
+def test_unwritable(tmp_path):
+    (tmp_path / "file").write_text("")
+    session = {"runner" : BashRunner(), "encoders" : [], "decoders" : []}
+    with pytest.raises(CmdRunnerException, match="Unable to open history"):
+        cmdrunner.HistoryCmd.run("on {}".format(tmp_path / "file" / "history"), session)
+    assert session["history"] is None
+
+def test_startup(tmp_path):
+    # History is off by default, and a home it can't be created in only warns
+    (tmp_path / "file").write_text("")
+    env = {**os.environ, "HOME" : str(tmp_path / "file")}
+    proc = subprocess.run([sys.executable, os.path.join(ROOT, "cmdrunner.py"), "echo", "hi"], env=env, capture_output=True, text=True)
+    assert proc.returncode == 0 and "history" not in proc.stdout
+    proc = subprocess.run([sys.executable, os.path.join(ROOT, "cmdrunner.py"), "--history", "echo", "hi"], env=env, capture_output=True, text=True)
+    assert proc.returncode == 0 and "[!] Unable to open history" in proc.stdout and "hi\n" in proc.stdout
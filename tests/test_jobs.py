@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+import cmdrunner
+import lib.jobs
+
+from lib.base import execute
+from lib.runners.bash import BashRunner, PersistentBashRunner
+
+@pytest.mark.parametrize("runner_cls", [BashRunner, PersistentBashRunner])
+def test_kill(runner_cls):
+    runner = runner_cls()
+    # Without a timeout the command only ends if it is cancelled
+    runner.timeout = None
+    session = {"runner" : runner, "encoders" : [], "decoders" : []}
+    execute("X=kept", session)
+    jobs = lib.jobs.JobManager(1)
+    job = jobs.submit("sleep 60", session, "default")
+    while job.status == "queued":
+        time.sleep(0.01)
+    time.sleep(0.2)
+    jobs.kill(job.id)
+    assert job.finished and job.status == "killed"
+    # The next job only runs once the killed command has stopped and freed the worker
+    starttime = time.monotonic()
+    job = jobs.submit("echo next", session, "default")
+    assert job.wait(10)
+    assert job.output.getvalue() == "next\n"
+    assert time.monotonic() - starttime < 5
+    # A persistent shell is interrupted rather than restarted, keeping its state
+    if runner_cls is PersistentBashRunner:
+        assert execute("echo $X", session) == "kept\n"
+
+def wait_running(jobs, count):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        running = [x for x in jobs.jobs.values() if x.status == "running"]
+        if len(running) >= count:
+            return len(running)
+        time.sleep(0.01)
+    return len(running)
+
+def test_resize():
+    session = {"runner" : BashRunner(), "encoders" : [], "decoders" : []}
+    jobs = lib.jobs.JobManager(1)
+    session["jobs"] = jobs
+    for x in range(3):
+        jobs.submit("sleep 0.5", session, "default")
+    assert wait_running(jobs, 1) == 1
+    # $set_workers resizes the pool of the running jobs
+    cmdrunner.SetWorkersCmd.run("3", session)
+    assert wait_running(jobs, 3) == 3
+    for job in list(jobs.jobs.values()):
+        assert job.wait(10)
+    cmdrunner.SetWorkersCmd.run("1", session)
+    for x in range(3):
+        jobs.submit("sleep 0.3", session, "default")
+    time.sleep(0.2)
+    assert wait_running(jobs, 1) == 1
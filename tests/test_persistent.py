@@ -0,0 +1,78 @@
+import concurrent.futures
+import time
+
+import pytest
+
+from lib.base import execute
+from lib.runners.bash import PersistentBashRunner
+
+IGNORE_SIGINT = "python3 -c 'import signal, time; signal.signal(signal.SIGINT, signal.SIG_IGN); time.sleep(30)'"
+
+@pytest.fixture
+def session():
+    runner = PersistentBashRunner()
+    runner.timeout = 1
+    runner.kill_timeout = 1
+    session = {"runner" : runner, "encoders" : [], "decoders" : []}
+    execute("cd /tmp; export EXPORTED=kept; VARIABLE=kept; f() { echo function kept; }", session)
+    yield session
+    if runner._proc is not None:
+        runner._close_shell()
+
+def check_state(session):
+    assert execute("pwd; echo $EXPORTED $VARIABLE; f", session) == "/tmp\nkept kept\nfunction kept\n"
+
+def test_state(session):
+    pid = session["runner"]._proc.pid
+    check_state(session)
+    assert session["runner"]._proc.pid == pid
+
+@pytest.mark.parametrize("cmd, output, status", [
+    ("true", "", 0),
+    ("echo out; false", "out\n", 1),
+    ("(exit 42)", "", 42),
+    ("printf 'no newline'", "no newline", 0),
+    # Reads /dev/null rather than the shell's command stream
+    ("cat", "", 0),
+])
+def test_exit_status(session, cmd, output, status):
+    assert execute(cmd, session) == output
+    assert session["runner"].exit_status == status
+
+def test_large_output(session):
+    # Long enough for the marker to arrive split across reads
+    output = execute("seq 200000; printf __CMDRUNNER_", session)
+    assert output == "".join("{}\n".format(x) for x in range(1, 200001)) + "__CMDRUNNER_"
+
+def test_exit(session):
+    assert execute("echo bye; exit 3", session) == "bye\n"
+    assert session["runner"].exit_status == 3
+    # A new shell is started for the next command
+    assert execute("pwd", session) != "/tmp\n"
+    assert session["runner"].exit_status == 0
+
+@pytest.mark.parametrize("cmd", ["while :; do :; done", "sleep 30 | cat", IGNORE_SIGINT, "trap '' INT; sleep 30"])
+def test_timeout(session, cmd, capsys):
+    starttime = time.monotonic()
+    execute(cmd, session)
+    assert time.monotonic() - starttime < 5
+    assert session["runner"].exit_status != 0
+    # Interrupting the command, or killing the processes it started, leaves the shell running
+    check_state(session)
+    assert "Restarted the shell" not in capsys.readouterr().out
+    # The trap interrupting commands is set again after a command changes it
+    starttime = time.monotonic()
+    execute("sleep 30", session)
+    assert time.monotonic() - starttime < 2
+
+def test_restart(session, capsys):
+    # Builtins ignoring SIGINT can only be stopped by restarting the shell, which is reported
+    execute("trap '' INT; while :; do :; done", session)
+    assert "[!] Restarted the shell, its working directory, variables and other state were lost" in capsys.readouterr().out
+    assert execute("echo $EXPORTED", session) == "\n"
+
+def test_concurrent(session):
+    # Commands from several threads take turns on the one shell
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        outputs = list(executor.map(lambda x: execute("echo {}; sleep 0.05; echo {}".format(x, x), session), range(8)))
+    assert outputs == ["{}\n{}\n".format(x, x) for x in range(8)]
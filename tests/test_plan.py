@@ -0,0 +1,104 @@
+import itertools
+import random
+import uuid
+
+import pytest
+
+import cmdrunner
+import lib.registry
+
+from lib.base import ExecutionPlan, execute, get_plan
+from lib.encoders.wmic import WmicEncoder
+from lib.runners.echo import EchoRunner
+
+# Arguments for an instance of every encoder, a new encoder needs adding here to be tested
+ARGUMENTS = {
+    "CompressEncoder" : [{}, {"format" : "base64"}],
+    "CurlEncoder" : [{"url" : "http://host/", "data" : "cmd=***"}],
+    "EchoEncoder" : [{}],
+    "PowerShellEncoder" : [{}, {"compress" : False}],
+    "SSHEncoder" : [{"username" : "user", "host" : "host"}, {"username" : "user", "host" : "host", "multiplex" : True}],
+    "WinCmdEncoder" : [{}],
+    "WmicEncoder" : [{"host" : "host", "username" : "user", "password" : "password"}, {"host" : "host", "output" : False}, {"host" : "host", "poll" : False}],
+    "XpCmdShellEncoder" : [{}],
+}
+ALPHABET = "ab01 ^&<>()|\\\"'`$%;=\n\té中"
+
+def get_encoder(name, kwargs, transport):
+    cls = lib.registry.get_class("encoder", name)
+    if "transport" in cls._arguments:
+        kwargs = {**kwargs, "transport" : transport}
+    return cls(**kwargs)
+
+def get_encoders(rng, transport, count):
+    names = [rng.choice(sorted(ARGUMENTS)) for _ in range(count)]
+    return [get_encoder(x, rng.choice(ARGUMENTS[x]), transport) for x in names]
+
+@pytest.fixture
+def deterministic(monkeypatch):
+    # Repeats the random names and paths of the encoders each time it is called
+    def reset():
+        counter = itertools.count()
+        monkeypatch.setattr(uuid, "uuid4", lambda: uuid.UUID(int=next(counter)))
+        random.seed(0)
+    return reset
+
+def test_arguments():
+    assert sorted(ARGUMENTS) == lib.registry.get_names("encoder")
+
+@pytest.mark.parametrize("transport", ["escape", "base64"])
+def test_equivalent(deterministic, transport):
+    rng = random.Random(transport)
+    for _ in range(300):
+        encoders = get_encoders(rng, transport, rng.randint(1, 5))
+        cmd = "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 30)))
+        plan = ExecutionPlan({"runner" : None, "encoders" : encoders})
+        deterministic()
+        encoded = plan.encode(cmd)
+        # Each encoder applied in turn, innermost (last) first
+        deterministic()
+        expected = cmd
+        for encoder in encoders[::-1]:
+            expected = encoder.encode(expected)
+        assert encoded == expected, [x.save() for x in encoders]
+
+def test_templates():
+    encoders = [get_encoder(x, ARGUMENTS[x][0], "escape") for x in ["SSHEncoder", "WinCmdEncoder", "EchoEncoder", "WmicEncoder", "SSHEncoder", "SSHEncoder"]]
+    plan = ExecutionPlan({"runner" : None, "encoders" : encoders})
+    # Consecutive template safe encoders are collapsed into one stage
+    assert plan.names == ["[4-5] SSHEncoder x2", "[3] WmicEncoder", "[0-2] SSHEncoder+WinCmdEncoder+EchoEncoder"]
+    assert not callable(plan.stages[0]) and callable(plan.stages[1]) and not callable(plan.stages[2])
+
+def test_ready_once(monkeypatch):
+    calls = []
+    ready = WmicEncoder.ready
+    monkeypatch.setattr(WmicEncoder, "ready", lambda self, *args: calls.append(self) or ready(self, *args))
+    session = {"runner" : EchoRunner(), "encoders" : [WmicEncoder("host{}".format(x)) for x in range(3)], "decoders" : []}
+    for _ in range(10):
+        execute("whoami", session)
+    assert len(calls) == 3
+
+def test_invalidate(tmp_path):
+    session = {"runner" : EchoRunner(), "encoders" : [], "decoders" : []}
+    plans = [get_plan(session)]
+    def check_changed():
+        assert get_plan(session) is not plans[-1] and get_plan(session) is get_plan(session)
+        plans.append(get_plan(session))
+    assert get_plan(session) is plans[0]
+    cmdrunner.PushEncoder.run("ssh user host", session)
+    check_changed()
+    cmdrunner.PushEncoder.run("wincmd", session)
+    check_changed()
+    assert execute("whoami", session).startswith("ssh ")
+    cmdrunner.PopEncoder.run("", session)
+    check_changed()
+    cmdrunner.SetRunner.run("echo", session)
+    check_changed()
+    path = str(tmp_path / "session.json")
+    cmdrunner.SaveSessionCmd.run(path, session)
+    cmdrunner.LoadSessionCmd.run(path, session, quiet=True)
+    check_changed()
+    assert execute("whoami", session) == "ssh -o \"StrictHostKeyChecking no\" -o \"UserKnownHostsFile /dev/null\" -o \"LogLevel ERROR\" user@host \"whoami\""
+    # Changing the list directly is noticed too
+    session["encoders"].append(lib.registry.get_class("encoder", "EchoEncoder")())
+    check_changed()
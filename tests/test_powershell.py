@@ -0,0 +1,56 @@
+import base64
+import random
+import re
+import zlib
+
+import pytest
+
+from lib.encoders.powershell import PowerShellEncoder
+
+PREFIX = "powershell -NoProfile –ExecutionPolicy Bypass -EncodedCommand "
+STUB = re.compile(r"\$s=New-Object IO\.Compression\.DeflateStream\(\[IO\.MemoryStream\]\[Convert\]::FromBase64String\('([A-Za-z0-9+/=]*)'\),\[IO\.Compression\.CompressionMode\]::Decompress\);iex \(New-Object IO\.StreamReader\(\$s,\[Text\.Encoding\]::UTF8\)\)\.ReadToEnd\(\)$")
+
+def decode(encoded):
+    """
+    Return the script run by the encoded command, and whether it was compressed, as powershell would.
+    """
+    assert encoded.startswith(PREFIX)
+    script = base64.b64decode(encoded[len(PREFIX):], validate=True).decode("utf-16-le")
+    match = STUB.match(script)
+    if match is None:
+        return script, False
+    return zlib.decompress(base64.b64decode(match.group(1)), -15).decode(), True
+
+def get_script(size):
+    # Repetitive, like most scripts, so compresses well
+    lines = ["Get-ChildItem -Path C:\\Users -Recurse | Where-Object {{ $_.Length -gt {} }} | Select-Object FullName".format(x % 10) for x in range(size)]
+    return "\n".join(lines)
+
+@pytest.mark.parametrize("cmd", ["whoami", "Write-Output 'é中\U0001f600'", ""])
+def test_short(cmd):
+    # Too short for the stub to pay for itself
+    encoded = PowerShellEncoder().encode(cmd)
+    assert decode(encoded) == (cmd, False) and encoded == PowerShellEncoder(compress=False).encode(cmd)
+
+@pytest.mark.parametrize("suffix", ["", "\nWrite-Output 'é中\U0001f600'"])
+def test_compressed(suffix):
+    script = get_script(200) + suffix
+    encoded = PowerShellEncoder().encode(script)
+    plain = PowerShellEncoder(compress=False).encode(script)
+    assert decode(encoded) == (script, True) and decode(plain) == (script, False)
+    assert len(encoded) * 10 < len(plain)
+
+def test_incompressible():
+    rng = random.Random(0)
+    # Random CJK is three bytes of UTF-8 to compress but only two of UTF-16 as it is
+    script = "'{}'".format("".join(chr(rng.randint(0x4e00, 0x9fff)) for _ in range(2000)))
+    assert decode(PowerShellEncoder().encode(script)) == (script, False)
+
+def test_shortest():
+    # Whichever form is shorter is used, for scripts either side of the crossover
+    for size in range(0, 12):
+        script = get_script(size)
+        encoded = PowerShellEncoder().encode(script)
+        plain = PowerShellEncoder(compress=False).encode(script)
+        assert len(encoded) <= len(plain) and decode(encoded)[0] == script
+        assert decode(encoded)[1] == (len(encoded) < len(plain))
@@ -0,0 +1,104 @@
+import importlib
+import inspect
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import cmdrunner
+import lib.registry
+
+from lib.base import CmdDecoder, CmdEncoder, CmdRunner, CmdRunnerException, InteractiveCmd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASES = {"runner" : CmdRunner, "encoder" : CmdEncoder, "decoder" : CmdDecoder}
+
+@pytest.fixture
+def manifest(tmp_path, monkeypatch):
+    # An empty cache, counting the times the plugin modules are parsed
+    scans = []
+    scan = lib.registry._scan
+    monkeypatch.setattr(lib.registry, "MANIFEST_PATH", str(tmp_path / "plugins.json"))
+    monkeypatch.setattr(lib.registry, "_manifest", None)
+    monkeypatch.setattr(lib.registry, "_scan", lambda files: scans.append(files) or scan(files))
+    return scans
+
+def reload():
+    lib.registry._manifest = None
+    return lib.registry.get_manifest()
+
+def test_manifest(manifest):
+    # Every plugin class found by importing the modules is in the manifest, and nothing else
+    for plugin_type, (package, _) in lib.registry.PLUGIN_TYPES.items():
+        expected = {}
+        for path in sorted(os.listdir(os.path.join(ROOT, *package.split(".")))):
+            if path.endswith(".py") and not path.startswith("_"):
+                module = importlib.import_module("{}.{}".format(package, path[:-3]))
+                for name, cls in inspect.getmembers(module, inspect.isclass):
+                    if cls.__module__ == module.__name__ and issubclass(cls, BASES[plugin_type]):
+                        expected[name] = module.__name__
+        assert lib.registry.get_manifest()[plugin_type] == expected
+        assert lib.registry.get_names(plugin_type) == sorted(expected)
+
+def test_cached(manifest):
+    plugins = reload()
+    assert len(manifest) == 1
+    with open(lib.registry.MANIFEST_PATH) as f:
+        assert json.load(f)["plugins"] == plugins
+    # Later runs use the cache without parsing the modules again
+    assert reload() == plugins and len(manifest) == 1
+
+def test_rebuilt(manifest, monkeypatch):
+    plugins = reload()
+    get_files = lib.registry._get_files
+    # A plugin module being modified
+    monkeypatch.setattr(lib.registry, "_get_files", lambda: {x : [y[0] + 1, y[1]] if x.endswith("bash.py") else y for x, y in get_files().items()})
+    assert reload() == plugins and len(manifest) == 2
+    # And removed
+    monkeypatch.setattr(lib.registry, "_get_files", lambda: {x : y for x, y in get_files().items() if not x.endswith("bash.py")})
+    assert "BashRunner" not in reload()["runner"] and len(manifest) == 3
+    monkeypatch.setattr(lib.registry, "_get_files", get_files)
+    assert reload() == plugins and len(manifest) == 4
+
+def test_corrupt(manifest):
+    plugins = reload()
+    with open(lib.registry.MANIFEST_PATH, "w") as f:
+        f.write("{")
+    assert reload() == plugins and len(manifest) == 2
+
+def test_find_class():
+    bash = lib.registry.get_class("runner", "BashRunner")
+    for name in ["bash", "BASH", "BashRunner", "bashrunner"]:
+        assert lib.registry.find_class("runner", name) is bash
+    assert lib.registry.find_class("encoder", "ssh").__name__ == "SSHEncoder"
+    assert lib.registry.find_class("decoder", "gzipbase64").__name__ == "GzipBase64Decoder"
+    # Only exact names, with or without the suffix, of the given plugin type
+    for name in ["bas", "bashrunnerx", "", "CmdRunner"]:
+        assert lib.registry.find_class("runner", name) is None
+    assert lib.registry.find_class("encoder", "bash") is None
+    with pytest.raises(KeyError):
+        lib.registry.get_class("runner", "bash")
+
+def test_lazy():
+    # Plugin modules are only imported once they are used
+    code = "; ".join([
+        "import sys, cmdrunner, lib.registry",
+        "plugins = lambda: sorted(x for x in sys.modules if x.split('.')[:2] in [['lib', 'runners'], ['lib', 'encoders'], ['lib', 'decoders']] and x.count('.') == 2)",
+        "print(plugins())",
+        "lib.registry.find_class('runner', 'bash')",
+        "print(plugins())",
+    ])
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert output.splitlines() == ["[]", "['lib.runners.bash']"]
+
+def test_get_command():
+    assert InteractiveCmd.get_command("$push_encoder").tag == "push_encoder"
+    # The shortest unique prefix is enough
+    assert InteractiveCmd.get_command("push_e").tag == "push_encoder"
+    assert InteractiveCmd.get_command("$pop_d").tag == "pop_decoder"
+    with pytest.raises(CmdRunnerException, match="Ambiguous command 'p'"):
+        InteractiveCmd.get_command("p")
+    with pytest.raises(CmdRunnerException, match="Unknown command 'pushx'"):
+        InteractiveCmd.get_command("pushx")
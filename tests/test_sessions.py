@@ -0,0 +1,55 @@
+import pytest
+
+import cmdrunner
+import lib.sessions
+
+from lib.base import execute
+from lib.runners.bash import BashRunner
+
+@pytest.fixture
+def sessions():
+    sessions = lib.sessions.Sessions()
+    sessions.add("default", {"runner" : BashRunner(), "encoders" : [], "decoders" : [], "workers" : 8})
+    cmdrunner.SessionCmd.run("new other", sessions.get())
+    return sessions
+
+def test_new_session(sessions):
+    assert sessions.current == "other"
+    default, other = sessions.get("default"), sessions.get("other")
+    assert default["runner"] is not other["runner"]
+    cmdrunner.PushEncoder.run("WinCmdEncoder", default)
+    assert len(default["encoders"]) == 1 and len(other["encoders"]) == 0
+
+def test_workers(sessions):
+    cmdrunner.SetWorkersCmd.run("3", sessions.get("default"))
+    assert sessions.get("other")["workers"] == 3
+
+def test_display(sessions):
+    cmdrunner.LastOutputCmd.run("display tail 5", sessions.get("default"))
+    assert sessions.get("other")["display"] == ("tail", 5)
+
+def test_cache(sessions, tmp_path):
+    default, other = sessions.get("default"), sessions.get("other")
+    cmdrunner.CacheCmd.run("on 60 {}".format(tmp_path / "cache.sqlite"), default)
+    assert other["cache"] is default["cache"]
+    assert execute("echo cached", other) == "cached\n"
+    # Turning the cache off closes it, which must not leave the other session holding it
+    cmdrunner.CacheCmd.run("off", default)
+    assert other.get("cache") is None
+    assert execute("echo uncached", other) == "uncached\n"
+
+def test_history(sessions, tmp_path):
+    default, other = sessions.get("default"), sessions.get("other")
+    cmdrunner.HistoryCmd.run("on {}".format(tmp_path / "history"), other)
+    assert default["history"] is other["history"]
+    cmdrunner.HistoryCmd.run("off", other)
+    assert default.get("history") is None
+    assert execute("echo unarchived", default) == "unarchived\n"
+
+def test_copies(sessions, tmp_path):
+    default = sessions.get("default")
+    cmdrunner.CacheCmd.run("on 60 {}".format(tmp_path / "cache.sqlite"), default)
+    # Copies override shared settings without changing them
+    copy = {**default, "cache" : None}
+    assert copy["cache"] is None and default["cache"] is not None
+    assert "workers" in copy and "runner" in copy
@@ -0,0 +1,59 @@
+import pytest
+
+import cmdrunner
+
+from lib.base import close_encoders, execute
+from lib.encoders.ssh import SSHEncoder
+from lib.runners.echo import EchoRunner
+
+class RecordingRunner(EchoRunner):
+    __slots__ = ("cmds",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cmds = []
+
+    def run(self, cmd):
+        self.cmds.append(cmd)
+        return ""
+
+CONTROL_OPTIONS = "-o \"ControlMaster auto\" -o \"ControlPath /tmp/.cmdrunner-%r@%h:%p\" -o \"ControlPersist 600\""
+
+def get_session(encoders):
+    return {"runner" : RecordingRunner(), "encoders" : encoders, "decoders" : []}
+
+def test_options():
+    encoder = SSHEncoder("user", "host", multiplex=True, identity="id_rsa")
+    assert encoder.get_options() == "-i id_rsa -o \"StrictHostKeyChecking no\" -o \"UserKnownHostsFile /dev/null\" -o \"LogLevel ERROR\" " + CONTROL_OPTIONS
+    assert encoder.close() == "ssh -O exit -o \"ControlPath /tmp/.cmdrunner-%r@%h:%p\" user@host"
+    # Without multiplexing every command opens its own connection, with nothing to close
+    encoder = SSHEncoder("user", "host")
+    assert "Control" not in encoder.encode("id") and encoder.close() is None
+    encoder = SSHEncoder("user", "host", multiplex=True, control_path="/run/ssh-%C", control_persist=30)
+    assert "-o \"ControlPath /run/ssh-%C\" -o \"ControlPersist 30\"" in encoder.encode("id")
+
+def test_close():
+    encoders = [SSHEncoder("user{}".format(x), "host{}".format(x), multiplex=x != 1) for x in range(3)]
+    session = get_session(encoders)
+    execute("id", session)
+    cmdrunner.SSHCloseCmd.run("", session)
+    # Innermost first, each through the hops outside it, skipping hops which are not multiplexed
+    assert session["runner"].cmds[1:] == [
+        SSHEncoder("user0", "host0", multiplex=True).encode(SSHEncoder("user1", "host1").encode(encoders[2].close())),
+        encoders[0].close(),
+    ]
+
+def test_close_fanout():
+    encoders = [SSHEncoder("user", "jump", multiplex=True), SSHEncoder("user", "web1,web2", multiplex=True)]
+    session = get_session(encoders)
+    close_encoders(session)
+    # The jump host shared by both targets is only closed once, after both targets
+    cmds = session["runner"].cmds
+    assert len(cmds) == 3 and cmds[-1] == encoders[0].close()
+    assert all(x.startswith("ssh ") and x.endswith(" user@jump \"ssh -O exit -o \\\"ControlPath /tmp/.cmdrunner-%r@%h:%p\\\" user@{}\"".format(y)) for x, y in zip(cmds, ["web1", "web2"]))
+
+def test_quit():
+    session = get_session([SSHEncoder("user", "host", multiplex=True)])
+    with pytest.raises(SystemExit):
+        cmdrunner.QuitCmd.run("", session)
+    assert session["runner"].cmds == [session["encoders"][0].close()]
@@ -0,0 +1,128 @@
+import json
+import time
+
+import pytest
+
+import cmdrunner
+import lib.stats
+
+from lib.base import CmdDecoder, CmdRunnerException, execute
+from lib.encoders.ssh import SSHEncoder
+from lib.encoders.wmic import WmicEncoder
+from lib.runners.bash import BashRunner
+from lib.runners.echo import EchoRunner
+
+class UpperDecoder(CmdDecoder):
+    def decode(self, cmd):
+        return cmd.upper()
+
+class SlowDecoder(CmdDecoder):
+    def decode_stream(self, chunks):
+        for chunk in chunks:
+            time.sleep(0.1)
+            yield chunk
+
+class LargeDecoder(CmdDecoder):
+    def decode(self, cmd):
+        return cmd * 100000
+
+class FailingRunner(EchoRunner):
+    def run(self, cmd):
+        raise CmdRunnerException("connection refused")
+
+def get_session(**kwargs):
+    session = {"runner" : EchoRunner(), "encoders" : [WmicEncoder("host1", "user", "password"), SSHEncoder("user", "host0", transport="escape")], "decoders" : [UpperDecoder()], "stats" : lib.stats.Stats()}
+    return {**session, **kwargs}
+
+def test_stages():
+    session = get_session()
+    output = execute("whoami", session)
+    record = session["stats"].records[-1]
+    assert [x[:2] for x in record.stages] == [
+        ["[1] SSHEncoder", "encode"],
+        ["[0] WmicEncoder", "encode"],
+        ["EchoRunner.encode", "encode"],
+        ["EchoRunner.run", "run"],
+        ["UpperDecoder", "decode"],
+    ]
+    # The size of each stage is the input of the next, starting from the command
+    sizes = [x[3:] for x in record.stages]
+    assert sizes[0][0] == len("whoami") and sizes[-1][1] == len(output)
+    assert all(x[1] == y[0] for x, y in zip(sizes, sizes[1:]))
+    assert record.seconds >= sum(x[2] for x in record.stages) and record.error is None
+
+def test_chained():
+    # Output is streamed through the decoders, but the runner's time excludes the decoder's and
+    # vice versa
+    session = get_session(runner=BashRunner(), encoders=[], decoders=[SlowDecoder()])
+    execute("sleep 0.5; echo a", session)
+    seconds = {x[0] : x[2] for x in session["stats"].records[-1].stages}
+    assert seconds["BashRunner.run"] >= 0.45 and 0.1 <= seconds["SlowDecoder"] < 0.45
+
+def test_error():
+    session = get_session(runner=FailingRunner())
+    with pytest.raises(CmdRunnerException):
+        execute("whoami", session)
+    record = session["stats"].records[-1]
+    assert record.error == "connection refused" and record.seconds is not None
+
+def test_trace(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    session = get_session(stats=lib.stats.Stats(trace_path=str(path)))
+    for cmd in ["whoami", "x" * 2000]:
+        execute(cmd, session)
+    session["stats"].close()
+    records = [json.loads(x) for x in path.read_text().splitlines()]
+    assert [x["cmd"] for x in records] == ["whoami", "x" * 1000]
+    assert records[0] == json.loads(json.dumps(session["stats"].records[0].to_dict()))
+    assert records[0]["stages"][0]["bytes_in"] == len("whoami")
+
+def test_profile():
+    session = get_session(decoders=[LargeDecoder()], stats=lib.stats.Stats(profile=True, memory=True))
+    try:
+        execute("whoami", session)
+    finally:
+        session["stats"].close()
+    record = session["stats"].records[-1]
+    assert any("encode" in x["function"] for x in record.profile)
+    # At least the decoded output is held in memory
+    assert record.memory_peak >= len(record.cmd) + record.stages[-1][4]
+
+def test_summary():
+    session = get_session()
+    for _ in range(20):
+        execute("whoami", session)
+    lines = session["stats"].summary().splitlines()
+    assert lines[0].split() == ["Stage", "Count", "p50", "p95", "Bytes", "Amplify"]
+    assert [x.rsplit(None, 5)[0] for x in lines[1:]] == ["[1] SSHEncoder", "[0] WmicEncoder", "EchoRunner.encode", "EchoRunner.run", "UpperDecoder", "Total"]
+    assert lines[-1].split()[1] == "20"
+    # Size amplification of each encoder, but not of the runner
+    record = session["stats"].records[-1]
+    assert lines[1].split()[-1] == "{:.2f}x".format(record.stages[0][4] / len("whoami"))
+    assert lines[4].split()[-1] == "-"
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert [lib.stats.percentile(values, x) for x in [0, 50, 95, 100]] == [1, 50, 95, 100]
+    assert lib.stats.percentile([3], 95) == 3 and lib.stats.percentile([], 50) == 0
+    assert [lib.stats.format_time(x) for x in [2, 0.0015, 2.5e-6, 5e-8]] == ["2.00s", "1.50ms", "2.50us", "50ns"]
+
+def test_cmd(capsys, tmp_path):
+    session = get_session(stats=None)
+    with pytest.raises(CmdRunnerException, match="Stats are not being recorded"):
+        cmdrunner.StatsCmd.run("", session)
+    cmdrunner.StatsCmd.run("on", session)
+    cmdrunner.StatsCmd.run("trace {}".format(tmp_path / "trace.jsonl"), session)
+    execute("whoami", session)
+    capsys.readouterr()
+    cmdrunner.StatsCmd.run("last", session)
+    assert capsys.readouterr().out.startswith("Command: whoami\n\t[1] SSHEncoder")
+    cmdrunner.StatsCmd.run("reset", session)
+    with pytest.raises(CmdRunnerException, match="No commands have been recorded"):
+        cmdrunner.StatsCmd.run("last", session)
+    with pytest.raises(CmdRunnerException, match="Invalid arguments 'profile maybe'"):
+        cmdrunner.StatsCmd.run("profile maybe", session)
+    cmdrunner.StatsCmd.run("off", session)
+    # The trace file is closed once stopped, with no further commands appended
+    execute("whoami", session)
+    assert session["stats"] is None and len((tmp_path / "trace.jsonl").read_text().splitlines()) == 1
@@ -0,0 +1,87 @@
+import random
+import time
+import tracemalloc
+
+import pytest
+
+from lib.base import CmdDecoder, execute, execute_stream
+from lib.runners.bash import BashRunner
+from lib.utils import iter_lines
+
+class UpperDecoder(CmdDecoder):
+    def decode(self, cmd):
+        return cmd.upper()
+
+def get_text(seed, size=2000):
+    rng = random.Random(seed)
+    return "".join(rng.choice(["a", "b", " ", "\n", "\r", "\r\n", "\r\n\r\n", " "]) for _ in range(size))
+
+def split(text, seed, max_size=12):
+    # Random chunks, including empty ones, which split "\r\n" and every other pair of characters
+    rng = random.Random(seed)
+    chunks = []
+    index = 0
+    while index < len(text):
+        size = rng.randint(0, max_size)
+        chunks.append(text[index:index + size])
+        index += size
+    return chunks
+
+@pytest.mark.parametrize("seed", range(20))
+def test_iter_lines(seed):
+    text = get_text(seed)
+    for max_size in [1, 2, 12, 500]:
+        assert list(iter_lines(split(text, seed, max_size))) == text.splitlines()
+    # Lines much shorter than max_length are unchanged
+    assert list(iter_lines(split(text, seed), max_length=1000)) == text.splitlines()
+
+@pytest.mark.parametrize("line", ["a\r\nb", "a\rb", "a\r\n"])
+def test_iter_lines_crlf(line):
+    for index in range(len(line) + 1):
+        assert list(iter_lines([line[:index], line[index:]])) == line.splitlines()
+
+def test_iter_lines_incremental():
+    # Each line is yielded once complete, before the following chunks are read
+    read = []
+    def chunks():
+        for chunk in ["first\nsec", "ond\r", "\nthird"]:
+            read.append(chunk)
+            yield chunk
+    lines = iter_lines(chunks())
+    assert next(lines) == "first" and read == ["first\nsec"]
+    # A trailing "\r" is held back until the next chunk shows whether it starts "\r\n"
+    assert next(lines) == "second" and read == ["first\nsec", "ond\r", "\nthird"]
+    assert list(lines) == ["third"]
+
+def test_iter_lines_max_length():
+    line = "x" * 1000
+    pieces = list(iter_lines(split(line + "\nend", 0), max_length=100))
+    assert pieces[-1] == "end" and "".join(pieces[:-1]) == line
+    assert all(len(x) >= 100 for x in pieces[:-2])
+
+@pytest.fixture
+def session():
+    return {"runner" : BashRunner(), "encoders" : [], "decoders" : []}
+
+def test_execute_stream(session):
+    # Output is yielded as the command writes it, before the command completes
+    starttime = time.monotonic()
+    chunks = execute_stream("echo first; sleep 0.5; echo second", session)
+    assert next(chunks) == "first\n" and time.monotonic() - starttime < 0.4
+    assert list(chunks) == ["second\n"]
+
+def test_decode_stream(session):
+    # Decoders without decode_stream() get the whole output passed to decode()
+    session["decoders"] = [UpperDecoder()]
+    assert list(execute_stream("echo a; sleep 0.1; echo b", session)) == ["A\nB\n"]
+    assert execute("echo a", session) == "A\n"
+
+def test_flat_memory(session):
+    # Streaming output much larger than a chunk does not hold on to it
+    tracemalloc.start()
+    try:
+        size = sum(len(x) for x in execute_stream("head -c 20000000 /dev/zero", session))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert size == 20000000 and peak < 2000000
@@ -0,0 +1,121 @@
+import os
+import random
+import re
+
+import pytest
+
+import lib.transfer
+
+from lib.base import CmdRunnerException
+from lib.encoders.ssh import SSHEncoder
+from lib.encoders.wincmd import WinCmdEncoder
+from lib.encoders.xpcmdshell import XpCmdShellEncoder
+from lib.runners.bash import BashRunner
+from lib.runners.echo import EchoRunner
+
+class RecordingRunner(BashRunner):
+    # Records each command run, failing those matching the fail pattern
+    cmds = []
+    fail = None
+
+    def run_stream(self, cmd):
+        RecordingRunner.cmds.append(cmd)
+        if RecordingRunner.fail is not None and re.search(RecordingRunner.fail, cmd):
+            raise CmdRunnerException("connection reset")
+        return super().run_stream(cmd)
+
+@pytest.fixture
+def session():
+    RecordingRunner.cmds = []
+    RecordingRunner.fail = None
+    return {"runner" : RecordingRunner(), "encoders" : [], "decoders" : []}
+
+@pytest.fixture
+def ssh(tmp_path, monkeypatch):
+    # Runs the remote command with sh, like ssh to a host with sh as its shell
+    path = tmp_path / "bin" / "ssh"
+    path.parent.mkdir()
+    path.write_text("#!/bin/sh\nfor cmd; do :; done\nexec sh -c \"$cmd\"\n")
+    path.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}{}{}".format(path.parent, os.pathsep, os.environ["PATH"]))
+
+def write_file(path, size):
+    data = random.Random(size).randbytes(size)
+    path.write_bytes(data)
+    return data
+
+def get_cmds(pattern):
+    return [x for x in RecordingRunner.cmds if re.search(pattern, x)]
+
+@pytest.mark.parametrize("size", [0, 1, 100000])
+def test_roundtrip(session, tmp_path, size):
+    data = write_file(tmp_path / "local", size)
+    assert lib.transfer.upload(str(tmp_path / "local"), str(tmp_path / "remote"), session, workers=4, max_chunk_size=16384) == size
+    assert (tmp_path / "remote").read_bytes() == data
+    assert lib.transfer.download(str(tmp_path / "remote"), str(tmp_path / "downloaded"), session, workers=4, chunk_size=8192) == size
+    assert (tmp_path / "downloaded").read_bytes() == data
+    # Only the transferred files are left
+    assert sorted(os.listdir(tmp_path)) == ["downloaded", "local", "remote"]
+
+def test_hops(session, ssh, tmp_path):
+    session["encoders"] = [SSHEncoder("user", "host{}".format(x), transport="escape") for x in range(3)]
+    data = write_file(tmp_path / "local", 50000)
+    lib.transfer.upload(str(tmp_path / "local"), str(tmp_path / "remote"), session, max_chunk_size=8192)
+    assert (tmp_path / "remote").read_bytes() == data
+    assert all(x.startswith("ssh ") for x in RecordingRunner.cmds)
+    lib.transfer.download(str(tmp_path / "remote"), str(tmp_path / "downloaded"), session)
+    assert (tmp_path / "downloaded").read_bytes() == data
+
+@pytest.mark.parametrize("encoders", [
+    [WinCmdEncoder(transport="escape")],
+    [XpCmdShellEncoder()],
+    [SSHEncoder("user", "host", transport="escape"), WinCmdEncoder(transport="escape")],
+])
+def test_chunk_size(encoders):
+    # The largest chunk whose write command fits every stage of the chain
+    session = {"runner" : EchoRunner(), "encoders" : encoders, "decoders" : []}
+    transfer = lib.transfer.get_transfer(session)
+    path = "C:\\remote.exe.cmdrunner-part.99999999"
+    chunk_size = lib.transfer.get_chunk_size(session, transfer, path, 1048576)
+    assert chunk_size % 3 == 0 and chunk_size < 8191
+    data = random.Random(0).randbytes(1048576)
+    assert lib.transfer.fits(transfer.write_chunk(path, data[:chunk_size]), session)
+    # One more base64 group does not fit for either the hardest to escape or incompressible data
+    larger = [b"\xfb\xef\xbe" * (chunk_size // 3 + 1), data[:chunk_size + 3]]
+    assert not all(lib.transfer.fits(transfer.write_chunk(path, x), session) for x in larger)
+
+def test_resume_upload(session, tmp_path):
+    data = write_file(tmp_path / "local", 40000)
+    args = [str(tmp_path / "local"), str(tmp_path / "remote"), session]
+    # Chunks from the fourth on fail, leaving the first three on the remote system
+    RecordingRunner.fail = r"cmdrunner-part\.([3-9]|[0-9]{2}) &&"
+    with pytest.raises(CmdRunnerException, match="Chunk [0-9]+ failed: connection reset"):
+        lib.transfer.upload(*args, max_chunk_size=4096, retries=2)
+    count = len(set(re.findall(r"cmdrunner-part\.([0-9]+) &&", " ".join(RecordingRunner.cmds))))
+    assert count == 10 and not (tmp_path / "remote").exists()
+    RecordingRunner.cmds = []
+    RecordingRunner.fail = None
+    lib.transfer.upload(*args, max_chunk_size=4096)
+    # Only the missing chunks are sent again
+    assert len(get_cmds(r"base64 -d >")) == count - 3
+    assert (tmp_path / "remote").read_bytes() == data
+
+def test_resume_download(session, tmp_path):
+    data = write_file(tmp_path / "remote", 40000)
+    args = [str(tmp_path / "remote"), str(tmp_path / "local"), session]
+    RecordingRunner.fail = r"skip=([2-9]|[0-9]{2}) "
+    with pytest.raises(CmdRunnerException, match="Chunk [0-9]+ failed: connection reset"):
+        lib.transfer.download(*args, chunk_size=4096, retries=2)
+    assert not (tmp_path / "local").exists() and (tmp_path / "local.cmdrunner-state").exists()
+    RecordingRunner.cmds = []
+    RecordingRunner.fail = None
+    lib.transfer.download(*args, chunk_size=4096)
+    # Only the chunks which failed are read again
+    assert len(get_cmds(r"skip=")) == 10 - 2
+    assert (tmp_path / "local").read_bytes() == data
+    assert not (tmp_path / "local.cmdrunner-state").exists() and not (tmp_path / "local.cmdrunner-part").exists()
+
+def test_fanout(session, tmp_path):
+    session["encoders"] = [SSHEncoder("user", "web1,web2")]
+    with pytest.raises(CmdRunnerException, match="not supported with fanned out encoders"):
+        lib.transfer.download(str(tmp_path / "remote"), str(tmp_path / "local"), session)
@@ -0,0 +1,124 @@
+import base64
+import glob
+import os
+import re
+import shlex
+
+import pytest
+
+from lib.base import CmdRunnerException, ExecutionPlan, execute
+from lib.encoders.ssh import SSHEncoder
+from lib.encoders.wincmd import WinCmdEncoder
+from lib.encoders.wmic import WmicEncoder
+from lib.runners.bash import BashRunner
+
+# Long enough, and with enough quotes and backslashes, for base64 to be shorter over 5 hops
+COMMANDS = [
+    "echo \"a \\\\ b\" 'c \"d\" e' && printf '%s\\n' \"x\\\\y\" \"q'q\" >&2",
+    "for x in 1 2 3; do echo \"[\\\"x\\\"]\"; done; test -d / && echo \"\\\\done\\\\\"",
+    "echo \"\\\"\\\"\\\"\" ; echo '\\\\\\\\' ; exit 3",
+    # Expanded and piped by the innermost shell, however the command is carried
+    "x=inner; echo \"[$x] `echo \\\"tick\\\"`\" | tr a-z A-Z; echo '$x' | cat; exit 4",
+]
+# Long enough, and with enough metacharacters, for base64 to be shorter over 5 hops
+WINDOWS_COMMAND = "(echo a & echo b) > C:\\a.txt & (type C:\\a.txt | findstr a) && (dir C:\\ | more) & (echo c) >> C:\\a.txt & (type C:\\a.txt | sort) & del C:\\a.txt"
+
+def get_encoders(transport, hops=5):
+    return [SSHEncoder("user", "host{}".format(x), transport=transport) for x in range(hops)]
+
+def encode(cmd, encoders):
+    return ExecutionPlan({"runner" : None, "encoders" : encoders}).encode(cmd)
+
+def get_payloads(encoded):
+    return [base64.b64decode(x).decode() for x in re.findall(r"\.b64 echo ([A-Za-z0-9+/=]+)", encoded)]
+
+def test_default_auto():
+    assert SSHEncoder("user", "host").transport == "auto"
+    assert WinCmdEncoder().transport == "auto" and WmicEncoder("host").transport == "auto"
+    # Short commands are still escaped
+    assert encode("id", [SSHEncoder("user", "host0")]) == encode("id", get_encoders("escape", 1))
+
+@pytest.mark.parametrize("cmd", COMMANDS)
+def test_transports(cmd):
+    assert "base64 -d" not in encode(cmd, get_encoders("escape"))
+    assert "base64 -d" in encode(cmd, get_encoders("auto"))
+    assert "base64 -d" in encode(cmd, get_encoders("base64", 1))
+
+@pytest.mark.parametrize("transport", ["escape", "base64", "auto"])
+def test_invalid_transport(transport):
+    for encoder in [SSHEncoder("user", "host", transport=transport), WinCmdEncoder(transport=transport), WmicEncoder("host", transport=transport)]:
+        ExecutionPlan({"runner" : None, "encoders" : [encoder]})
+        encoder.transport = "gzip"
+        with pytest.raises(CmdRunnerException, match="Unsupported transport 'gzip'"):
+            ExecutionPlan({"runner" : None, "encoders" : [encoder]})
+
+@pytest.fixture
+def ssh(tmp_path, monkeypatch):
+    # Runs the remote command with sh as the login shell, like ssh to a host with sh as its shell
+    path = tmp_path / "ssh"
+    path.write_text("#!/bin/sh\nfor cmd; do :; done\nexec sh -c \"$cmd\"\n")
+    path.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}{}{}".format(tmp_path, os.pathsep, os.environ["PATH"]))
+
+@pytest.mark.parametrize("cmd", COMMANDS)
+def test_equivalent(ssh, cmd):
+    runner = BashRunner()
+    files = set(glob.glob("/tmp/.cmdrunner-*"))
+    results = []
+    for transport in ["escape", "auto", "base64"]:
+        output = execute(cmd, {"runner" : runner, "encoders" : get_encoders(transport), "decoders" : []})
+        results.append((output, runner.exit_status))
+    # The same as running the command with sh directly
+    assert results == [(execute("sh -c {}".format(shlex.quote(cmd)), {"runner" : runner, "encoders" : [], "decoders" : []}), runner.exit_status)] * 3
+    # The command file removes itself, even when the command exits the shell
+    assert set(glob.glob("/tmp/.cmdrunner-*")) == files
+
+def test_wincmd():
+    encoded = encode(WINDOWS_COMMAND, [WinCmdEncoder(transport="base64")])
+    path, = re.findall(r"C:\\Windows\\Temp\\cmdrunner-[0-9a-f]+", encoded)[:1]
+    assert get_payloads(encoded) == ["del {}.txt\n{}".format(path, WINDOWS_COMMAND)]
+    assert encoded == "cmd /S /C " + " ^& ".join([
+      "^>{}.b64 echo {}".format(path, base64.b64encode(get_payloads(encoded)[0].encode()).decode()),
+      "certutil -f -decode {0}.b64 {0}.txt ^>nul".format(path),
+      "del {}.b64".format(path),
+      "for /F \"delims=\" %c in ^({}.txt^) do @cmd /S /C %c".format(path),
+    ])
+    assert "certutil" not in encode(WINDOWS_COMMAND, [WinCmdEncoder() for _ in range(3)])
+    encoded = encode(WINDOWS_COMMAND, [WinCmdEncoder() for _ in range(5)])
+    assert "certutil" in encoded and len(encoded) < len(encode(WINDOWS_COMMAND, [WinCmdEncoder(transport="escape") for _ in range(5)]))
+    assert [x.split("\n", 1)[1] for x in get_payloads(encoded)] == [WINDOWS_COMMAND]
+
+@pytest.mark.parametrize("cmd", ["{} & echo {}".format(WINDOWS_COMMAND, x) for x in ["\"", "%PATH%", "\r\necho b", "\necho b", "\u00e9"]] + [";" + WINDOWS_COMMAND])
+def test_wincmd_inexact(cmd):
+    # Commands which cmd.exe would run differently from the decoded file are always escaped
+    assert encode(cmd, [WinCmdEncoder() for _ in range(5)]) == encode(cmd, [WinCmdEncoder(transport="escape") for _ in range(5)])
+
+def test_wmic_nested():
+    encoders = [WmicEncoder("host{}".format(x), "user", "password") for x in range(4)]
+    encoded = encode("whoami & echo \"done\"", encoders)
+    # Each hop carries the hop inside it base64 encoded, so only the innermost command is escaped
+    for index in range(3):
+        assert "/NODE:\"host{}\"".format(index) in encoded
+        assert "certutil -f -decode" in encoded and "^" not in encoded
+        encoded, = get_payloads(encoded)
+    assert "/NODE:\"host3\"" in encoded and "base64" not in encoded and "certutil" not in encoded
+    assert "process call create \"cmd /S /C (whoami & echo \\\"done\\\") > C:\\" in encoded
+
+def test_wmic_escape():
+    # Nested hops carried by escaping, as before the base64 transport
+    encoders = [WmicEncoder("host{}".format(x), "user", "password", transport="escape") for x in range(2)]
+    encoded = encode("whoami", encoders)
+    assert "certutil" not in encoded and "cmd /S /C ^(whoami^) ^> C:\\" in encoded
+    # An escaped command over the command line limit is carried base64 encoded by auto
+    encoder = WmicEncoder("host", "user", "password")
+    assert "certutil" not in encode("echo {}".format("a" * 8000), [encoder])
+    encoded = encode("echo {}".format("a" * 8200), [encoder])
+    assert get_payloads(encoded) == ["echo {}".format("a" * 8200)]
+
+def test_wmic_no_output():
+    encoder = WmicEncoder("host", "user", "password", output=False, transport="base64")
+    encoded = encode("whoami", [encoder])
+    assert get_payloads(encoded) == ["whoami"]
+    assert re.search(r"do @cmd /S /C %c\) & rmdir /S /Q C:\\\w+\"$", encoded)
+    encoder.transport = "escape"
+    assert encode("whoami", [encoder]) == "wmic /NODE:\"host\" /User:\"user\" /Password:\"password\" process call create \"whoami\""
@@ -0,0 +1,124 @@
+import asyncio
+import gzip
+import http.server
+import threading
+import time
+import urllib.parse
+
+import pytest
+
+from lib.base import execute, execute_batch_async, execute_stream
+from lib.runners.web import WebRunner
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Keeps connections alive between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        data = urllib.parse.parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        cmd = data["cmd"][0]
+        self.server.requests.append((self.client_address, self.headers["Accept-Encoding"]))
+        if cmd == "stream":
+            # Written in chunks with a pause between them
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in [b"first\n", b"second\n"]:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+                time.sleep(0.5)
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        body = "ran {}".format(cmd).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        if "gzip" in self.headers["Accept-Encoding"]:
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def session(server):
+    runner = WebRunner("http://127.0.0.1:{}/".format(server.server_address[1]), "cmd=***")
+    return {"runner" : runner, "encoders" : [], "decoders" : []}
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_run(server, session, compress):
+    session["runner"].compress = compress
+    cmds = ["id", "echo a+b & c", "whoami"]
+    assert [execute(x, session) for x in cmds] == ["ran {}".format(x) for x in cmds]
+    # Every request reuses the one keep-alive connection, negotiating compression if enabled
+    assert len(set(x for x, _ in server.requests)) == 1
+    assert all(x == ("gzip, deflate" if compress else "identity") for _, x in server.requests)
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_stream(session, stream):
+    session["runner"].stream = stream
+    starttime = time.monotonic()
+    chunks = execute_stream("stream", session)
+    first = next(chunks)
+    if stream:
+        # The body is read as it arrives
+        assert first == "first\n" and time.monotonic() - starttime < 0.4
+        assert "".join(chunks) == "second\n"
+    else:
+        assert first == "first\nsecond\n" and list(chunks) == []
+
+def test_encode():
+    assert WebRunner("http://127.0.0.1/", "cmd=***").encode("a b&c=d") == "a+b%26c%3Dd"
+
+async def start_server():
+    import aiohttp.web
+    async def handler(request):
+        data = await request.post()
+        return aiohttp.web.Response(text="ran {}".format(data["cmd"]))
+    app = aiohttp.web.Application()
+    app.router.add_post("/", handler)
+    server = aiohttp.web.AppRunner(app)
+    await server.setup()
+    site = aiohttp.web.TCPSite(server, "127.0.0.1", 0)
+    await site.start()
+    return server, "http://127.0.0.1:{}/".format(server.addresses[0][1])
+
+async def run_batch(runner, cmds, close):
+    server, url = await start_server()
+    runner.url = url
+    session = {"runner" : runner, "encoders" : [], "decoders" : []}
+    try:
+        results = [x async for x in execute_batch_async(cmds, session, workers=4)]
+        sessions = [x[0] for x in runner._async_sessions.values()]
+        if close:
+            await runner.aclose()
+        return results, sessions
+    finally:
+        await server.cleanup()
+
+@pytest.mark.parametrize("close", [True, False])
+def test_run_async(close):
+    pytest.importorskip("aiohttp")
+    runner = WebRunner("http://127.0.0.1/", "cmd=***")
+    cmds = ["id", "echo a b", "whoami"]
+    results, sessions = asyncio.run(run_batch(runner, cmds, close))
+    assert [x[1].getvalue() for x in results] == ["ran {}".format(x) for x in cmds]
+    assert all(x[2] is None for x in results)
+    # Every request on the loop shares one session, which is closed with the loop even without aclose()
+    assert len(sessions) == 1 and sessions[0].closed
+    # A new loop gets a new session, and the closed loop's is forgotten
+    results, _sessions = asyncio.run(run_batch(runner, ["id"], close))
+    assert results[0][1].getvalue() == "ran id" and len(_sessions) == 1 and _sessions[0] is not sessions[0]
+    assert len(runner._async_sessions) == 0
@@ -0,0 +1,40 @@
+import re
+
+from lib.base import ExecutionPlan
+from lib.encoders.ssh import SSHEncoder
+from lib.encoders.wmic import WmicEncoder
+
+def encode(cmd, encoders):
+    return ExecutionPlan({"runner" : None, "encoders" : encoders}).encode(cmd)
+
+def test_poll():
+    encoded = encode("whoami", [WmicEncoder("host", "user", "password", timeout=20)])
+    match = re.match("".join([
+        r"mkdir \\\\host\\C\$\\(\w+) && ",
+        r"wmic /NODE:\"host\" /User:\"user\" /Password:\"password\" process call create \"cmd /S /C \(whoami\) > C:\\\1\\(\w+)\.log & type nul > C:\\\1\\(\w+)\.done\" >nul && ",
+        r"\(for /L %i in \(1,1,20\) do @if not exist \\\\host\\C\$\\\1\\\3\.done ping -n 2 127\.0\.0\.1 >nul\) & ",
+        r"type \\\\host\\C\$\\\1\\\2\.log & ",
+        r"rmdir /S /Q \\\\host\\C\$\\\1$",
+    ]), encoded)
+    # The completion marker is only written once the command has finished, and is polled for every
+    # second rather than waiting a fixed delay
+    assert match is not None, encoded
+    assert "ping -n 2 " in encoded and "ping -n 3 " not in encoded
+
+def test_delay():
+    encoded = encode("whoami", [WmicEncoder("host", "user", "password", poll=False, delay=5)])
+    assert re.match(r"mkdir \\\\host\\C\$\\(\w+) && wmic /NODE:\"host\" /User:\"user\" /Password:\"password\" process call create \"cmd /S /C \(whoami\) > C:\\\1\\(\w+)\.log\" >nul && ping -n 5 127\.0\.0\.1 >nul && type \\\\host\\C\$\\\1\\\2\.log && rmdir /S /Q \\\\host\\C\$\\\1$", encoded), encoded
+    assert ".done" not in encoded
+
+def test_nested_timeouts():
+    # Each hop waits for the hops inside it as well as its own command
+    encoders = [WmicEncoder("host0", timeout=60, delay=2), SSHEncoder("user", "host1"), WmicEncoder("host2", timeout=30, delay=3)]
+    ExecutionPlan({"runner" : None, "encoders" : encoders})
+    assert [encoders[0]._timeout, encoders[2]._timeout] == [90, 30]
+    assert [encoders[0]._delay, encoders[2]._delay] == [5, 3]
+    assert "(for /L %i in (1,1,90) do @if not exist \\\\host0\\C$\\" in encode("whoami", encoders)
+
+def test_no_output():
+    # Without output there is nothing to wait for
+    encoded = encode("whoami", [WmicEncoder("host", "user", "password", output=False)])
+    assert encoded == "wmic /NODE:\"host\" /User:\"user\" /Password:\"password\" process call create \"whoami\""
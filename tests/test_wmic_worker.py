@@ -0,0 +1,47 @@
+import pytest
+
+import cmdrunner
+
+from lib.base import CmdRunnerException
+from lib.encoders.wmic import WmicEncoder
+from lib.runners.echo import EchoRunner
+
+class FailingRunner(EchoRunner):
+    # Fails the given number of commands with an exception which is not a CmdRunnerException
+    failures = 0
+
+    def run(self, cmd):
+        if FailingRunner.failures:
+            FailingRunner.failures -= 1
+            raise ConnectionError("connection reset")
+        return cmd
+
+@pytest.fixture
+def session():
+    session = {"runner" : FailingRunner(), "encoders" : [WmicEncoder("10.0.0.1", "user", "password")], "decoders" : []}
+    cmdrunner.WmicWorkerCmd.run("start", session)
+    return session
+
+def test_start(session, capsys):
+    encoder, hops = session["wmic_workers"]["[0] 10.0.0.1"]
+    assert encoder is session["encoders"][0]
+    cmdrunner.WmicWorkerCmd.run("status", session)
+    assert "[0] 10.0.0.1 running" in capsys.readouterr().out
+    # Commands are now dropped on the worker's share
+    assert ".b64" in encoder.encode("whoami")
+
+def test_stop(session):
+    encoder = session["encoders"][0]
+    cmdrunner.WmicWorkerCmd.run("stop", session)
+    assert session["wmic_workers"] == {}
+    assert encoder.stop_worker() is None and ".b64" not in encoder.encode("whoami")
+
+def test_stop_failed(session):
+    encoder = session["encoders"][0]
+    FailingRunner.failures = 1
+    with pytest.raises(CmdRunnerException, match="connection reset"):
+        cmdrunner.PopEncoder.run("", session)
+    # The worker is kept, so stopping it again builds the same command and succeeds
+    assert len(session["encoders"]) == 1 and encoder.stop_worker() is not None
+    cmdrunner.PopEncoder.run("", session)
+    assert session["wmic_workers"] == {} and session["encoders"] == []